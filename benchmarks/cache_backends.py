@@ -0,0 +1,90 @@
+'''Compare the cache backends on a synthetic build.
+
+This times opening a cache, recording a deck's worth of entries,
+reading them back in bulk and trimming, for each backend in turn:
+
+    python benchmarks/cache_backends.py [--tags N] [--repeat N]
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lazy_slides.cache import BACKENDS, create_cache
+
+def import_time(backend):
+    '''Time importing a backend in a fresh interpreter.'''
+    code = ('import time; start = time.time(); '
+            'from lazy_slides.cache import backend_class; '
+            'backend_class({!r}); print(time.time() - start)'.format(backend))
+    env = dict(os.environ, PYTHONPATH=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..'))
+    return float(subprocess.check_output([sys.executable, '-c', code], env=env))
+
+def run(backend, directory, tags):
+    db_file = os.path.join(directory, '{}.db'.format(backend))
+    filename = os.path.join(directory, 'image.png')
+    timings = []
+
+    def timed(label, func):
+        start = time.time()
+        func()
+        timings.append((label, time.time() - start))
+
+    caches = []
+    timed('open', lambda: caches.append(create_cache(db_file, 100, backend)))
+    cache = caches[0]
+
+    def populate():
+        for tag in tags:
+            cache.set_many('engine', [(tag, filename, -1, -1),
+                                      (tag, filename, 800, 600)])
+        cache.flush()
+    timed('set', populate)
+
+    def lookup():
+        for tag in tags:
+            cache.get('engine', tag)
+            cache.get('engine', tag, 800, 600)
+    timed('get', lookup)
+
+    timed('get_many', lambda: cache.get_many('engine', tags, 800, 600))
+    timed('trim', lambda: cache.trim(len(tags)))
+    cache.close()
+
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tags', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tags = ['tag{}'.format(i) for i in range(args.tags)]
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'image.png'), 'wb') as f:
+            f.write(b'x' * 1024)
+
+        for backend in sorted(BACKENDS):
+            best = {}
+            for _ in range(args.repeat):
+                for label, seconds in run(backend, directory, tags):
+                    best[label] = min(best.get(label, seconds), seconds)
+                os.remove(os.path.join(directory, '{}.db'.format(backend)))
+            best['import'] = import_time(backend)
+            print('{:8} {}'.format(backend, '  '.join(
+                '{}={:.3f}s'.format(label, best[label])
+                for label in ('import', 'open', 'set', 'get', 'get_many',
+                              'trim'))))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
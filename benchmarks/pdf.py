@@ -0,0 +1,103 @@
+'''Compare writing a deck of slides with reportlab's default ASCII85
+streams against generate.generate_slides(), for PNG and JPEG slide
+images.
+
+    python benchmarks/pdf.py [--pages N] [--size WxH] [--quality Q]
+
+Each page gets its own photo-like image, since reportlab only embeds
+a file once however many times it's drawn. The output size is
+reported alongside the time, as is whether the JPEGs' bytes appear
+in the PDF unchanged.
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import PIL.Image
+from reportlab.pdfgen import canvas
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lazy_slides import generate
+from lazy_slides import manipulation
+from lazy_slides.manipulation.encode import save
+
+def make_images(directory, pages, size, encoding):
+    # Noise over a gradient compresses roughly like a photo rather
+    # than like a flat colour.
+    gradient = PIL.Image.linear_gradient('L').resize(size)
+    filenames = []
+    for page in range(pages):
+        noise = PIL.Image.effect_noise(size, 16 + page % 32)
+        im = PIL.Image.merge('RGB', (gradient, noise, gradient))
+        filename = os.path.join(
+            directory,
+            '{}{}'.format(page, manipulation.extension(encoding)))
+        save(im, filename, encoding)
+        filenames.append(filename)
+    return filenames
+
+def default_streams(tags, tag_map, outfilename, size):
+    '''Write the deck the way generate_slides() used to.'''
+    c = canvas.Canvas(outfilename)
+    for tag in tags:
+        c.setPageSize(size)
+        c.drawImage(tag_map[tag], 0, 0, width=size[0], height=size[1])
+        c.showPage()
+    c.save()
+
+def binary_streams(tags, tag_map, outfilename, size):
+    generate.generate_slides(tags,
+                             tag_map,
+                             outfilename,
+                             argparse.Namespace(),
+                             size=size)
+
+def embedded_verbatim(filenames, outfilename):
+    with open(outfilename, 'rb') as f:
+        pdf = f.read()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            if f.read() not in pdf:
+                return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--size', default='1024x768')
+    parser.add_argument('--quality', type=int, default=85)
+    args = parser.parse_args()
+
+    size = tuple(int(x) for x in args.size.split('x'))
+    directory = tempfile.mkdtemp()
+    try:
+        for encoding in (manipulation.Encoding('png'),
+                         manipulation.Encoding('jpeg', args.quality)):
+            filenames = make_images(directory, args.pages, size, encoding)
+            tags = [str(page) for page in range(args.pages)]
+            tag_map = dict(zip(tags, filenames))
+
+            for label, func in (('ascii85', default_streams),
+                                ('binary', binary_streams)):
+                outfilename = os.path.join(directory, label + '.pdf')
+                start = time.time()
+                func(tags, tag_map, outfilename, size)
+                seconds = time.time() - start
+                print('{:14} {:8} {:.2f}s  {:.3f}s per page  {} bytes{}'.format(
+                    manipulation.encoding_key(encoding),
+                    label,
+                    seconds,
+                    seconds / args.pages,
+                    os.path.getsize(outfilename),
+                    '  verbatim' if encoding.format == 'jpeg' and
+                    embedded_verbatim(filenames, outfilename) else ''))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''Compare converting then resizing a downloaded image against doing
+both from a single decode with manipulation.render().
+
+A large photo-like JPEG is generated and turned into a full-size PNG
+base image plus one slide-sized rendition, first the way the resolver
+used to (convert, then resize the PNG), then in one pass:
+
+    python benchmarks/render.py [--size WxH] [--repeat N]
+
+The bytes written are reported alongside the time; the two-pass
+version also reads the full-size PNG back in.
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lazy_slides import manipulation
+
+SLIDE_SIZE = (200, 200)
+
+def make_source(directory, size):
+    # Noise over a gradient compresses roughly like a photo rather
+    # than like a flat colour.
+    gradient = PIL.Image.linear_gradient('L').resize(size)
+    noise = PIL.Image.effect_noise(size, 32)
+    im = PIL.Image.merge('RGB', (gradient, noise, gradient))
+    filename = os.path.join(directory, 'source.jpg')
+    im.save(filename, quality=90)
+    return filename
+
+def two_pass(source, directory):
+    base = manipulation.convert(source,
+                                outfilename=os.path.join(directory, 'a.png'))
+    resized = manipulation.resize(base, os.path.join(directory, 'b.png'),
+                                  SLIDE_SIZE)
+    return [base, resized]
+
+def fused(source, directory):
+    return manipulation.render(
+        source,
+        base_filename=os.path.join(directory, 'a.png'),
+        renditions=[(os.path.join(directory, 'b.png'), SLIDE_SIZE)])
+
+def run(func, source, directory, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        written = func(source, directory)
+    seconds = (time.time() - start) / repeat
+    return seconds, sum(os.path.getsize(f) for f in written)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', default='3000x2000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    size = tuple(int(x) for x in args.size.split('x'))
+    directory = tempfile.mkdtemp()
+    try:
+        source = make_source(directory, size)
+        for label, func in (('two-pass', two_pass), ('fused', fused)):
+            seconds, written = run(func, source, directory, args.repeat)
+            print('{:9} {:.3f}s per image  {} bytes written'.format(
+                label, seconds, written))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
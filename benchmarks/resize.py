@@ -0,0 +1,87 @@
+'''Compare resizing a large JPEG to a slide-sized image in each
+quality tier of manipulation.render().
+
+    python benchmarks/resize.py [--size WxH] [--target WxH] [--repeat N]
+
+Each tier runs in its own process so that its peak memory use, most
+of which is the decoded image, can be reported separately. The source
+image is made in another process too, since Linux carries a process's
+peak memory use over into programs it runs.
+'''
+
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lazy_slides import manipulation
+
+def make_source(filename, size):
+    # Noise over a gradient compresses roughly like a photo rather
+    # than like a flat colour.
+    gradient = PIL.Image.linear_gradient('L').resize(size)
+    noise = PIL.Image.effect_noise(size, 32)
+    im = PIL.Image.merge('RGB', (gradient, noise, gradient))
+    im.save(filename, quality=90)
+
+def measure(source, target, quality, repeat):
+    '''Time one tier in this process.'''
+    outfilename = os.path.join(os.path.dirname(source), quality + '.png')
+    start = time.time()
+    for _ in range(repeat):
+        manipulation.resize(source, outfilename, target, quality=quality)
+    seconds = (time.time() - start) / repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('{:7} {:.3f}s per image  {:.0f} MiB peak'.format(
+        quality, seconds, peak / 1024.0))
+
+def parse_size(text):
+    return tuple(int(x) for x in text.split('x'))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', default='6000x4000')
+    parser.add_argument('--target', default='200x200')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--make', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.make:
+        make_source(args.source, parse_size(args.size))
+        return
+    if args.measure:
+        measure(args.source, parse_size(args.target), args.measure,
+                args.repeat)
+        return
+
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, 'source.jpg')
+        subprocess.check_call(
+            [sys.executable, __file__,
+             '--make',
+             '--source', source,
+             '--size', args.size])
+        for quality in ('best', 'normal', 'fast'):
+            subprocess.check_call(
+                [sys.executable, __file__,
+                 '--measure', quality,
+                 '--source', source,
+                 '--target', args.target,
+                 '--repeat', str(args.repeat)])
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''Compare per-request connections with the pooled keep-alive
+transport against a local HTTP server.
+
+Each request fetches a small image-sized body from a server on
+localhost, from several worker threads at once, first opening a new
+connection per request as the downloader used to, then through
+lazy_slides.transport:
+
+    python benchmarks/transport.py [--requests N] [--workers N]
+
+The server counts the connections it accepts, i.e. the handshakes
+made. Over a real network, and with TLS, each saved handshake is worth
+one or more round trips rather than the microseconds seen here.
+'''
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from concurrent import futures
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lazy_slides import transport
+
+BODY = b'x' * (64 * 1024)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def run(server, fetch, url, count, workers):
+    server.connections = 0
+    start = time.time()
+    with futures.ThreadPoolExecutor(workers) as e:
+        for result in [e.submit(fetch, url) for _ in range(count)]:
+            assert len(result.result()) == len(BODY)
+    return time.time() - start, server.connections
+
+def fresh(url):
+    return requests.get(url).content
+
+def pooled(url):
+    return transport.get(url).content
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    url = 'http://127.0.0.1:{}/image.png'.format(server.server_address[1])
+    transport.configure(pool_size=args.workers)
+
+    for label, fetch in (('fresh', fresh), ('pooled', pooled)):
+        seconds, connections = run(server, fetch, url,
+                                   args.requests, args.workers)
+        print('{:7} {:.3f}s  {:.0f} req/s  {} connections'.format(
+            label, seconds, args.requests / seconds, connections))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -13,9 +13,10 @@ Originally lifted from:
 It was easier to bundle this file directly rather than use a pypi dependency or whatever.
 '''
 
-import requests # Get from https://github.com/kennethreitz/requests
 import string
 
+from .. import transport
+
 class BingSearchAPI():
     bing_api = "https://api.datamarket.azure.com/Data.ashx/Bing/Search/v1/Composite?"
 
@@ -49,7 +50,7 @@ class BingSearchAPI():
         for key,value in params.iteritems():
             request += '&' + key + '=' + str(value)
         request = self.bing_api + self.replace_symbols(request)
-        return requests.get(request, auth=(self.key, self.key))
+        return transport.get(request, auth=(self.key, self.key))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+'''A content-addressed store for image files.
+
+Files are named by a hash of their contents and sharded into
+subdirectories by the first characters of that hash, so identical
+downloads and renditions are only ever stored once.
+'''
+
+import hashlib
+import logging
+import os
+import uuid
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def file_digest(filename):
+    '''Calculate the hex digest of a file's contents.'''
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class BlobStore:
+    '''A content-addressed file store rooted in a data directory.
+
+    :param directory: The lazy_slides data directory.
+    :param shard_width: The number of leading digest characters used
+      to name the shard subdirectories.
+    '''
+
+    def __init__(self, directory, shard_width=2):
+        # Blobs are recorded by absolute path so that the cache means
+        # the same thing regardless of the working directory.
+        directory = os.path.abspath(directory)
+        self.root = os.path.join(directory, 'blobs')
+        self.temp_dir = os.path.join(directory, 'tmp')
+        self.shard_width = shard_width
+
+    def path(self, digest, ext=''):
+        '''The filename for the blob with a given digest and extension.'''
+        return os.path.join(self.root,
+                            digest[:self.shard_width],
+                            digest + ext)
+
+    def contains(self, digest, ext=''):
+        return os.path.exists(self.path(digest, ext))
+
+    def temp_directory(self):
+        '''Get the store's temp directory, creating it if needed.
+
+        Files written there are on the same filesystem as the blobs,
+        so `put()` can move them into place with a rename.
+        '''
+        _makedirs(self.temp_dir)
+        return self.temp_dir
+
+    def temp_path(self, ext=''):
+        '''Get a unique filename in the store's temp directory.'''
+        return os.path.join(self.temp_directory(), uuid.uuid4().hex + ext)
+
+    def put(self, filename):
+        '''Move a file into the store.
+
+        If the store already holds identical contents, `filename` is
+        simply removed.
+
+        :param filename: The file to store. It is consumed by this.
+        :return: The filename of the blob.
+        '''
+        ext = os.path.splitext(filename)[1].lower()
+        target = self.path(file_digest(filename), ext)
+
+        if os.path.exists(target):
+            log.info('Blob already stored: {} -> {}'.format(filename, target))
+            os.remove(filename)
+            return target
+
+        log.info('Storing blob: {} -> {}'.format(filename, target))
+        _makedirs(os.path.dirname(target))
+        try:
+            os.rename(filename, target)
+        except OSError:
+            # Someone else stored the same contents first.
+            if not os.path.exists(target):
+                raise
+            os.remove(filename)
+
+        return target
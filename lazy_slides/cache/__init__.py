@@ -0,0 +1,77 @@
+'''The cache of downloaded and resized images.
+
+The storage is pluggable: `open_cache()` takes the name of one of the
+`BACKENDS`, or the fully-qualified name of any `CacheBackend`
+subclass. Backends are only imported when they're used, so the
+default `sqlite3` backend doesn't pay for importing SQLAlchemy.
+'''
+
+import contextlib
+import importlib
+
+from .backend import CacheBackend
+from .lru import LRUCache
+
+BACKENDS = {
+    'sqlite': 'lazy_slides.cache.sqlite.SqliteCache',
+    'orm': 'lazy_slides.cache.orm.OrmCache',
+}
+
+DEFAULT_BACKEND = 'sqlite'
+
+def backend_class(backend):
+    '''Find the class implementing a cache backend.
+
+    :param backend: A key of `BACKENDS` or the fully-qualified name of
+      a `CacheBackend` subclass.
+    '''
+    toks = BACKENDS.get(backend, backend).split('.')
+    module_name = '.'.join(toks[:-1])
+    class_name = toks[-1]
+
+    mod = importlib.import_module(module_name)
+
+    return getattr(mod, class_name)
+
+def create_cache(filename, commit_every=None, backend=DEFAULT_BACKEND):
+    '''Create a cache backend for a database file.
+
+    :param filename: The database file.
+    :param commit_every: The number of writes after which pending
+      writes are committed, or `None` to only commit on close.
+    :param backend: The backend to use. See `backend_class()`.
+    '''
+    return backend_class(backend)(filename, commit_every)
+
+@contextlib.contextmanager
+def open_cache(filename,
+               size,
+               max_bytes=None,
+               lru=None,
+               commit_every=None,
+               backend=DEFAULT_BACKEND):
+    '''Open a cache, trimming it to a budget and committing it on
+    exit.
+
+    :param filename: The database file.
+    :param size: The maximum number of entries to keep, or `None`.
+    :param max_bytes: The maximum number of bytes of cached files to
+      keep, or `None`.
+    :param lru: An optional `LRUCache` to put in front of the
+      database. If given, it is what gets yielded.
+    :param commit_every: Commit after this many writes rather than
+      only on exit. See `CacheBackend`.
+    :param backend: The backend to use. See `backend_class()`.
+    '''
+    cache = create_cache(filename, commit_every, backend)
+    if lru is not None:
+        lru.backing = cache
+        cache = lru
+
+    try:
+        yield cache
+        cache.trim(size, max_bytes)
+        cache.close()
+    except Exception:
+        cache.close(commit=False)
+        raise
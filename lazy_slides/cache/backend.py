@@ -0,0 +1,340 @@
+'''The interface shared by the cache backends, and helpers for
+implementing it.
+'''
+
+import datetime
+import functools
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# How long, in seconds, to wait for another connection's write lock.
+BUSY_TIMEOUT = 30
+
+# SQLite limits the number of bound parameters per statement, so bulk
+# lookups are split into chunks of at most this many tags.
+MAX_BATCH = 500
+
+# The encoding of sized entries unless another is given. Caches from
+# before encodings were part of the key only held PNGs, so their sized
+# entries are given this one.
+DEFAULT_ENCODING = 'png'
+
+# The encoding of base entries, which serve every encoding.
+BASE_ENCODING = ''
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def unlink_all(filenames):
+    '''Remove a collection of files, ignoring ones that are already
+    gone.
+    '''
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            log.info('unable to remove cache file: {}'.format(filename))
+
+def expired(timestamp, max_age):
+    '''Whether something stored at `timestamp` is older than `max_age`
+    seconds. A `max_age` of `None` never expires.
+    '''
+    if max_age is None:
+        return False
+    age = datetime.datetime.now() - timestamp
+    return age > datetime.timedelta(seconds=max_age)
+
+def entry_encoding(width, height, encoding):
+    '''The encoding part of the key of an entry.'''
+    if width == -1 and height == -1:
+        return BASE_ENCODING
+    return encoding
+
+def rekey_entries(dbapi_connection, create_entries):
+    '''Rebuild an `entries` table from before encodings were part of
+    its key.
+
+    This runs in one immediate transaction, so other processes opening
+    the same database either wait for it or see it done.
+
+    :param create_entries: The statement creating the current
+      `entries` table.
+    '''
+    def columns():
+        return [row[1] for row in dbapi_connection.execute(
+            'PRAGMA table_info(entries)')]
+
+    if 'encoding' in columns():
+        return
+
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    try:
+        dbapi_connection.execute('BEGIN IMMEDIATE')
+        try:
+            old_columns = columns()
+            if 'encoding' not in old_columns:
+                log.info('adding encodings to cache keys')
+                dbapi_connection.execute(
+                    'ALTER TABLE entries RENAME TO old_entries')
+                dbapi_connection.execute(create_entries)
+                dbapi_connection.execute(
+                    'INSERT INTO entries ({0}, encoding) '
+                    'SELECT {0}, CASE WHEN width = -1 AND height = -1 '
+                    'THEN ? ELSE ? END FROM old_entries'.format(
+                        ', '.join(old_columns)),
+                    (BASE_ENCODING, DEFAULT_ENCODING))
+                dbapi_connection.execute('DROP TABLE old_entries')
+            dbapi_connection.execute('COMMIT')
+        except Exception:
+            dbapi_connection.execute('ROLLBACK')
+            raise
+    finally:
+        dbapi_connection.isolation_level = isolation_level
+
+def configure_connection(dbapi_connection):
+    '''Apply the pragmas used for on-disk cache databases.'''
+    # WAL lets readers proceed while a batch is being committed, and
+    # NORMAL sync is still crash-safe in WAL mode.
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={}'.format(int(BUSY_TIMEOUT * 1000)))
+    cursor.close()
+
+def synchronized(method):
+    '''Serialize calls to a backend method on the backend's lock.'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class CacheBackend:
+    '''The base for cache backends.
+
+    Backends map (engine, tag, width, height, encoding) keys to image
+    filenames, search keys to lists of URLs, and (engine, tag) keys to
+    the source the tag's base image came from. A width and height of
+    -1 denote the base, unsized image for a tag, which is shared by
+    every encoding: its encoding is always `BASE_ENCODING`, whatever
+    is asked for. The encoding names how a sized image was written,
+    e.g. "png" or "jpeg-q85". Entries may also record the
+    pixel dimensions and format of their image, which lets
+    `get_renditions()` find images to derive new sizes from.
+
+    All methods may be called from any thread. Writes are committed
+    in batches of `commit_every` as they are made, so an interrupted
+    build keeps the results it had already recorded. With the default
+    of `None` nothing is committed until `close()`.
+
+    Subclasses implement the lookup and update methods along with
+    `_commit()` and `_rollback()`, and call `_written()` after each
+    write.
+
+    :param filename: The database file.
+    :param commit_every: The number of writes after which pending
+      writes are committed, or `None`.
+    '''
+
+    def __init__(self, filename, commit_every=None):
+        self.filename = filename
+        self.commit_every = commit_every
+        self._pending = 0
+        self._lock = threading.RLock()
+
+    def get(self, engine, tag, width=-1, height=-1,
+            encoding=DEFAULT_ENCODING):
+        '''Look up the filename for a key.
+
+        Entries whose file no longer exists are removed and reported
+        as misses.
+
+        :return: The filename, or `None` on a cache miss.
+        '''
+        raise NotImplementedError()
+
+    def get_many(self, engine, tags, width=-1, height=-1,
+                 encoding=DEFAULT_ENCODING):
+        '''Look up the sized and base entries for many tags at once.
+
+        :param engine: The search engine the entries belong to.
+        :param tags: An iterable of tags to look up.
+        :param width: The width of the sized entries.
+        :param height: The height of the sized entries.
+        :param encoding: The encoding of the sized entries.
+        :return: A dict mapping each tag to a `(filename,
+          base_filename)` tuple. Either member is `None` on a cache
+          miss.
+        '''
+        raise NotImplementedError()
+
+    def set(self, engine, tag, filename, width=-1, height=-1, timestamp=None,
+            pixel_width=None, pixel_height=None, image_format=None,
+            encoding=DEFAULT_ENCODING):
+        '''Store the filename for a key.
+
+        :param timestamp: When the entry was made. Defaults to now.
+        :param pixel_width: The actual width of the image, if known.
+        :param pixel_height: The actual height of the image, if known.
+        :param image_format: The format of the image, e.g. "PNG", if
+          known.
+        '''
+        raise NotImplementedError()
+
+    def set_many(self, engine, entries, encoding=DEFAULT_ENCODING):
+        '''Store many entries at once.
+
+        :param entries: An iterable of `(tag, filename, width,
+          height)` tuples, each optionally extended with `pixel_width,
+          pixel_height, image_format`.
+        :param encoding: The encoding of the sized entries.
+        '''
+        for entry in entries:
+            info = dict(zip(('pixel_width', 'pixel_height', 'image_format'),
+                            entry[4:]))
+            self.set(engine, *entry[:4], encoding=encoding, **info)
+
+    def get_renditions(self, engine, tag, min_width, min_height):
+        '''Find the cached images of a tag which are at least a given
+        size.
+
+        Only entries which recorded their pixel dimensions, and whose
+        files exist, are considered, whatever their encoding.
+
+        :return: A list of `(filename, pixel_width, pixel_height,
+          image_format)` tuples, smallest first.
+        '''
+        raise NotImplementedError()
+
+    def trim(self, size=None, max_bytes=None):
+        '''Evict the oldest entries until the cache fits a budget.
+
+        The budget can be an entry count, a total number of bytes of
+        the files the entries refer to, or both. Evicted files which
+        are not referenced by any remaining entry are deleted.
+
+        :param size: The maximum number of entries to keep, or `None`
+          for no limit.
+        :param max_bytes: The maximum number of bytes to keep, or
+          `None` for no limit.
+        :return: The filenames which were removed from disk.
+        '''
+        raise NotImplementedError()
+
+    def get_search(self, function, tag, count, ttl=None, negative_ttl=None):
+        '''Look up the cached results of a search.
+
+        :param function: The name of the search function.
+        :param tag: The tag searched for.
+        :param count: The number of results requested.
+        :param ttl: The maximum age in seconds of a result with URLs,
+          or `None` for no limit.
+        :param negative_ttl: The maximum age in seconds of a "no
+          results" entry, or `None` for no limit.
+        :return: The list of URLs, an empty list if the search is
+          known to find nothing, or `None` on a cache miss.
+        '''
+        raise NotImplementedError()
+
+    def set_search(self, function, tag, count, urls):
+        '''Record the results of a search.
+
+        :param urls: The URLs found, or `None` or an empty list if the
+          search found nothing.
+        '''
+        raise NotImplementedError()
+
+    def get_source(self, engine, tag):
+        '''Look up where the base image of a tag was downloaded from.
+
+        :return: A tuple `(url, etag, last_modified, timestamp,
+          image_format)` of the URL, the validators the server sent
+          for it, which may be `None`, when the image was last
+          downloaded or revalidated, and the PIL format of the
+          downloaded image, e.g. "JPEG", if it was recorded. `None` if
+          the source isn't known.
+        '''
+        raise NotImplementedError()
+
+    def set_source(self, engine, tag, url, etag=None, last_modified=None,
+                   image_format=None):
+        '''Record where the base image of a tag was downloaded from, as
+        of now.
+
+        The base image itself is always a PNG, so `image_format` keeps
+        the format it was downloaded in.
+        '''
+        raise NotImplementedError()
+
+    def reconcile(self, filenames):
+        '''Compare the cache against the files on disk.
+
+        Entry filenames are compared by absolute path.
+
+        :param filenames: The absolute paths of the files on disk.
+        :return: A tuple `(orphans, dangling)`: the members of
+          `filenames` no entry refers to, and the filenames of entries
+          which aren't in `filenames`.
+        '''
+        raise NotImplementedError()
+
+    def forget(self, filenames):
+        '''Remove every entry which refers to one of `filenames`.
+
+        :return: The number of entries removed.
+        '''
+        raise NotImplementedError()
+
+    def forget_tag(self, engine, tag):
+        '''Remove every entry of a tag: its base image and its sized
+        images in every encoding.
+
+        Other tags' entries are kept even if they refer to the same
+        files, and the files themselves are left for `sweep.sweep()`,
+        since a build may still be using them.
+
+        :return: The number of entries removed.
+        '''
+        raise NotImplementedError()
+
+    def size(self):
+        '''The number of entries in the cache.'''
+        raise NotImplementedError()
+
+    def _commit(self):
+        raise NotImplementedError()
+
+    def _rollback(self):
+        raise NotImplementedError()
+
+    def _written(self, count=1):
+        self._pending += count
+        if self.commit_every and self._pending >= self.commit_every:
+            self.flush()
+
+    @synchronized
+    def flush(self):
+        '''Commit any pending writes.'''
+        if self._pending:
+            log.info('Committing {} cache writes'.format(self._pending))
+        self._commit()
+        self._pending = 0
+
+    @synchronized
+    def close(self, commit=True):
+        log.info('Closing cache')
+        if commit:
+            self.flush()
+        else:
+            self._rollback()
@@ -0,0 +1,158 @@
+'''An in-memory tier for the cache.'''
+
+import collections
+import threading
+import time
+
+from .backend import DEFAULT_ENCODING, entry_encoding
+
+class LRUCache:
+    '''A bounded in-memory tier in front of a cache backend.
+
+    Lookups are answered from memory when possible and fall through
+    to the backing cache otherwise. Writes go to both. Entries are
+    evicted least-recently-used first once there are more than
+    `max_entries` of them, and expire `ttl` seconds after they were
+    stored.
+
+    An `LRUCache` outlives the backend it wraps, so a long-running
+    process can keep one around and pass it to each `open_cache()`.
+    Any attribute it doesn't define is looked up on the backing
+    cache.
+
+    :param max_entries: The maximum number of entries held in memory.
+    :param ttl: The number of seconds an entry stays valid, or `None`
+      for no expiry.
+    '''
+
+    def __init__(self, max_entries=1000, ttl=None, backing=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backing = backing
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self.backing is None:
+            raise AttributeError(name)
+        return getattr(self.backing, name)
+
+    def _lookup(self, key):
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is not None:
+                filename, expires = item
+                if expires is None or expires > time.time():
+                    self._entries[key] = item
+                    self.hits += 1
+                    return filename
+            self.misses += 1
+            return None
+
+    def _store(self, key, filename):
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (filename, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, engine, tag, width=-1, height=-1,
+            encoding=DEFAULT_ENCODING):
+        key = (engine, tag, width, height,
+               entry_encoding(width, height, encoding))
+        filename = self._lookup(key)
+        if filename is None:
+            filename = self.backing.get(engine, tag, width, height, encoding)
+            if filename is not None:
+                self._store(key, filename)
+        return filename
+
+    def get_many(self, engine, tags, width=-1, height=-1,
+                 encoding=DEFAULT_ENCODING):
+        sized = entry_encoding(width, height, encoding)
+        base = entry_encoding(-1, -1, encoding)
+
+        results = {}
+        missing = []
+        for tag in set(tags):
+            fname = self._lookup((engine, tag, width, height, sized))
+            base_fname = self._lookup((engine, tag, -1, -1, base))
+            if fname is None or base_fname is None:
+                missing.append(tag)
+            results[tag] = (fname, base_fname)
+
+        if missing:
+            found = self.backing.get_many(engine, missing, width, height,
+                                          encoding)
+            for tag, (fname, base_fname) in found.items():
+                if fname is not None:
+                    self._store((engine, tag, width, height, sized), fname)
+                if base_fname is not None:
+                    self._store((engine, tag, -1, -1, base), base_fname)
+                results[tag] = (fname, base_fname)
+
+        return results
+
+    def set(self, engine, tag, filename, width=-1, height=-1, timestamp=None,
+            encoding=DEFAULT_ENCODING, **info):
+        self.backing.set(engine, tag, filename, width, height, timestamp,
+                         encoding=encoding, **info)
+        self._store((engine, tag, width, height,
+                     entry_encoding(width, height, encoding)), filename)
+
+    def set_many(self, engine, entries, encoding=DEFAULT_ENCODING):
+        entries = list(entries)
+        self.backing.set_many(engine, entries, encoding)
+        for entry in entries:
+            tag, filename, width, height = entry[:4]
+            self._store((engine, tag, width, height,
+                         entry_encoding(width, height, encoding)), filename)
+
+    def _invalidate(self, filenames):
+        if filenames:
+            with self._lock:
+                for key, (filename, _) in list(self._entries.items()):
+                    if filename in filenames:
+                        del self._entries[key]
+
+    def trim(self, size=None, max_bytes=None):
+        removed = set(self.backing.trim(size, max_bytes))
+        self._invalidate(removed)
+        return sorted(removed)
+
+    def forget(self, filenames):
+        filenames = set(filenames)
+        self._invalidate(filenames)
+        return self.backing.forget(filenames)
+
+    def forget_tag(self, engine, tag):
+        with self._lock:
+            for key in list(self._entries):
+                if key[:2] == (engine, tag):
+                    del self._entries[key]
+        return self.backing.forget_tag(engine, tag)
+
+    def close(self, commit=True):
+        '''Close the backing cache and detach from it.
+
+        If the backing cache is closed without committing, the
+        in-memory entries are dropped too since they may refer to
+        writes which were never persisted.
+        '''
+        try:
+            self.backing.close(commit)
+        finally:
+            self.backing = None
+            if not commit:
+                with self._lock:
+                    self._entries.clear()
+
+    def clear(self):
+        '''Drop every in-memory entry and reset the counters.'''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
@@ -0,0 +1,450 @@
+'''A cache backend built on the SQLAlchemy ORM.'''
+
+import datetime
+import json
+import logging
+import os
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Integer, String, Text, event
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+from .backend import (BUSY_TIMEOUT, CacheBackend, DEFAULT_ENCODING,
+                      MAX_BATCH, chunks, configure_connection, entry_encoding,
+                      expired, file_size, rekey_entries, synchronized,
+                      unlink_all)
+
+Base = declarative_base()
+
+class Entry(Base):
+    __tablename__ = 'entries'
+
+    engine = Column(String, primary_key=True)
+    tag = Column(String, primary_key=True)
+    width = Column(Integer, primary_key=True)
+    height = Column(Integer, primary_key=True)
+    encoding = Column(String, primary_key=True)
+    filename = Column(String)
+    timestamp = Column(DateTime)
+    size = Column(Integer, default=0)
+    pixel_width = Column(Integer)
+    pixel_height = Column(Integer)
+    format = Column(String)
+
+    def __init__(self,
+                 engine,
+                 tag,
+                 width,
+                 height,
+                 filename,
+                 timestamp=None,
+                 size=0,
+                 pixel_width=None,
+                 pixel_height=None,
+                 format=None,
+                 encoding=DEFAULT_ENCODING):
+        self.engine = engine
+        self.tag = tag
+        self.width = width
+        self.height = height
+        self.encoding = encoding
+        self.filename = filename
+        self.size = size
+        self.pixel_width = pixel_width
+        self.pixel_height = pixel_height
+        self.format = format
+        if timestamp:
+            self.timestamp = timestamp
+        else:
+            self.timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return '<Entry(engine="{}", tag="{}", width="{}", height="{}", encoding="{}", filename="{}", timestamp={}, size={})>'.format(
+            self.engine,
+            self.tag,
+            self.width,
+            self.height,
+            self.encoding,
+            self.filename,
+            self.timestamp,
+            self.size)
+
+class SearchResult(Base):
+    '''The URLs a search function found for a tag.
+
+    A `urls` of `None` is a negative entry, recording that the search
+    found nothing.
+    '''
+    __tablename__ = 'search_results'
+
+    function = Column(String, primary_key=True)
+    tag = Column(String, primary_key=True)
+    count = Column(Integer, primary_key=True)
+    urls = Column(Text)
+    timestamp = Column(DateTime)
+
+    def __repr__(self):
+        return '<SearchResult(function="{}", tag="{}", count="{}", urls={}, timestamp={})>'.format(
+            self.function,
+            self.tag,
+            self.count,
+            self.urls,
+            self.timestamp)
+
+class Source(Base):
+    '''Where the base image of a tag was downloaded from, and the
+    validators the server sent for it.
+    '''
+    __tablename__ = 'sources'
+
+    engine = Column(String, primary_key=True)
+    tag = Column(String, primary_key=True)
+    url = Column(String)
+    etag = Column(String)
+    last_modified = Column(String)
+    timestamp = Column(DateTime)
+    format = Column(String)
+
+    def __repr__(self):
+        return '<Source(engine="{}", tag="{}", url="{}", etag={}, last_modified={}, timestamp={}, format={})>'.format(
+            self.engine,
+            self.tag,
+            self.url,
+            self.etag,
+            self.last_modified,
+            self.timestamp,
+            self.format)
+
+log = logging.getLogger(__name__)
+
+def _upgrade_schema(engine, model):
+    '''Add any columns missing from a model's table created by an
+    older version of lazy_slides.
+    '''
+    table = model.__tablename__
+    existing = set(c['name'] for c in
+                   sqlalchemy.inspect(engine).get_columns(table))
+    with engine.begin() as conn:
+        for column in model.__table__.columns:
+            if column.name in existing:
+                continue
+            log.info('adding cache column: {}.{}'.format(table, column.name))
+            conn.execute(sqlalchemy.text(
+                'ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table,
+                    column.name,
+                    column.type.compile(engine.dialect))))
+
+def _rekey_entries(engine):
+    '''Rebuild an `entries` table from before encodings were part of
+    its key. See `rekey_entries()`.
+    '''
+    create = str(CreateTable(Entry.__table__).compile(engine))
+    connection = engine.raw_connection()
+    try:
+        rekey_entries(connection.dbapi_connection, create)
+    finally:
+        connection.close()
+
+def _configure_connection(dbapi_connection, connection_record):
+    configure_connection(dbapi_connection)
+
+# SQLite's implicit row id, used to address rows of the composite-key
+# entries table in set-based statements.
+_rowid = sqlalchemy.literal_column('rowid')
+
+class OrmCache(CacheBackend):
+    '''A cache backend which stores entries through the SQLAlchemy
+    ORM.
+    '''
+    def __init__(self, filename, commit_every=None):
+        CacheBackend.__init__(self, filename, commit_every)
+
+        self.engine = sqlalchemy.create_engine(
+            'sqlite:///{}?check_same_thread=False'.format(filename),
+            connect_args={'timeout': BUSY_TIMEOUT})
+        if filename != ':memory:':
+            event.listen(self.engine, 'connect', _configure_connection)
+
+        Base.metadata.create_all(self.engine)
+        _rekey_entries(self.engine)
+        _upgrade_schema(self.engine, Entry)
+        _upgrade_schema(self.engine, Source)
+
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+
+    def _get_entry(self, engine, tag, width, height, encoding):
+        return self.session.query(Entry).filter_by(
+            tag=tag,
+            engine=engine,
+            width=width,
+            height=height,
+            encoding=entry_encoding(width, height, encoding)).first()
+
+    @synchronized
+    def get(self, engine, tag, width=-1, height=-1,
+            encoding=DEFAULT_ENCODING):
+        log.info('retrieving from cache: {} {} {} {}'.format(
+            engine, tag, width, height))
+
+        entry = self._get_entry(engine, tag, width, height, encoding)
+        if not entry:
+            log.info('cache miss: {} {} {} {}'.format(
+                engine, tag, width, height))
+            return None
+
+        log.info('cache hit: {} {} {} {}'.format(
+            engine, tag, width, height))
+
+        # Don't report a cache hit unless the file exists.
+        if not os.path.exists(entry.filename):
+            log.info('cache file missing: {} {} {} {}'.format(
+                engine, tag, width, height))
+            # If the file doesn't exist, remove the cache entry.
+            self.session.delete(entry)
+            self._written()
+            return None
+
+        return entry.filename
+
+    @synchronized
+    def get_many(self, engine, tags, width=-1, height=-1,
+                 encoding=DEFAULT_ENCODING):
+        tags = sorted(set(tags))
+        log.info('retrieving {} tags from cache: {} {} {}'.format(
+            len(tags), engine, width, height))
+
+        results = {}
+        for chunk in chunks(tags, MAX_BATCH):
+            query = self.session.query(Entry).filter(
+                Entry.engine == engine,
+                Entry.tag.in_(chunk),
+                sqlalchemy.or_(
+                    sqlalchemy.and_(
+                        Entry.width == width,
+                        Entry.height == height,
+                        Entry.encoding == entry_encoding(width,
+                                                         height,
+                                                         encoding)),
+                    sqlalchemy.and_(
+                        Entry.width == -1,
+                        Entry.height == -1,
+                        Entry.encoding == entry_encoding(-1, -1, encoding))))
+            for entry in query:
+                # Don't report a cache hit unless the file exists.
+                if not os.path.exists(entry.filename):
+                    log.info('cache file missing: {} {} {} {}'.format(
+                        engine, entry.tag, entry.width, entry.height))
+                    self.session.delete(entry)
+                    self._written()
+                    continue
+
+                fname, base_fname = results.get(entry.tag, (None, None))
+                if entry.width == width and entry.height == height:
+                    fname = entry.filename
+                if entry.width == -1 and entry.height == -1:
+                    base_fname = entry.filename
+                results[entry.tag] = (fname, base_fname)
+
+        log.info('cache hits: {} of {}'.format(len(results), len(tags)))
+
+        return dict((tag, results.get(tag, (None, None))) for tag in tags)
+
+    @synchronized
+    def set(self, engine, tag, filename, width=-1, height=-1, timestamp=None,
+            pixel_width=None, pixel_height=None, image_format=None,
+            encoding=DEFAULT_ENCODING):
+        log.info('Cache set: {} {} {} {} -> {}'.format(
+            engine, tag, width, height, filename))
+
+        e = self._get_entry(engine, tag, width, height, encoding)
+        if e:
+            e.filename = filename
+            e.timestamp = timestamp or datetime.datetime.now()
+            e.size = file_size(filename)
+            e.pixel_width = pixel_width
+            e.pixel_height = pixel_height
+            e.format = image_format
+        else:
+            e = Entry(engine=engine,
+                      tag=tag,
+                      filename=filename,
+                      width=width,
+                      height=height,
+                      encoding=entry_encoding(width, height, encoding),
+                      timestamp=timestamp,
+                      size=file_size(filename),
+                      pixel_width=pixel_width,
+                      pixel_height=pixel_height,
+                      format=image_format)
+            self.session.add(e)
+
+        self._written()
+
+    @synchronized
+    def get_renditions(self, engine, tag, min_width, min_height):
+        query = self.session.query(
+            Entry.filename,
+            Entry.pixel_width,
+            Entry.pixel_height,
+            Entry.format).filter(
+                Entry.engine == engine,
+                Entry.tag == tag,
+                Entry.pixel_width >= min_width,
+                Entry.pixel_height >= min_height).order_by(
+                    Entry.pixel_width * Entry.pixel_height)
+        return [tuple(row) for row in query if os.path.exists(row[0])]
+
+    @synchronized
+    def trim(self, size=None, max_bytes=None):
+        log.info('Cache trim: {} entries, {} bytes'.format(size, max_bytes))
+
+        newest = (Entry.timestamp.desc(), _rowid.desc())
+        victims = []
+        if size is not None:
+            victims.append(
+                self.session.query(_rowid).select_from(Entry).order_by(
+                    *newest).offset(size))
+        if max_bytes is not None:
+            running = self.session.query(
+                _rowid.label('id'),
+                sqlalchemy.func.sum(Entry.size).over(
+                    order_by=newest).label('total')).select_from(
+                        Entry).subquery()
+            victims.append(
+                self.session.query(running.c.id).filter(
+                    running.c.total > max_bytes))
+        if not victims:
+            return []
+
+        if len(victims) == 1:
+            victims = victims[0]
+        else:
+            victims = victims[0].union(victims[1])
+        victims = victims.subquery()
+        selected = _rowid.in_(sqlalchemy.select(victims))
+
+        filenames = set(f for (f,) in
+                        self.session.query(Entry.filename).filter(selected))
+        if not filenames:
+            return []
+
+        count = self.session.query(Entry).filter(selected).delete(
+            synchronize_session='fetch')
+        log.info('Cache trim: evicted {} entries'.format(count))
+
+        # Files can be shared between entries, so keep any which are
+        # still referenced.
+        for chunk in chunks(sorted(filenames), MAX_BATCH):
+            filenames.difference_update(
+                f for (f,) in self.session.query(Entry.filename).filter(
+                    Entry.filename.in_(chunk)))
+
+        unlink_all(filenames)
+        return sorted(filenames)
+
+    @synchronized
+    def get_search(self, function, tag, count, ttl=None, negative_ttl=None):
+        result = self.session.query(SearchResult).filter_by(
+            function=function, tag=tag, count=count).first()
+        if result is None:
+            log.info('search cache miss: {} {} {}'.format(function, tag, count))
+            return None
+
+        urls = None if result.urls is None else json.loads(result.urls)
+        if expired(result.timestamp, ttl if urls else negative_ttl):
+            log.info('search cache expired: {} {} {}'.format(
+                function, tag, count))
+            return None
+
+        log.info('search cache hit: {} {} {}'.format(function, tag, count))
+        return urls or []
+
+    @synchronized
+    def set_search(self, function, tag, count, urls):
+        log.info('search cache set: {} {} {} -> {}'.format(
+            function, tag, count, urls))
+
+        result = self.session.query(SearchResult).filter_by(
+            function=function, tag=tag, count=count).first()
+        if result is None:
+            result = SearchResult(function=function, tag=tag, count=count)
+            self.session.add(result)
+        result.urls = json.dumps(list(urls)) if urls else None
+        result.timestamp = datetime.datetime.now()
+
+        self._written()
+
+    @synchronized
+    def get_source(self, engine, tag):
+        source = self.session.query(Source).filter_by(
+            engine=engine, tag=tag).first()
+        if source is None:
+            return None
+        return (source.url,
+                source.etag,
+                source.last_modified,
+                source.timestamp,
+                source.format)
+
+    @synchronized
+    def set_source(self, engine, tag, url, etag=None, last_modified=None,
+                   image_format=None):
+        log.info('source set: {} {} -> {}'.format(engine, tag, url))
+
+        source = self.session.query(Source).filter_by(
+            engine=engine, tag=tag).first()
+        if source is None:
+            source = Source(engine=engine, tag=tag)
+            self.session.add(source)
+        source.url = url
+        source.etag = etag
+        source.last_modified = last_modified
+        source.timestamp = datetime.datetime.now()
+        source.format = image_format
+
+        self._written()
+
+    @synchronized
+    def reconcile(self, filenames):
+        filenames = set(filenames)
+        referenced = set(
+            f for (f,) in self.session.query(Entry.filename).distinct()
+            if f is not None)
+        absolute = set(os.path.abspath(f) for f in referenced)
+
+        orphans = sorted(filenames - absolute)
+        dangling = sorted(f for f in referenced
+                          if os.path.abspath(f) not in filenames)
+        return orphans, dangling
+
+    @synchronized
+    def forget(self, filenames):
+        filenames = sorted(set(filenames))
+        count = 0
+        for chunk in chunks(filenames, MAX_BATCH):
+            count += self.session.query(Entry).filter(
+                Entry.filename.in_(chunk)).delete(
+                    synchronize_session='fetch')
+        self._written(count)
+        return count
+
+    @synchronized
+    def forget_tag(self, engine, tag):
+        count = self.session.query(Entry).filter_by(
+            engine=engine, tag=tag).delete(synchronize_session='fetch')
+        self._written(count)
+        return count
+
+    @synchronized
+    def size(self):
+        return self.session.query(Entry).count()
+
+    def _commit(self):
+        self.session.commit()
+
+    def _rollback(self):
+        self.session.rollback()
@@ -0,0 +1,431 @@
+'''A cache backend built directly on the `sqlite3` module.
+
+This uses the same tables as the ORM backend, so the two can be used
+interchangeably on one database. It avoids importing SQLAlchemy and
+the per-row ORM overhead: every statement is a constant string, so
+`sqlite3` reuses its prepared form, lookups are answered from a
+covering index, and bulk writes are single `executemany()` upserts.
+'''
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from .backend import (BUSY_TIMEOUT, CacheBackend, DEFAULT_ENCODING,
+                      MAX_BATCH, chunks, configure_connection, entry_encoding,
+                      expired, file_size, rekey_entries, synchronized,
+                      unlink_all)
+
+log = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# The columns of each table, in order. The key columns are never
+# added to an existing table, but any others are if they're missing.
+# Entries from before the encoding was part of their key are rekeyed
+# instead. See `rekey_entries()`.
+ENTRY_COLUMNS = [
+    ('engine', 'VARCHAR NOT NULL'),
+    ('tag', 'VARCHAR NOT NULL'),
+    ('width', 'INTEGER NOT NULL'),
+    ('height', 'INTEGER NOT NULL'),
+    ('encoding', 'VARCHAR NOT NULL'),
+    ('filename', 'VARCHAR'),
+    ('timestamp', 'DATETIME'),
+    ('size', 'INTEGER'),
+    ('pixel_width', 'INTEGER'),
+    ('pixel_height', 'INTEGER'),
+    ('format', 'VARCHAR'),
+]
+
+SEARCH_COLUMNS = [
+    ('function', 'VARCHAR NOT NULL'),
+    ('tag', 'VARCHAR NOT NULL'),
+    ('count', 'INTEGER NOT NULL'),
+    ('urls', 'TEXT'),
+    ('timestamp', 'DATETIME'),
+]
+
+SOURCE_COLUMNS = [
+    ('engine', 'VARCHAR NOT NULL'),
+    ('tag', 'VARCHAR NOT NULL'),
+    ('url', 'VARCHAR'),
+    ('etag', 'VARCHAR'),
+    ('last_modified', 'VARCHAR'),
+    ('timestamp', 'DATETIME'),
+    ('format', 'VARCHAR'),
+]
+
+CREATE_ENTRIES = '''
+CREATE TABLE IF NOT EXISTS entries (
+    {}, PRIMARY KEY (engine, tag, width, height, encoding))'''.format(
+    ', '.join(' '.join(c) for c in ENTRY_COLUMNS))
+
+SCHEMA = '''
+{};
+CREATE TABLE IF NOT EXISTS search_results (
+    {}, PRIMARY KEY (function, tag, count));
+CREATE TABLE IF NOT EXISTS sources (
+    {}, PRIMARY KEY (engine, tag));
+'''.format(CREATE_ENTRIES,
+           ', '.join(' '.join(c) for c in SEARCH_COLUMNS),
+           ', '.join(' '.join(c) for c in SOURCE_COLUMNS))
+
+# Created after any missing columns have been added.
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS entries_lookup
+    ON entries (engine, tag, width, height, encoding, filename);
+CREATE INDEX IF NOT EXISTS entries_age
+    ON entries (timestamp);
+'''
+
+SELECT_ENTRY = '''
+SELECT filename FROM entries
+WHERE engine = ? AND tag = ? AND width = ? AND height = ? AND encoding = ?'''
+
+SELECT_ENTRIES = '''
+SELECT tag, width, height, encoding, filename FROM entries
+WHERE engine = ? AND tag IN ({})
+AND ((width = ? AND height = ? AND encoding = ?)
+     OR (width = -1 AND height = -1 AND encoding = ?))'''
+
+DELETE_ENTRY = '''
+DELETE FROM entries
+WHERE engine = ? AND tag = ? AND width = ? AND height = ? AND encoding = ?'''
+
+UPSERT_ENTRY = '''
+INSERT OR REPLACE INTO entries
+    (engine, tag, width, height, encoding, filename, timestamp, size,
+     pixel_width, pixel_height, format)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+SELECT_RENDITIONS = '''
+SELECT filename, pixel_width, pixel_height, format FROM entries
+WHERE engine = ? AND tag = ? AND pixel_width >= ? AND pixel_height >= ?
+ORDER BY pixel_width * pixel_height'''
+
+# The rows beyond the newest `size` entries.
+OVER_COUNT = '''
+SELECT rowid FROM entries
+ORDER BY timestamp DESC, rowid DESC LIMIT -1 OFFSET ?'''
+
+# The rows beyond the newest `max_bytes` of files.
+OVER_BYTES = '''
+SELECT id FROM (
+    SELECT rowid AS id,
+           SUM(size) OVER (ORDER BY timestamp DESC, rowid DESC) AS total
+    FROM entries)
+WHERE total > ?'''
+
+SELECT_REFERENCED = '''
+SELECT DISTINCT filename FROM entries WHERE filename IN ({})'''
+
+DISK_FILES = '''
+CREATE TEMP TABLE IF NOT EXISTS disk_files (filename VARCHAR PRIMARY KEY)'''
+
+SELECT_ORPHANS = '''
+SELECT filename FROM disk_files
+WHERE filename NOT IN (
+    SELECT abspath(filename) FROM entries WHERE filename IS NOT NULL)'''
+
+SELECT_DANGLING = '''
+SELECT DISTINCT filename FROM entries
+WHERE abspath(filename) NOT IN (SELECT filename FROM disk_files)'''
+
+DELETE_FILES = '''
+DELETE FROM entries WHERE filename IN ({})'''
+
+DELETE_TAG = '''
+DELETE FROM entries WHERE engine = ? AND tag = ?'''
+
+SELECT_SEARCH = '''
+SELECT urls, timestamp FROM search_results
+WHERE function = ? AND tag = ? AND count = ?'''
+
+UPSERT_SEARCH = '''
+INSERT OR REPLACE INTO search_results
+    (function, tag, count, urls, timestamp)
+VALUES (?, ?, ?, ?, ?)'''
+
+SELECT_SOURCE = '''
+SELECT url, etag, last_modified, timestamp, format FROM sources
+WHERE engine = ? AND tag = ?'''
+
+UPSERT_SOURCE = '''
+INSERT OR REPLACE INTO sources
+    (engine, tag, url, etag, last_modified, timestamp, format)
+VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+def _now():
+    return datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+
+def _parse_timestamp(timestamp):
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if timestamp else _now()
+
+def _placeholders(count):
+    return ', '.join('?' * count)
+
+class SqliteCache(CacheBackend):
+    '''A cache backend which talks to SQLite through `sqlite3`.'''
+
+    def __init__(self, filename, commit_every=None):
+        CacheBackend.__init__(self, filename, commit_every)
+
+        self.connection = sqlite3.connect(filename,
+                                          timeout=BUSY_TIMEOUT,
+                                          check_same_thread=False)
+        if filename != ':memory:':
+            configure_connection(self.connection)
+        self.connection.create_function('abspath', 1, os.path.abspath)
+
+        self.connection.executescript(SCHEMA)
+        rekey_entries(self.connection, CREATE_ENTRIES)
+        self._upgrade_schema('entries', ENTRY_COLUMNS)
+        self._upgrade_schema('search_results', SEARCH_COLUMNS)
+        self._upgrade_schema('sources', SOURCE_COLUMNS)
+        self.connection.executescript(INDEXES)
+
+    def _upgrade_schema(self, table, columns):
+        '''Add any columns missing from a table created by an older
+        version of lazy_slides.
+        '''
+        existing = set(row[1] for row in self.connection.execute(
+            'PRAGMA table_info({})'.format(table)))
+        for name, definition in columns:
+            if name in existing:
+                continue
+            log.info('adding cache column: {}.{}'.format(table, name))
+            self.connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                table, name, definition.replace(' NOT NULL', '')))
+        self.connection.commit()
+
+    @synchronized
+    def get(self, engine, tag, width=-1, height=-1,
+            encoding=DEFAULT_ENCODING):
+        log.info('retrieving from cache: {} {} {} {}'.format(
+            engine, tag, width, height))
+
+        key = (engine, tag, width, height,
+               entry_encoding(width, height, encoding))
+        row = self.connection.execute(SELECT_ENTRY, key).fetchone()
+        if row is None:
+            log.info('cache miss: {} {} {} {}'.format(
+                engine, tag, width, height))
+            return None
+
+        log.info('cache hit: {} {} {} {}'.format(
+            engine, tag, width, height))
+
+        # Don't report a cache hit unless the file exists.
+        if not os.path.exists(row[0]):
+            log.info('cache file missing: {} {} {} {}'.format(
+                engine, tag, width, height))
+            self.connection.execute(DELETE_ENTRY, key)
+            self._written()
+            return None
+
+        return row[0]
+
+    @synchronized
+    def get_many(self, engine, tags, width=-1, height=-1,
+                 encoding=DEFAULT_ENCODING):
+        tags = sorted(set(tags))
+        log.info('retrieving {} tags from cache: {} {} {}'.format(
+            len(tags), engine, width, height))
+
+        encodings = [entry_encoding(width, height, encoding),
+                     entry_encoding(-1, -1, encoding)]
+        results = {}
+        missing = []
+        for chunk in chunks(tags, MAX_BATCH):
+            rows = self.connection.execute(
+                SELECT_ENTRIES.format(_placeholders(len(chunk))),
+                [engine] + chunk + [width, height] + encodings)
+            for tag, w, h, e, filename in rows:
+                # Don't report a cache hit unless the file exists.
+                if not os.path.exists(filename):
+                    log.info('cache file missing: {} {} {} {}'.format(
+                        engine, tag, w, h))
+                    missing.append((engine, tag, w, h, e))
+                    continue
+
+                fname, base_fname = results.get(tag, (None, None))
+                if w == width and h == height:
+                    fname = filename
+                if w == -1 and h == -1:
+                    base_fname = filename
+                results[tag] = (fname, base_fname)
+
+        if missing:
+            self.connection.executemany(DELETE_ENTRY, missing)
+            self._written(len(missing))
+
+        log.info('cache hits: {} of {}'.format(len(results), len(tags)))
+
+        return dict((tag, results.get(tag, (None, None))) for tag in tags)
+
+    @synchronized
+    def set(self, engine, tag, filename, width=-1, height=-1, timestamp=None,
+            pixel_width=None, pixel_height=None, image_format=None,
+            encoding=DEFAULT_ENCODING):
+        log.info('Cache set: {} {} {} {} -> {}'.format(
+            engine, tag, width, height, filename))
+
+        self.connection.execute(
+            UPSERT_ENTRY,
+            (engine, tag, width, height,
+             entry_encoding(width, height, encoding), filename,
+             _format_timestamp(timestamp), file_size(filename),
+             pixel_width, pixel_height, image_format))
+        self._written()
+
+    @synchronized
+    def set_many(self, engine, entries, encoding=DEFAULT_ENCODING):
+        now = _now()
+        rows = []
+        for entry in entries:
+            tag, filename, width, height = entry[:4]
+            info = (tuple(entry[4:]) + (None, None, None))[:3]
+            rows.append((engine, tag, width, height,
+                         entry_encoding(width, height, encoding), filename,
+                         now, file_size(filename)) + info)
+        log.info('Cache set: {} entries for {}'.format(len(rows), engine))
+
+        self.connection.executemany(UPSERT_ENTRY, rows)
+        self._written(len(rows))
+
+    @synchronized
+    def get_renditions(self, engine, tag, min_width, min_height):
+        rows = self.connection.execute(
+            SELECT_RENDITIONS, (engine, tag, min_width, min_height))
+        return [tuple(row) for row in rows if os.path.exists(row[0])]
+
+    @synchronized
+    def trim(self, size=None, max_bytes=None):
+        log.info('Cache trim: {} entries, {} bytes'.format(size, max_bytes))
+
+        queries = []
+        params = []
+        if size is not None:
+            queries.append(OVER_COUNT)
+            params.append(size)
+        if max_bytes is not None:
+            queries.append(OVER_BYTES)
+            params.append(max_bytes)
+        if not queries:
+            return []
+
+        victims = 'rowid IN ({})'.format(' UNION '.join(queries))
+
+        filenames = set(f for (f,) in self.connection.execute(
+            'SELECT DISTINCT filename FROM entries WHERE ' + victims, params))
+        if not filenames:
+            return []
+
+        count = self.connection.execute(
+            'DELETE FROM entries WHERE ' + victims, params).rowcount
+        log.info('Cache trim: evicted {} entries'.format(count))
+
+        # Files can be shared between entries, so keep any which are
+        # still referenced.
+        for chunk in chunks(sorted(filenames), MAX_BATCH):
+            filenames.difference_update(
+                f for (f,) in self.connection.execute(
+                    SELECT_REFERENCED.format(_placeholders(len(chunk))),
+                    chunk))
+
+        unlink_all(filenames)
+        return sorted(filenames)
+
+    @synchronized
+    def get_search(self, function, tag, count, ttl=None, negative_ttl=None):
+        row = self.connection.execute(
+            SELECT_SEARCH, (function, tag, count)).fetchone()
+        if row is None:
+            log.info('search cache miss: {} {} {}'.format(function, tag, count))
+            return None
+
+        urls = None if row[0] is None else json.loads(row[0])
+        if expired(_parse_timestamp(row[1]), ttl if urls else negative_ttl):
+            log.info('search cache expired: {} {} {}'.format(
+                function, tag, count))
+            return None
+
+        log.info('search cache hit: {} {} {}'.format(function, tag, count))
+        return urls or []
+
+    @synchronized
+    def set_search(self, function, tag, count, urls):
+        log.info('search cache set: {} {} {} -> {}'.format(
+            function, tag, count, urls))
+
+        self.connection.execute(
+            UPSERT_SEARCH,
+            (function, tag, count,
+             json.dumps(list(urls)) if urls else None,
+             _now()))
+        self._written()
+
+    @synchronized
+    def get_source(self, engine, tag):
+        row = self.connection.execute(SELECT_SOURCE, (engine, tag)).fetchone()
+        if row is None:
+            return None
+        return tuple(row[:3]) + (_parse_timestamp(row[3]), row[4])
+
+    @synchronized
+    def set_source(self, engine, tag, url, etag=None, last_modified=None,
+                   image_format=None):
+        log.info('source set: {} {} -> {}'.format(engine, tag, url))
+
+        self.connection.execute(
+            UPSERT_SOURCE,
+            (engine, tag, url, etag, last_modified, _now(), image_format))
+        self._written()
+
+    @synchronized
+    def reconcile(self, filenames):
+        self.connection.execute(DISK_FILES)
+        self.connection.execute('DELETE FROM disk_files')
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO disk_files VALUES (?)',
+            ((f,) for f in filenames))
+
+        orphans = [f for (f,) in self.connection.execute(SELECT_ORPHANS)]
+        dangling = [f for (f,) in self.connection.execute(SELECT_DANGLING)]
+
+        self.connection.execute('DELETE FROM disk_files')
+        return orphans, dangling
+
+    @synchronized
+    def forget(self, filenames):
+        filenames = sorted(set(filenames))
+        count = 0
+        for chunk in chunks(filenames, MAX_BATCH):
+            count += self.connection.execute(
+                DELETE_FILES.format(_placeholders(len(chunk))),
+                chunk).rowcount
+        self._written(count)
+        return count
+
+    @synchronized
+    def forget_tag(self, engine, tag):
+        count = self.connection.execute(DELETE_TAG, (engine, tag)).rowcount
+        self._written(count)
+        return count
+
+    @synchronized
+    def size(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _commit(self):
+        self.connection.commit()
+
+    def _rollback(self):
+        self.connection.rollback()
@@ -1,21 +1,226 @@
-import contextlib
+import collections
+import email.utils
+import errno
 import logging
 import os
+import shutil
+import tempfile
 import urllib2
 import urlparse
 import uuid
 
+from . import transport
+from .scheduler import Cancelled
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 log = logging.getLogger(__name__)
 
-def download(url, directory):
-    '''Download a file specified by a URL to a local file.
+# The number of bytes read from the connection at a time.
+CHUNK_SIZE = 64 * 1024
+
+# The Linux ioctl which makes a file share another's blocks,
+# copy-on-write, on filesystems which support it (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+# The result of `fetch()`: the URL, the downloaded file, or `None` if
+# the server said it hadn't changed, and the validators the server
+# sent for it, if any.
+Download = collections.namedtuple(
+    'Download', ['url', 'filename', 'etag', 'last_modified'])
+
+def _check_size(url, size, max_bytes):
+    if max_bytes is not None and size > max_bytes:
+        raise IOError(
+            '{} is larger than the {} byte limit'.format(url, max_bytes))
+
+def _open(url, headers=None):
+    '''Open a URL for streaming.
+
+    HTTP(S) goes through the shared keep-alive transport. Anything
+    else, e.g. file:// URLs, is left to urllib2, which ignores
+    `headers`.
+
+    :return: A tuple (chunks, info, close) of an iterator over the
+      data, or `None` if the server said it's not modified, the
+      response headers, and a function which releases the connection.
+    '''
+    if transport.is_http(url):
+        response = transport.send('GET', url, stream=True, headers=headers)
+        chunks = response.iter_content(CHUNK_SIZE)
+        if response.status_code == 304:
+            chunks = None
+        return chunks, response.headers, response.close
+
+    infile = urllib2.urlopen(url)
+    return (iter(lambda: infile.read(CHUNK_SIZE), b''),
+            infile.info(),
+            infile.close)
+
+def _check_cancelled(url, cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled('Download of {} was cancelled'.format(url))
+
+def _save(url, filename, max_bytes, headers=None, cancel=None):
+    '''Stream a URL to a file via a temporary file beside it.
+
+    :param cancel: A `threading.Event` which stops the download once
+      it's set. It's checked between chunks.
+    :return: A tuple (saved, info) of whether the file was saved,
+      which it isn't if the server said it's not modified, and the
+      response headers.
+    :raise scheduler.Cancelled: `cancel` was set. Nothing is left
+      behind, and the connection is closed.
+    '''
+    _check_cancelled(url, cancel)
+    try:
+        return _stream(url, filename, max_bytes, headers, cancel)
+    except Exception:
+        # Failing after being cancelled, e.g. by timing out, is just
+        # being cancelled, so that the download isn't retried.
+        _check_cancelled(url, cancel)
+        raise
+
+def _stream(url, filename, max_bytes, headers, cancel):
+    directory = os.path.dirname(filename)
+    chunks, info, close = _open(url, headers)
+    try:
+        if chunks is None:
+            return False, info
+
+        # Give up before reading anything if the server tells us the
+        # file is too big.
+        length = info.get('Content-Length')
+        if length and length.isdigit():
+            _check_size(url, int(length), max_bytes)
+
+        fd, temp_filename = tempfile.mkstemp(suffix='.part', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                size = 0
+                for chunk in chunks:
+                    _check_cancelled(url, cancel)
+                    size += len(chunk)
+                    _check_size(url, size, max_bytes)
+                    outfile.write(chunk)
+
+            os.rename(temp_filename, filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+    finally:
+        close()
+
+    return True, info
+
+def _local_path(url):
+    '''The local file a URL refers to, if it's a file:// URL or a
+    plain path.
+    '''
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'file':
+        return urllib2.url2pathname(parsed.path)
+    if '://' not in url and os.path.isfile(url):
+        return url
+    return None
+
+def _local_validator(path):
+    '''An HTTP-style Last-Modified date for a local file.'''
+    return email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+
+def _reflink(path, filename):
+    '''Make `filename` a copy-on-write clone of `path`.'''
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'reflinks are not supported')
+
+    fd, temp_filename = tempfile.mkstemp(suffix='.part',
+                                         dir=os.path.dirname(filename))
+    try:
+        try:
+            with open(path, 'rb') as infile:
+                fcntl.ioctl(fd, FICLONE, infile.fileno())
+        finally:
+            os.close(fd)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        os.remove(temp_filename)
+        raise
+
+def _copy(path, filename):
+    '''Copy `path` to `filename` via a temporary file beside it.'''
+    fd, temp_filename = tempfile.mkstemp(suffix='.part',
+                                         dir=os.path.dirname(filename))
+    os.close(fd)
+    try:
+        shutil.copyfile(path, temp_filename)
+        os.rename(temp_filename, filename)
+    except Exception:
+        os.remove(temp_filename)
+        raise
+
+def _save_local(path, filename, max_bytes):
+    '''Put a local file at `filename` doing as little I/O as possible.
+
+    This tries a copy-on-write clone, which doesn't copy any data but
+    only works within one filesystem that supports it, and otherwise
+    `shutil.copyfile()`, which leaves the copying to the kernel where
+    the platform allows.
+
+    The file is never hard-linked: it goes into the content-addressed
+    store, and a source which was later edited in place would change
+    the blob under its hash.
+    '''
+    _check_size(path, os.path.getsize(path), max_bytes)
+
+    try:
+        _reflink(path, filename)
+        log.info('Cloned {} to {}'.format(path, filename))
+        return
+    except (IOError, OSError):
+        pass
+
+    _copy(path, filename)
+    log.info('Copied {} to {}'.format(path, filename))
+
+def fetch(url,
+          directory,
+          max_bytes=None,
+          etag=None,
+          last_modified=None,
+          cancel=None):
+    '''Download a URL unless it hasn't changed.
 
     This generates a unique name for the downloaded file and saves
-    into that.
+    into that. The data is streamed to a temporary file in
+    `directory` which is only renamed into place once it's complete,
+    so an interrupted download never leaves a partial file under the
+    final name. HTTP(S) downloads are subject to the transport's
+    per-host scheduling.
+
+    If `etag` or `last_modified` are given, the request is made
+    conditional on them, so a server whose copy hasn't changed can
+    answer without sending it again.
+
+    file:// URLs and plain paths take a fast path which avoids copying
+    the data where possible. See `_save_local()`. Their modification
+    time stands in for Last-Modified.
 
     :param url: The URL to download.
     :param directory: The directory into which to save the file.
+    :param max_bytes: The largest download to accept, or `None` for no
+      limit.
+    :param etag: The ETag of a copy we already have.
+    :param last_modified: The Last-Modified date of a copy we already
+      have.
+    :param cancel: A `threading.Event` which stops an HTTP(S) download
+      once it's set. See `_save()`.
+    :return: A `Download`. Its `filename` is `None` if the server
+      said our copy is still current.
+    :raise IOError: The download is larger than `max_bytes`.
+    :raise scheduler.Cancelled: `cancel` was set.
     '''
 
     parsed = urlparse.urlparse(url)
@@ -29,12 +234,46 @@ def download(url, directory):
         filename_comps[1])
     filename = os.path.join(directory, filename)
 
+    path = _local_path(url)
+    if path is not None:
+        validator = _local_validator(path)
+        if validator == last_modified:
+            log.info('Not modified: {}'.format(url))
+            return Download(url, None, None, validator)
+
+        _save_local(path, filename, max_bytes)
+        return Download(url, filename, None, validator)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
     log.info('Downloading {} to {}'.format(
             url, filename))
 
-    # Save the URL data to the new filename.
-    with contextlib.closing(urllib2.urlopen(url)) as infile:
-        with open(filename, 'wb') as outfile:
-            outfile.write(infile.read())
+    # Save the URL data to the new filename. This is scheduled as a
+    # whole so that the host's concurrency slot is held until the
+    # data has been read, and so that a dropped connection retries
+    # the download.
+    saved, info = transport.schedule(
+        url, _save, url, filename, max_bytes, headers or None, cancel)
+
+    if not saved:
+        log.info('Not modified: {}'.format(url))
+        filename = None
 
-    return filename
+    return Download(url,
+                    filename,
+                    info.get('ETag') or etag,
+                    info.get('Last-Modified') or last_modified)
+
+def download(url, directory, max_bytes=None):
+    '''Download a file specified by a URL to a local file.
+
+    See `fetch()`.
+
+    :return: The downloaded file.
+    '''
+    return fetch(url, directory, max_bytes).filename
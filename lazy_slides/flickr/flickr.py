@@ -25,11 +25,12 @@ __version__ = "$Rev$"
 __date__ = "$Date$"
 __copyright__ = "Copyright: 2004-2010 James Clarke; Portions: 2007-2008 Joshua Henderson; Portions: 2011 Andrei Vlad Vacariu"
 from urllib import urlencode
-from urllib import urlopen
 from xml.dom import minidom
 import hashlib
 import os
 
+from .. import transport
+
 HOST = 'http://flickr.com'
 API = '/services/rest'
 
@@ -1085,7 +1086,7 @@ def _doget(method, auth=False, **params):
     if debug:
         print("_doget", url)
 
-    return _get_data(minidom.parse(urlopen(url)))
+    return _get_data(minidom.parseString(transport.get(url).content))
 
 def _dopost(method, auth=False, **params):
     #uncomment to check you aren't killing the flickr server
@@ -1104,7 +1105,10 @@ def _dopost(method, auth=False, **params):
         print("_dopost url", url)
         print("_dopost payload", payload)
 
-    return _get_data(minidom.parse(urlopen(url, payload)))
+    return _get_data(minidom.parseString(
+        transport.post(url, payload,
+                       headers={'Content-Type':
+                                'application/x-www-form-urlencoded'}).content))
 
 def _prepare_params(params):
     """Convert lists to strings with ',' between items."""
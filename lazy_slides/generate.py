@@ -1,24 +1,77 @@
+import contextlib
+
+from reportlab import rl_config
 from reportlab.pdfgen import canvas
 
+@contextlib.contextmanager
+def binary_streams():
+    '''Stop reportlab wrapping the PDF's streams in ASCII85.
+
+    reportlab embeds an image file with a JPEG extension as it is, as
+    a DCTDecode stream, with no decoding or compressing. By default,
+    though, it ASCII85-encodes that stream and every other one, which
+    takes time and makes each embedded JPEG a quarter bigger. PDFs are
+    binary files anyway, so there's no need for it.
+
+    The setting is global, so this restores it on exit.
+    '''
+    use_a85 = rl_config.useA85
+    rl_config.useA85 = 0
+    try:
+        yield
+    finally:
+        rl_config.useA85 = use_a85
+
+class Slideshow:
+    '''A slideshow built a page at a time.
+
+    Each page's image is embedded as soon as the page is added, but
+    reportlab keeps the whole document, images included, in memory
+    until `save()` writes it out, so memory use still grows with the
+    number of pages.
+
+    :param outfile: The name of the file to write.
+    :param size: The (width, height) of the slides.
+    '''
+
+    def __init__(self, outfile, size):
+        self.size = size
+        with binary_streams():
+            self._canvas = canvas.Canvas(outfile)
+
+    def add_slide(self, filename):
+        '''Add a page showing the image in `filename`.'''
+        width, height = self.size
+        with binary_streams():
+            self._canvas.setPageSize((width, height))
+            self._canvas.drawImage(filename, 0, 0,
+                                   width=width,
+                                   height=height)
+            self._canvas.showPage()
+
+    def save(self):
+        with binary_streams():
+            self._canvas.save()
+
 def generate_slides(tags,
                     tag_map,
                     outfile,
-                    args):
+                    args,
+                    size=None):
     '''Generate a beamer slideshow.
 
+    JPEG images are embedded without being decoded or compressed
+    again; see `binary_streams()`.
+
     :param tags: The tags used to find the images in the slideshow.
     :param filenames: The filenames of the images for the slideshow.
     :param outfile: The name of the file into which the results should
       be saved.
+    :param size: The (width, height) of the slides. Defaults to the
+      image size in `args`.
     '''
-    c = canvas.Canvas(outfile)
+    slides = Slideshow(outfile,
+                       size or (args.image_width, args.image_height))
     for tag in tags:
-        c.setPageSize((args.image_width,
-                       args.image_height))
-        c.drawImage(tag_map[tag], 0, 0,
-                    width=args.image_width,
-                    height=args.image_height)
-        c.showPage()
-
-    c.save()
-
+        slides.add_slide(tag_map[tag])
+    slides.save()
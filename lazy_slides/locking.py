@@ -0,0 +1,141 @@
+'''Advisory file locks for coordinating lazy_slides processes.
+
+Several processes building against the same data directory use these
+to make sure only one of them resolves a given key at a time. While a
+key is being resolved its lock file holds an in-flight marker naming
+the process doing the work.
+'''
+
+import hashlib
+import logging
+import os
+import socket
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# How often a lock with a timeout is polled.
+POLL_INTERVAL = 0.1
+
+class FileLock:
+    '''An advisory lock on a file.
+
+    Where `fcntl` isn't available this degrades to a lock which always
+    succeeds.
+
+    :param path: The lock file.
+    :param marker: Written to the lock file while it's held
+      exclusively.
+    '''
+
+    def __init__(self, path, marker=''):
+        self.path = path
+        self.marker = marker
+        self._fd = None
+
+    def acquire(self, shared=False, blocking=True, timeout=None):
+        '''Acquire the lock.
+
+        :param shared: Take a shared rather than an exclusive lock.
+        :param blocking: Wait for the lock if it's held elsewhere.
+        :param timeout: The maximum number of seconds to wait, or
+          `None` to wait forever.
+        :return: Whether the lock was acquired.
+        '''
+        if fcntl is None:
+            return True
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+        if blocking and timeout is None:
+            fcntl.flock(self._fd, mode)
+        else:
+            deadline = time.time() + (timeout or 0)
+            while True:
+                try:
+                    fcntl.flock(self._fd, mode | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    if not blocking or time.time() >= deadline:
+                        os.close(self._fd)
+                        self._fd = None
+                        return False
+                    time.sleep(POLL_INTERVAL)
+
+        if not shared:
+            os.ftruncate(self._fd, 0)
+            os.write(self._fd, self.marker.encode('utf-8'))
+
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+
+        try:
+            os.ftruncate(self._fd, 0)
+        except OSError:
+            pass
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def holder(self):
+        '''The in-flight marker of whoever holds the lock, if anyone.'''
+        try:
+            with open(self.path) as f:
+                return f.read() or None
+        except IOError:
+            return None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class KeyLocks:
+    '''Per-key advisory locks kept in a data directory.
+
+    :param directory: The lazy_slides data directory.
+    :param timeout: The maximum number of seconds to wait for a key,
+      or `None` to wait forever.
+    '''
+
+    def __init__(self, directory, timeout=None):
+        self.directory = os.path.join(directory, 'locks')
+        self.timeout = timeout
+
+    def _lock(self, key):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+
+        key = repr(key)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        marker = '{} {} {}\n'.format(socket.gethostname(), os.getpid(), key)
+        return FileLock(os.path.join(self.directory, name + '.lock'), marker)
+
+    def acquire(self, key, shared=False, blocking=True):
+        '''Lock a key.
+
+        :return: The held `FileLock`, or `None` if it couldn't be
+          acquired within the timeout or without blocking.
+        '''
+        lock = self._lock(key)
+        if lock.acquire(shared=shared, blocking=blocking, timeout=self.timeout):
+            return lock
+
+        if blocking:
+            log.warning('Timed out waiting for {} held by {}'.format(
+                key, lock.holder()))
+        return None
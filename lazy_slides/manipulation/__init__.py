@@ -3,4 +3,8 @@ ways.
 '''
 
 from .convert import convert
+from .encode import (ENCODINGS, Encoding, encoding_key, extension,
+                     for_source, is_lossy)
+from .info import image_info, verify
+from .render import FILTERS, REDUCING_GAPS, render
 from .resize import resize
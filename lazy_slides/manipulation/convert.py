@@ -1,12 +1,9 @@
-import logging
 import os
 
-import PIL.Image
+from .render import render
 
 
-log = logging.getLogger(__name__)
-
-def convert(infilename, target_type='png'):
+def convert(infilename, target_type='png', outfilename=None):
     '''Convert an image from one type to another.
 
     This uses PIL to convert an input file into another
@@ -14,17 +11,14 @@ def convert(infilename, target_type='png'):
 
     :param infilename: The name of the file to convert.
     :param target_type: The new image type to save as.
+    :param outfilename: The name of the file to write. By default
+      this is `infilename` with its extension replaced by
+      `target_type`.
     '''
 
-    outfilename = '{}.{}'.format(
-        os.path.splitext(infilename)[0],
-        target_type)
-
-    log.info('Converting {} to {}.'.format(
-            infilename,
-            outfilename))
-
-    im = PIL.Image.open(infilename)
-    im.save(outfilename)
+    if outfilename is None:
+        outfilename = '{}.{}'.format(
+            os.path.splitext(infilename)[0],
+            target_type)
 
-    return outfilename
+    return render(infilename, base_filename=outfilename)[0]
@@ -0,0 +1,140 @@
+'''How resized images are written.
+
+Full-size base images are always kept as lossless PNG, but renditions
+only ever go into slides, so photographs can be written much smaller
+as JPEG or WebP.
+'''
+
+import collections
+
+import PIL.Image
+
+# The formats renditions can be written in. "source" keeps the format
+# of the tag's original image. See `for_source()`.
+ENCODINGS = ['png', 'jpeg', 'webp', 'source']
+
+EXTENSIONS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'webp': '.webp',
+}
+
+# The encoding "source" means for original images in each PIL format.
+# Anything else, e.g. GIF, is written as PNG, which loses nothing.
+SOURCE_ENCODINGS = {
+    'PNG': 'png',
+    'JPEG': 'jpeg',
+    'WEBP': 'webp',
+}
+
+# Formats which lose detail each time they're written, so they're
+# never resized again. See `is_lossy()`.
+LOSSY_FORMATS = frozenset(['JPEG', 'WEBP'])
+
+DEFAULT_QUALITY = 85
+DEFAULT_COMPRESS_LEVEL = 6
+
+# :param format: One of `ENCODINGS`.
+# :param quality: The JPEG or WebP quality, from 1 to 100.
+# :param progressive: Whether JPEGs are progressive.
+# :param compress_level: The PNG zlib level, from 0 (fastest) to 9
+#   (smallest).
+Encoding = collections.namedtuple(
+    'Encoding', ['format', 'quality', 'progressive', 'compress_level'])
+Encoding.__new__.__defaults__ = ('png',
+                                 DEFAULT_QUALITY,
+                                 False,
+                                 DEFAULT_COMPRESS_LEVEL)
+
+def encoding_key(encoding):
+    '''The name images written with `encoding` are cached under, e.g.
+    "jpeg-q85-progressive".
+
+    Only options which affect the format are part of the name, and
+    PNGs at the default compression level are just "png", the name
+    used before encodings could be chosen.
+    '''
+    if encoding.format == 'png':
+        if encoding.compress_level == DEFAULT_COMPRESS_LEVEL:
+            return 'png'
+        return 'png-z{}'.format(encoding.compress_level)
+    if encoding.format == 'jpeg':
+        return 'jpeg-q{}{}'.format(encoding.quality,
+                                   '-progressive' if encoding.progressive
+                                   else '')
+    if encoding.format == 'webp':
+        return 'webp-q{}'.format(encoding.quality)
+    if encoding.format == 'source':
+        # The source format is only known once the original is read,
+        # so every option it might be written with is in the name.
+        return 'source-q{}-z{}{}'.format(encoding.quality,
+                                         encoding.compress_level,
+                                         '-progressive' if encoding.progressive
+                                         else '')
+    return encoding.format
+
+def for_source(encoding, image_format):
+    '''Resolve the "source" encoding for an original image in a PIL
+    format, e.g. "JPEG". Other encodings are returned as they are.
+
+    The format is the one PIL read the original in, so it doesn't
+    depend on the URL or filename it came from.
+    '''
+    if encoding.format != 'source':
+        return encoding
+    return encoding._replace(
+        format=SOURCE_ENCODINGS.get(image_format, 'png'))
+
+def extension(encoding, image_format=None):
+    '''The file extension of images written with `encoding` from an
+    original image in the PIL format `image_format`. See
+    `for_source()`.
+    '''
+    return EXTENSIONS[for_source(encoding, image_format).format]
+
+def is_lossy(image_format):
+    '''Whether images of a PIL format, e.g. "JPEG", are lossy.'''
+    return image_format in LOSSY_FORMATS
+
+def _flatten(im, background='white'):
+    '''Drop the alpha channel of an image, compositing it over
+    `background`.
+    '''
+    if im.mode in ('RGB', 'L', 'CMYK'):
+        return im
+    if im.mode in ('RGBA', 'LA') or 'transparency' in im.info:
+        rgba = im.convert('RGBA')
+        flat = PIL.Image.new('RGB', im.size, background)
+        flat.paste(rgba, mask=rgba.split()[3])
+        return flat
+    return im.convert('RGB')
+
+def save(im, filename, encoding=None):
+    '''Write an image with an encoding.
+
+    :param im: The PIL image.
+    :param filename: The file to write.
+    :param encoding: An `Encoding`, or `None` to write the format
+      given by the extension of `filename` with PIL's defaults. A
+      "source" encoding should have been resolved with `for_source()`;
+      otherwise it goes by the format `im` was read in, if any.
+    '''
+    if encoding is not None:
+        encoding = for_source(encoding, im.format)
+
+    if encoding is None:
+        im.save(filename)
+    elif encoding.format == 'png':
+        im.save(filename, 'PNG', compress_level=encoding.compress_level)
+    elif encoding.format == 'jpeg':
+        _flatten(im).save(filename,
+                          'JPEG',
+                          quality=encoding.quality,
+                          progressive=encoding.progressive)
+    elif encoding.format == 'webp':
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if 'A' in im.mode or
+                            'transparency' in im.info else 'RGB')
+        im.save(filename, 'WEBP', quality=encoding.quality)
+    else:
+        raise ValueError('Unknown encoding: {}'.format(encoding.format))
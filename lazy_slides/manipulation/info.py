@@ -0,0 +1,29 @@
+import PIL.Image
+
+
+def image_info(filename):
+    '''Read the dimensions and format of an image file.
+
+    Only the image header is read, so this is cheap.
+
+    :param filename: The image file name.
+    :return: A tuple (width, height, format), e.g. (800, 600, 'PNG').
+    '''
+
+    with open(filename, 'rb') as f:
+        im = PIL.Image.open(f)
+        return im.size + (im.format,)
+
+
+def verify(filename):
+    '''Check that a file holds a complete, decodable image.
+
+    :param filename: The image file name.
+    :raise IOError: The file is not a valid image.
+    '''
+
+    try:
+        with open(filename, 'rb') as f:
+            PIL.Image.open(f).verify()
+    except Exception as e:
+        raise IOError('{} is not a valid image: {}'.format(filename, e))
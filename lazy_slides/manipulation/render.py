@@ -0,0 +1,147 @@
+import logging
+
+import PIL.Image
+
+from .encode import for_source, save
+
+log = logging.getLogger(__name__)
+
+# The resampling filters which can be asked for by name.
+FILTERS = ['nearest', 'box', 'bilinear', 'hamming', 'bicubic', 'lanczos']
+
+# For each quality tier, how much bigger than its target size an image
+# is shrunk to cheaply before the resampling filter does the rest:
+# JPEGs are decoded at a reduced scale (draft mode) and other images
+# are reduced by an integer factor. Bigger gaps look better and cost
+# more; 3 is indistinguishable from resampling the full image. `None`
+# always resamples the full image.
+REDUCING_GAPS = {
+    'best': None,
+    'normal': 3.0,
+    'fast': 1.0,
+}
+
+# Modes which PIL can't reduce by an integer factor.
+UNREDUCIBLE_MODES = ('1', 'P')
+
+def resample_filter(name):
+    '''The PIL resampling filter with a name from `FILTERS`, or `None`
+    for PIL's default.
+    '''
+    if name is None:
+        return None
+    return getattr(PIL.Image, name.upper())
+
+def _reduce(im, new_size, gap):
+    '''Shrink an image by the largest integer factor which leaves it
+    at least `gap` times bigger than `new_size`.
+
+    Pillow 7 added `Image.reduce()` for this. Older versions, the only
+    ones for Python 2, get the same box average from `Image.resize()`.
+    '''
+    if gap is None or im.mode in UNREDUCIBLE_MODES:
+        return im
+
+    factor = int(min(im.size[0] / (new_size[0] * gap),
+                     im.size[1] / (new_size[1] * gap)))
+    if factor < 2:
+        return im
+    if hasattr(im, 'reduce'):
+        return im.reduce(factor)
+    # Round up, as reduce() does, so that no edge pixels are dropped.
+    return im.resize(((im.size[0] + factor - 1) // factor,
+                      (im.size[1] + factor - 1) // factor),
+                     PIL.Image.BOX)
+
+def _resize(im, new_size, resample):
+    if resample is None:
+        return im.resize(new_size)
+    return im.resize(new_size, resample_filter(resample))
+
+def _source_for(images, new_size, gap):
+    '''Pick the smallest image to resize to `new_size` from.
+
+    With `gap` set, a rendition already made which is at least `gap`
+    times bigger than `new_size` will do as well as the decoded image,
+    and is cheaper to resample. Otherwise the decoded image, the first
+    of `images`, is used.
+    '''
+    if gap is None:
+        return images[0]
+
+    big_enough = [im for im in images
+                  if im.size[0] >= new_size[0] * gap and
+                  im.size[1] >= new_size[1] * gap]
+    if not big_enough:
+        return images[0]
+    return min(big_enough, key=lambda im: im.size[0] * im.size[1])
+
+def render(infilename,
+           base_filename=None,
+           renditions=(),
+           resample=None,
+           quality='normal',
+           encoding=None):
+    '''Decode an image once and write any number of copies of it.
+
+    Converting an image and then resizing the result decodes it
+    twice and writes a full-size file only to read it back. This does
+    the same work from a single decode held in memory.
+
+    When no full-size copy is wanted, the image is decoded no bigger
+    than the largest rendition needs. See `REDUCING_GAPS`.
+
+    Renditions are made from largest to smallest, and unless the
+    quality is "best", each can be made from a bigger one already made
+    rather than from the decoded image.
+
+    :param infilename: The image file to read.
+    :param base_filename: If given, a full-size copy is written to
+      this file, in the format given by its extension.
+    :param renditions: An iterable of `(outfilename, (width, height))`
+      tuples of resized copies to write.
+    :param resample: The name of the resampling filter to resize with,
+      from `FILTERS`, or `None` for PIL's default.
+    :param quality: The quality tier, a key of `REDUCING_GAPS`.
+    :param encoding: The `Encoding` renditions are written with, or
+      `None` for the format given by their extension. "source" means
+      the format `infilename` is in; see `encode.for_source()`.
+    :return: A list of the files written, the full-size copy first and
+      then the renditions in the order they were given.
+    '''
+
+    renditions = list(renditions)
+    gap = REDUCING_GAPS[quality]
+
+    im = PIL.Image.open(infilename)
+    if encoding is not None:
+        encoding = for_source(encoding, im.format)
+    if base_filename is None and renditions and gap is not None:
+        largest = (max(size[0] for _, size in renditions),
+                   max(size[1] for _, size in renditions))
+        im.draft(im.mode, (int(largest[0] * gap), int(largest[1] * gap)))
+    im.load()
+
+    written = []
+    if base_filename is not None:
+        log.info('Converting {} to {}.'.format(
+                infilename,
+                base_filename))
+        im.save(base_filename)
+        written.append(base_filename)
+
+    images = [im]
+    largest_first = sorted(renditions,
+                           key=lambda r: r[1][0] * r[1][1],
+                           reverse=True)
+    for outfilename, new_size in largest_first:
+        log.info('Resizing {} to {}. New size = {}'.format(
+                infilename,
+                outfilename,
+                new_size))
+        source = _source_for(images, new_size, gap)
+        resized = _resize(_reduce(source, new_size, gap), new_size, resample)
+        save(resized, outfilename, encoding)
+        images.append(resized)
+
+    return written + [outfilename for outfilename, _ in renditions]
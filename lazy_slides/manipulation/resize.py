@@ -1,27 +1,25 @@
-import logging
+from .render import render
 
-import PIL
-
-
-log = logging.getLogger(__name__)
 
 def resize(infilename,
            outfilename,
-           new_size):
+           new_size,
+           resample=None,
+           quality='normal',
+           encoding=None):
     '''Resize an image file.
 
     :param infilename: The input image file name.
     :param outfilename: The output image file name.
     :param new_size: A tuple (width, height) of the new image size.
+    :param resample: The name of the resampling filter to use. See
+      `render()`.
+    :param quality: The quality tier. See `render()`.
+    :param encoding: The `Encoding` to write. See `render()`.
     '''
 
-    log.info('Resizing {} to {}. New size = {}'.format(
-            infilename,
-            outfilename,
-            new_size))
-
-    im = PIL.Image.open(infilename)
-    im_resized = im.resize(new_size)
-    im_resized.save(outfilename)
-
-    return outfilename
+    return render(infilename,
+                  renditions=[(outfilename, new_size)],
+                  resample=resample,
+                  quality=quality,
+                  encoding=encoding)[0]
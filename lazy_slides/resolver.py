@@ -1,33 +1,130 @@
+import futures
 import logging
+import os
 import os.path
 
+from .cache.backend import expired
 from . import download
 from . import manipulation
 from . import search
+from .singleflight import SingleFlight
 
 log = logging.getLogger(__name__)
 
+# The number of candidate URLs requested from the search function.
+SEARCH_COUNT = 5
+
+# When cached base images are checked against their source: never,
+# before they're used, or after the build has used them.
+REVALIDATE_MODES = ['off', 'sync', 'background']
+
+def normalize_tag(tag):
+    '''The form of a tag which is compared when deciding whether two
+    tags are the same search.
+    '''
+    return ' '.join(tag.lower().split())
+
+def by_area(sizes):
+    '''Sort (width, height) sizes largest first.'''
+    return sorted(sizes, key=lambda size: (size[0] * size[1], size),
+                  reverse=True)
+
+def caches_renditions(config):
+    '''Whether slide images made with `config` are cached.
+
+    The cache isn't keyed on the resampling filter or resizing quality,
+    so only images made with the defaults are read from or recorded in
+    it. Base images don't depend on either, so they're always cached.
+    '''
+    return config.resample is None and config.quality == 'normal'
+
 class Resolver:
+    '''Makes the images of one tag at each of `config.sizes`.
+
+    :param fnames: A dict mapping each size to its cached image, or to
+      `None` if it isn't cached.
+    :param base_fname: The cached base image, or `None`.
+    '''
     def __init__(self,
                  tag,
                  config,
-                 fname,
-                 base_fname):
+                 fnames,
+                 base_fname,
+                 store,
+                 cache,
+                 locks=None,
+                 flight=None,
+                 cpu_executor=None):
         self.config = config
         self.tag = tag
-        self.fname = fname
+        self.sizes = by_area(config.sizes)
+        self.encoding_key = manipulation.encoding_key(config.encoding)
+        self.fnames = dict(fnames)
         self.base_fname = base_fname
+        self.store = store
+        self.cache = cache
+        self.locks = locks
+        self.flight = flight or SingleFlight()
+        self.cpu_executor = cpu_executor
 
         self.success = False
 
-    def _download(self, urls):
+        # State carried from fetch() to process().
+        self._held_lock = None
+        self._source_fname = None
+        self._download = None
+        self._download_format = None
+        self._made = []
+
+    def _fetch(self, url, etag=None, last_modified=None, cancel=None):
+        '''Download a candidate URL and check that it's an image.
+
+        :return: A `download.Download` of a file in the store's temp
+          directory. See `download.fetch()`.
+        '''
+        result = download.fetch(
+            url,
+            self.store.temp_directory(),
+            self.config.max_download_bytes or None,
+            etag,
+            last_modified,
+            cancel)
+        if result.filename is None:
+            return result
+
+        try:
+            manipulation.verify(result.filename)
+        except Exception:
+            os.remove(result.filename)
+            raise
+        return result
+
+    def _keep(self, result):
+        '''Move a download from `_fetch()` into the store.'''
+        return result._replace(filename=self.store.put(result.filename))
+
+    def _download_url(self, url, cancel=None):
+        '''Download a candidate URL into the store.
+
+        :return: A `download.Download`.
+        '''
+        return self._keep(self._fetch(url, cancel=cancel))
+
+    def _download_any(self, urls):
+        '''Download the first of `urls` which is a valid image.
+
+        Resolvers downloading the same URL at the same time share one
+        download.
+
+        :return: A `download.Download`.
+        '''
+        if self.config.hedge_delay > 0:
+            return self._hedged_download(urls)
+
         for url in urls:
             try:
-                filename = download.download(
-                    url,
-                    self.config.directory)
-
-                return filename
+                return self.flight.do(('download', url),
+                                      self._download_url, url)
             except Exception:
                 log.exception('Error processing url {}'.format(url))
 
@@ -35,36 +132,438 @@ class Resolver:
             'Unable to download image for tag {}'.format(
                 self.tag))
 
-    def _resolve_base(self):
-        if self.base_fname:
+    def _hedged_download(self, urls):
+        '''Download the first of `urls` to arrive as a valid image.
+
+        Candidates are started one at a time, but the next one is
+        started as soon as the current ones have been running for
+        `hedge_delay` seconds without finishing, or as soon as one
+        fails. The first valid image wins.
+
+        The losers are cancelled, unless another resolver is waiting
+        for the same download. Any which finish anyway without being
+        used are reclaimed by `sweep.sweep()`.
+        '''
+        remaining = list(urls)
+        pending = set()
+        executor = futures.ThreadPoolExecutor(len(remaining) or 1)
+
+        def start():
+            url = remaining.pop(0)
+            log.info('Starting download of {} for {}'.format(url, self.tag))
+            future = self.flight.submit(('download', url),
+                                        executor,
+                                        self._download_url,
+                                        url)
+            future.url = url
+            pending.add(future)
+
+        try:
+            while remaining or pending:
+                if not pending:
+                    start()
+
+                done, pending = futures.wait(
+                    pending,
+                    timeout=self.config.hedge_delay if remaining else None,
+                    return_when=futures.FIRST_COMPLETED)
+
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    log.error('Error processing url {}: {}'.format(
+                        future.url, future.exception()))
+
+                # Either everything running failed or it's slow, so
+                # hedge with the next candidate.
+                if remaining:
+                    start()
+        finally:
+            for future in pending:
+                self.flight.leave(('download', future.url), future)
+            executor.shutdown(wait=False)
+
+        raise IOError(
+            'Unable to download image for tag {}'.format(
+                self.tag))
+
+    def _search(self, use_cache=True):
+        '''Find candidate URLs for the tag, preferring cached results.
+
+        :param use_cache: Whether cached results will do. The results
+          of a new search are cached either way.
+        :return: A tuple (urls, cached) of the URLs and whether they
+          came from the cache.
+        :raise KeyError: No match is found for the tag.
+        '''
+        function = self.config.search_function
+        urls = None
+        if use_cache:
+            urls = self.cache.get_search(function,
+                                         self.tag,
+                                         SEARCH_COUNT,
+                                         self.config.search_ttl,
+                                         self.config.negative_ttl)
+        cached = urls is not None
+        if urls is None:
+            try:
+                urls = self.flight.do(
+                    ('search', function, normalize_tag(self.tag)),
+                    search.search,
+                    self.tag,
+                    count=SEARCH_COUNT)
+            except KeyError:
+                self.cache.set_search(function, self.tag, SEARCH_COUNT, None)
+                raise
+            self.cache.set_search(function, self.tag, SEARCH_COUNT, urls)
+
+        if not urls:
+            raise KeyError('No results for "{}"'.format(self.tag))
+
+        return urls, cached
+
+    def _download_found(self):
+        '''Search for the tag and download the first image found.
+
+        Cached search results can go stale, e.g. when an image is
+        taken down. So if none of the cached URLs can be downloaded,
+        the search is made again, replacing the cached results, before
+        giving up.
+
+        :return: A `download.Download`.
+        '''
+        urls, cached = self._search()
+        try:
+            return self._download_any(urls)
+        except IOError:
+            if not cached:
+                raise
+
+        log.info('Cached search results for {} failed; searching again'.format(
+            self.tag))
+        fresh, _ = self._search(use_cache=False)
+        if fresh == urls:
+            raise IOError(
+                'Unable to download image for tag {}'.format(
+                    self.tag))
+        return self._download_any(fresh)
+
+    def _image_work(self, func, *args, **kwargs):
+        '''Call a `manipulation` function, on the CPU executor if there
+        is one.
+
+        Only filenames and options are passed, so the executor can be
+        a process pool.
+        '''
+        if self.cpu_executor is None:
+            return func(*args, **kwargs)
+        return self.cpu_executor.submit(func, *args, **kwargs).result()
+
+    def _convert(self, filename, sizes, encoding):
+        '''Convert a downloaded image into a base image and resize it
+        to each of `sizes`, written with `encoding`.
+
+        The download is only decoded once for all of them.
+
+        :return: A tuple (base image, list of resized images).
+        '''
+        # The original download is left for sweep.sweep() to reclaim,
+        # since another resolver may be converting the same blob.
+        ext = manipulation.extension(encoding)
+        written = self._image_work(
+            manipulation.render,
+            filename,
+            base_filename=self.store.temp_path('.png'),
+            renditions=[(self.store.temp_path(ext), size) for size in sizes],
+            resample=self.config.resample,
+            quality=self.config.quality,
+            encoding=encoding)
+        return self.store.put(written[0]), [self.store.put(f)
+                                            for f in written[1:]]
+
+    def _resize(self, source, sizes, encoding):
+        '''Resize an image to each of `sizes` from one decode, written
+        with `encoding`.
+
+        :return: The list of resized images.
+        '''
+        ext = manipulation.extension(encoding)
+        written = self._image_work(
+            manipulation.render,
+            source,
+            renditions=[(self.store.temp_path(ext), size) for size in sizes],
+            resample=self.config.resample,
+            quality=self.config.quality,
+            encoding=encoding)
+        return [self.store.put(f) for f in written]
+
+    def _cached_encoding(self, source):
+        '''The encoding to write renditions made from the cached image
+        `source` with.
+
+        The cached image is a PNG base image or a rendition, so for
+        the "source" encoding this looks up the format the base image
+        was downloaded in. Tags cached before that was recorded keep
+        the format of `source`.
+        '''
+        encoding = self.config.encoding
+        if encoding.format != 'source':
+            return encoding
+
+        cached = self.cache.get_source(self.config.search_function, self.tag)
+        if cached is not None and cached[4]:
+            image_format = cached[4]
+        else:
+            image_format = manipulation.image_info(source)[2]
+        return manipulation.for_source(encoding, image_format)
+
+    def _missing(self):
+        '''The sizes which aren't resolved yet, largest first.'''
+        return [size for size in self.sizes if self.fnames.get(size) is None]
+
+    def _lock(self):
+        '''Lock the tag against other processes sharing the cache.
+
+        Once the lock is held, this picks up anything another process
+        resolved for the tag while we were waiting for it.
+
+        :return: The held lock, or `None` if locking is disabled or
+          timed out.
+        '''
+        if self.locks is None:
+            return None
+
+        lock = self.locks.acquire((self.config.search_function, self.tag))
+
+        for size in self.sizes:
+            fname, base_fname = self.cache.get_many(
+                self.config.search_function,
+                [self.tag],
+                *size,
+                encoding=self.encoding_key)[self.tag]
+            if caches_renditions(self.config):
+                self.fnames[size] = fname
+            self.base_fname = self.base_fname or base_fname
+
+        return lock
+
+    def _find_rendition(self):
+        '''Find a cached image to derive the missing sizes from.
+
+        This is the smallest cached image of the tag which is at
+        least as big as every missing size, so that large images
+        aren't decoded again when a smaller rendition will do. Lossy
+        renditions are skipped, so that their artifacts aren't
+        compressed again. Renditions aren't used when resizing with
+        other than the default filter and quality, see
+        `caches_renditions()`.
+
+        :return: The filename, or `None` if there is no such image.
+        '''
+        if not caches_renditions(self.config):
+            return None
+
+        missing = self._missing()
+        renditions = self.cache.get_renditions(
+            self.config.search_function,
+            self.tag,
+            max(width for width, _ in missing),
+            max(height for _, height in missing))
+        renditions = [r for r in renditions
+                      if not manipulation.is_lossy(r[3])]
+        if not renditions:
+            return None
+
+        filename, width, height, _ = renditions[0]
+        log.info('Resizing {} from {}x{} rendition {}'.format(
+            self.tag, width, height, filename))
+        return filename
+
+    def _unlock(self):
+        if self._held_lock is not None:
+            self._held_lock.release()
+            self._held_lock = None
+
+    def _record(self):
+        '''Record the resolved files in the cache.
+
+        This happens as soon as the tag is resolved so that an
+        interrupted build keeps its work, and so that other processes
+        waiting on the tag's lock can reuse it.
+
+        Slide images made with other than the default filter and
+        quality aren't recorded, see `caches_renditions()`.
+        '''
+        entries = []
+        if caches_renditions(self.config):
+            entries.extend((self.tag, self.fnames[size]) + size +
+                           manipulation.image_info(self.fnames[size])
+                           for size in self._made)
+        if self.base_fname is not None:
+            entries.append((self.tag, self.base_fname, -1, -1) +
+                           manipulation.image_info(self.base_fname))
+
+        self.cache.set_many(self.config.search_function,
+                            entries,
+                            encoding=self.encoding_key)
+        if self._download is not None:
+            self.cache.set_source(self.config.search_function,
+                                  self.tag,
+                                  self._download.url,
+                                  self._download.etag,
+                                  self._download.last_modified,
+                                  self._download_format)
+        if self.locks is not None:
+            self.cache.flush()
+
+    def fetch(self):
+        '''Do the I/O-bound part of resolving the tag.
+
+        This finds the image the missing sizes will be made from,
+        searching for and downloading one if need be. If this
+        succeeds, `process()` must be called afterwards to finish the
+        job and release any lock taken here.
+        '''
+        if self.config.revalidate == 'sync':
+            self.revalidate()
+
+        if not self._missing():
             return
 
-        urls = search.search(self.tag, count=5)
-        filename = self._download(urls)
-        self.base_fname = manipulation.convert(filename)
+        self._held_lock = self._lock()
+        try:
+            if not self._missing():
+                return
 
-        # TODO: Delete original downloaded file if it's different than
-        # the converted version.
+            self._source_fname = self._find_rendition()
+            if self._source_fname is None and not self.base_fname:
+                self._download = self._download_found()
+        except Exception:
+            self._unlock()
+            raise
 
-    def resolve(self):
-        if self.fname is None:
-            self._resolve_base()
-            assert self.base_fname is not None
+    def process(self):
+        '''Do the CPU-bound part of resolving the tag.
+
+        This converts anything `fetch()` downloaded and resizes the
+        result, or the image `fetch()` found, to each missing size.
 
-            (fname, ext) = os.path.splitext(self.base_fname)
+        :return: A tuple (tag, fnames) where `fnames` maps each size to
+          its image.
+        '''
+        try:
+            missing = self._missing()
+            if missing:
+                # Resolvers working from the same file share the work,
+                # and since the store is content-addressed they also
+                # share the result.
+                if self._download is not None:
+                    # The format PIL reads the download in, which is
+                    # what "source" renditions keep.
+                    self._download_format = manipulation.image_info(
+                        self._download.filename)[2]
+                    self.base_fname, fnames = self.flight.do(
+                        ('convert', self._download.filename) +
+                        tuple(missing),
+                        self._convert,
+                        self._download.filename,
+                        missing,
+                        manipulation.for_source(self.config.encoding,
+                                                self._download_format))
+                else:
+                    source = self._source_fname or self.base_fname
+                    assert source is not None
 
-            self.fname = '{}.{}.{}{}'.format(
-                fname,
-                self.config.image_width,
-                self.config.image_height,
-                ext)
+                    fnames = self.flight.do(
+                        ('resize', source) + tuple(missing),
+                        self._resize,
+                        source,
+                        missing,
+                        self._cached_encoding(source))
 
-            manipulation.resize(self.base_fname,
-                                self.fname,
-                                (self.config.image_width,
-                                 self.config.image_height))
+                self.fnames.update(zip(missing, fnames))
+                self._made = missing
+                self._record()
+        finally:
+            self._unlock()
 
-        assert self.fname is not None
+        assert not self._missing()
 
         self.success = True
-        return (self.tag, self.fname)
+        return (self.tag, dict(self.fnames))
+
+    def _stale_source(self):
+        '''The cached source of the base image, if it's due to be
+        revalidated. A `revalidate_after` of 0 means it always is.
+        '''
+        if self.base_fname is None:
+            return None
+
+        source = self.cache.get_source(self.config.search_function, self.tag)
+        if source is None:
+            return None
+        if self.config.revalidate_after and not expired(
+                source[3], self.config.revalidate_after):
+            return None
+        return source
+
+    def revalidate(self):
+        '''Check the base image against its source, if it's due.
+
+        This makes a conditional request, so a source which hasn't
+        changed only has to say so. If it has changed, the new image
+        becomes the base image, the sizes made from the old one are
+        forgotten, and the requested sizes are made again. If the
+        source can't be reached, the old image is kept.
+
+        :return: Whether the image changed.
+        '''
+        if self._stale_source() is None:
+            return False
+
+        self._held_lock = self._lock()
+        try:
+            source = self._stale_source()
+            if source is None:
+                self._unlock()
+                return False
+
+            url, etag, last_modified = source[:3]
+            log.info('Revalidating {} from {}'.format(self.tag, url))
+            try:
+                result = self._fetch(url, etag, last_modified)
+            except Exception:
+                log.exception('Unable to revalidate {} from {}'.format(
+                    self.tag, url))
+                self._unlock()
+                return False
+
+            if result.filename is None:
+                self.cache.set_source(self.config.search_function,
+                                      self.tag,
+                                      url,
+                                      result.etag,
+                                      result.last_modified,
+                                      source[4])
+                if self.locks is not None:
+                    self.cache.flush()
+                self._unlock()
+                return False
+
+            log.info('{} has changed at {}'.format(self.tag, url))
+            self.cache.forget_tag(self.config.search_function, self.tag)
+
+            self._download = self._keep(result)
+            self._source_fname = None
+            self.base_fname = None
+            self.fnames = {}
+        except Exception:
+            self._unlock()
+            raise
+
+        self.process()
+        return True
+
+    def resolve(self):
+        self.fetch()
+        return self.process()
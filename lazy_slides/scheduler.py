@@ -0,0 +1,233 @@
+'''Per-host scheduling of network requests.
+
+Every request to a host goes through that host's `HostPolicy`, which
+limits how many requests are in flight at once and how fast new ones
+start, retries transient failures with jittered exponential backoff,
+and stops sending requests to a host which keeps failing (a "circuit
+breaker") until it's had time to recover.
+'''
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.compat import urlparse
+
+log = logging.getLogger(__name__)
+
+# HTTP statuses which mean "try again later" rather than "no".
+RETRY_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+class CircuitOpenError(IOError):
+    '''Raised instead of making a request to a host which is failing.'''
+
+class Cancelled(Exception):
+    '''Raised by work which stopped because nobody wants its result
+    any more. It's never retried.
+    '''
+
+def is_transient(exc):
+    '''Whether an exception is worth retrying.'''
+    if isinstance(exc, requests.HTTPError):
+        response = exc.response
+        return response is not None and response.status_code in RETRY_STATUSES
+    return isinstance(exc, (requests.ConnectionError,
+                            requests.Timeout,
+                            requests.exceptions.ChunkedEncodingError))
+
+class TokenBucket:
+    '''A token bucket rate limiter.
+
+    :param rate: The number of tokens added per second, or `None` for
+      no limit.
+    :param burst: The most tokens the bucket holds, i.e. how many
+      requests can start back to back after a quiet period.
+    '''
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        '''Take a token, waiting for one if the bucket is empty.'''
+        if not self.rate:
+            return
+
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    '''Stops calls to something which keeps failing.
+
+    After `threshold` consecutive failures the breaker opens and
+    `allow()` refuses calls for `reset_timeout` seconds. After that a
+    single trial call is let through: if it succeeds the breaker
+    closes again, otherwise it stays open for another
+    `reset_timeout`.
+
+    :param threshold: The number of consecutive failures which open
+      the breaker, or `None` to never open it.
+    :param reset_timeout: The number of seconds the breaker stays open.
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        '''Whether a call may be made now.'''
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.time() - self._opened < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self.threshold and
+                               self._failures >= self.threshold):
+                self._opened = time.time()
+            self._trial = False
+
+class HostPolicy:
+    '''The concurrency limit, rate limit and circuit breaker of a host.'''
+
+    def __init__(self, max_concurrency, rate, burst, threshold, reset_timeout):
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(threshold, reset_timeout)
+
+class Scheduler:
+    '''Schedules calls which make requests to hosts.
+
+    :param max_concurrency: The most calls in flight to one host.
+    :param rate: The most calls started per second to one host, or
+      `None` for no limit.
+    :param burst: The number of calls which can start at once before
+      `rate` kicks in.
+    :param retries: The number of times a transient failure is
+      retried.
+    :param backoff: The delay in seconds before the first retry. Each
+      retry waits up to twice as long as the one before.
+    :param max_backoff: The longest delay between retries.
+    :param threshold: The number of consecutive failures after which
+      a host is skipped. See `CircuitBreaker`.
+    :param reset_timeout: How long a failing host is skipped.
+    '''
+
+    def __init__(self,
+                 max_concurrency=4,
+                 rate=None,
+                 burst=1,
+                 retries=3,
+                 backoff=0.5,
+                 max_backoff=30,
+                 threshold=5,
+                 reset_timeout=60):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def policy(self, host):
+        '''Get the `HostPolicy` of a host, creating it if need be.'''
+        with self._lock:
+            policy = self._hosts.get(host)
+            if policy is None:
+                policy = self._hosts[host] = HostPolicy(self.max_concurrency,
+                                                        self.rate,
+                                                        self.burst,
+                                                        self.threshold,
+                                                        self.reset_timeout)
+            return policy
+
+    def delay(self, attempt):
+        '''The jittered delay before retry number `attempt` (from 0).'''
+        ceiling = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def call(self, url, func, *args, **kwargs):
+        '''Call `func(*args, **kwargs)` as a request to `url`'s host.
+
+        The call holds one of the host's concurrency slots for its
+        whole duration, so anything it streams from the host should be
+        read before it returns.
+
+        :raise CircuitOpenError: The host has been failing and is being
+          skipped.
+        :raise Cancelled: `func` was cancelled. This says nothing about
+          the host, so it's passed straight on.
+        '''
+        host = urlparse(url).netloc.lower()
+        policy = self.policy(host)
+
+        attempt = 0
+        while True:
+            if not policy.breaker.allow():
+                raise CircuitOpenError(
+                    'Skipping {}: {} keeps failing'.format(url, host))
+
+            policy.bucket.acquire()
+            try:
+                with policy.slots:
+                    result = func(*args, **kwargs)
+            except Cancelled:
+                raise
+            except Exception as exc:
+                if not is_transient(exc):
+                    # The host is up; it just didn't like the request.
+                    policy.breaker.succeeded()
+                    raise
+
+                policy.breaker.failed()
+                if attempt >= self.retries:
+                    raise
+
+                delay = self.delay(attempt)
+                log.info('Retrying {} in {:.2f}s after {}'.format(
+                    url, delay, exc))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                policy.breaker.succeeded()
+                return result
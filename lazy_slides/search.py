@@ -33,7 +33,7 @@ def search(tag, count):
     log.info('searching for images tagged with "{}"'.format(tag))
     url = search_function(tag=tag, count=count)
 
-    if url is None:
+    if not url:
         raise KeyError('No results for "{}"'.format(tag))
 
     log.info('found photo: {}'.format(url))
@@ -0,0 +1,112 @@
+'''Coalescing of concurrent identical work.
+
+Different tags often lead to the same work: "Cat" and "cat" find the
+same images, and synonyms often share their top search result. A
+`SingleFlight` shared between resolvers makes sure that work is only
+done once while it's in flight, with everyone asking for it sharing
+the result through one future.
+'''
+
+import threading
+
+import futures
+
+class _Flight:
+    def __init__(self):
+        self.future = futures.Future()
+        self.cancel = threading.Event()
+        self.waiters = 0
+
+class SingleFlight:
+    '''Runs at most one call per key at a time.
+
+    While a call for a key is in flight, further calls for the same
+    key wait for it and share its result, or its exception, rather
+    than repeating the work. Once it's finished the key is free again,
+    so results aren't kept any longer than the call takes.
+
+    Calls made with `submit()` can be given up on with `leave()`. A
+    call is only cancelled once everyone waiting for it has left.
+    '''
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        '''Join the call in flight for `key`, creating it if there
+        isn't one.
+
+        :return: A tuple (flight, leader) where `leader` says whether
+          the caller must run the call.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            flight.waiters += 1
+            return flight, leader
+
+    def _run(self, key, flight, func, args, kwargs):
+        future = flight.future
+        future.set_running_or_notify_cancel()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                # A cancelled flight has already been replaced.
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def do(self, key, func, *args, **kwargs):
+        '''Call `func(*args, **kwargs)` in this thread unless a call for
+        `key` is already in flight, in which case wait for that.
+
+        :return: The result of the call.
+        '''
+        flight, leader = self._join(key)
+        if leader:
+            self._run(key, flight, func, args, kwargs)
+        return flight.future.result()
+
+    def submit(self, key, executor, func, *args, **kwargs):
+        '''Like `do()`, but run the call on `executor` and return its
+        future straight away.
+
+        `func` is also passed a `threading.Event` as its `cancel`
+        keyword argument. It's set once everyone waiting for the call
+        has given up on it with `leave()`, and `func` should then stop
+        as soon as it can.
+
+        The future may be shared, so callers mustn't cancel it.
+        '''
+        flight, leader = self._join(key)
+        if leader:
+            kwargs = dict(kwargs, cancel=flight.cancel)
+            executor.submit(self._run, key, flight, func, args, kwargs)
+        return flight.future
+
+    def leave(self, key, future):
+        '''Stop waiting for a call from `submit()`.
+
+        If nobody else is waiting for it, the call is cancelled, and
+        the key is free for a new call straight away. Calls which
+        have finished are left alone.
+
+        :return: Whether the call was cancelled.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.future is not future:
+                return False
+            flight.waiters -= 1
+            if flight.waiters > 0:
+                return False
+            del self._flights[key]
+            flight.cancel.set()
+            return True
@@ -5,14 +5,59 @@ import logging
 import os
 import sys
 
-from .cache import open_cache
+from .blobstore import BlobStore
+from .cache import BACKENDS, DEFAULT_BACKEND, open_cache
 from .cpu_count import cpu_count
 from . import generate
-from .resolver import Resolver
+from .locking import KeyLocks
+from . import manipulation
+from .resolver import REVALIDATE_MODES, Resolver, by_area, caches_renditions
+from .scheduler import Scheduler
+from .singleflight import SingleFlight
 from . import search
+from . import sweep
+from . import transport
 
 log = logging.getLogger(__name__)
 
+# The ways a Builder can resolve tags, mapped to the methods doing it.
+ENGINES = {
+    'threads': '_resolve_threads',
+    'pipeline': '_resolve_pipeline',
+}
+
+def parse_sizes(text):
+    '''Parse a comma-separated list of sizes like "1024x768,640x480".
+
+    :return: A list of (width, height) tuples.
+    '''
+    sizes = []
+    for item in text.split(','):
+        try:
+            width, height = [int(n) for n in item.strip().lower().split('x')]
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                'Invalid size {!r}: expected WIDTHxHEIGHT'.format(item))
+        if width < 1 or height < 1:
+            raise argparse.ArgumentTypeError(
+                'Invalid size {!r}: must be positive'.format(item))
+        if (width, height) in sizes:
+            # Both sizes would be written to the same file.
+            raise argparse.ArgumentTypeError(
+                'Size {!r} is given more than once'.format(item))
+        sizes.append((width, height))
+    return sizes
+
+def output_filename(output, size, sizes):
+    '''The file the slides of one size are written to.
+
+    With more than one size, the size goes in the name, so
+    "slides.pdf" becomes e.g. "slides-1024x768.pdf".
+    '''
+    if len(sizes) < 2:
+        return output
+    root, ext = os.path.splitext(output)
+    return '{}-{}x{}{}'.format(root, size[0], size[1], ext)
 
 def parse_args():
     '''Parse the command line arguments.
@@ -25,55 +70,315 @@ def parse_args():
         'tags', metavar='KEYWORD', type=str, nargs='+',
         help='A tag on which to search and generate a slide.')
     parser.add_argument(
-        '-V, --verbose', dest='verbose', action='store_true',
+        '-V', '--verbose', dest='verbose', action='store_true',
         help='Generate extra output.')
     parser.add_argument(
-        '-o, --output',
+        '-o', '--output',
         dest='output',
         #action='store_const',
         default='slides.pdf',
         metavar='F',
         help='The filename for the output.')
     parser.add_argument(
-        '-F, --fail-on-missing',
+        '-F', '--fail-on-missing',
         dest='fail_on_missing',
         action='store_true',
         help='Fail when a tag generates no matches.')
     parser.add_argument(
-        '-s, --search-function',
+        '-s', '--search-function',
         dest='search_function',
         default='lazy_slides.flickr.search',
         metavar='FUNCTION',
         help='The Python function used to search for images URLs.')
     parser.add_argument(
-        '-W, --image-width',
+        '-W', '--image-width',
         dest='image_width',
         type=int,
         default=200,
         metavar='INT',
         help='The width of the slide image.')
     parser.add_argument(
-        '-H, --image-height',
+        '-H', '--image-height',
         dest='image_height',
         type=int,
         default=200,
         metavar='INT',
         help='The height of the slide image.')
     parser.add_argument(
-        '-w, --workers',
+        '-z', '--sizes',
+        dest='sizes',
+        type=parse_sizes,
+        default=None,
+        metavar='WxH[,WxH...]',
+        help='Build the slides at each of these sizes, writing one output '
+             'file per size, e.g. "1024x768,640x480". Each image is only '
+             'decoded once for all sizes. Overrides --image-width and '
+             '--image-height.')
+    parser.add_argument(
+        '-f', '--resample',
+        dest='resample',
+        choices=manipulation.FILTERS,
+        default=None,
+        help='The resampling filter used to resize images. Defaults to '
+             "PIL's default. Slide images made with another filter aren't "
+             'cached.')
+    parser.add_argument(
+        '-q', '--quality',
+        dest='quality',
+        choices=sorted(manipulation.REDUCING_GAPS),
+        default='normal',
+        help='How much resizing quality to trade for speed: "best" resizes '
+             'from the full image, "normal" first decodes and shrinks large '
+             'images to a few times the slide size, and "fast" shrinks them '
+             'almost to the slide size, for quick previews. Slide images '
+             'are only cached at "normal" quality.')
+    parser.add_argument(
+        '-E', '--encoding',
+        dest='encode_format',
+        choices=manipulation.ENCODINGS,
+        default='png',
+        help='The format slide images are written in: lossless "png", '
+             'much smaller "jpeg" or "webp" for photographs, or "source" '
+             'to keep the format of the downloaded image where it is one '
+             'of those, and "png" otherwise.')
+    parser.add_argument(
+        '-Q', '--encode-quality',
+        dest='encode_quality',
+        type=int,
+        default=85,
+        metavar='INT',
+        help='The quality of JPEG and WebP slide images, from 1 to 100.')
+    parser.add_argument(
+        '-g', '--progressive',
+        dest='progressive',
+        action='store_true',
+        help='Write progressive JPEGs.')
+    parser.add_argument(
+        '-Z', '--compress-level',
+        dest='compress_level',
+        type=int,
+        choices=range(10),
+        default=6,
+        metavar='0-9',
+        help='The zlib compression level of PNG slide images: 0 is '
+             'fastest, 9 is smallest.')
+    parser.add_argument(
+        '-w', '--workers',
         dest='num_workers',
         type=int,
         default=0,
         metavar='INT',
         help='The number of worker threads or processes to use.')
     parser.add_argument(
-        '-d, --directory',
+        '-x', '--cpu-executor',
+        dest='cpu_executor',
+        choices=['threads', 'processes'],
+        default='threads',
+        help='Where images are converted and resized: on the thread '
+             'resolving the tag, or on a pool of --cpu-workers processes, '
+             'which lets image work use every core.')
+    parser.add_argument(
+        '-X', '--cpu-workers',
+        dest='cpu_workers',
+        type=int,
+        default=0,
+        metavar='INT',
+        help='The number of processes converting and resizing images with '
+             '--cpu-executor processes, and of CPU workers in the pipeline '
+             'engine. Defaults to --workers.')
+    parser.add_argument(
+        '-e', '--engine',
+        dest='engine',
+        choices=sorted(ENGINES),
+        default='threads',
+        help='How tags are resolved: "threads" resolves each tag start to '
+             'finish on one worker, "pipeline" downloads on --io-workers '
+             'threads and converts and resizes on --workers threads.')
+    parser.add_argument(
+        '-O', '--stream',
+        dest='stream',
+        action='store_true',
+        help='Add each slide to the output as soon as its tag and every '
+             'tag before it are resolved, rather than once all of them '
+             'are, so that embedding images overlaps downloading them. '
+             'This saves time, not memory: each slideshow is still held '
+             'in memory until it is written.')
+    parser.add_argument(
+        '-I', '--io-workers',
+        dest='io_workers',
+        type=int,
+        default=32,
+        metavar='INT',
+        help='The number of download threads used by the pipeline engine.')
+    parser.add_argument(
+        '-d', '--directory',
         dest='directory',
         default='.lazy_slides',
         metavar='DIRECTORY',
         help='The directory used to hold lazy-slides data.')
+    parser.add_argument(
+        '-c', '--cache-entries',
+        dest='cache_entries',
+        type=int,
+        default=100,
+        metavar='INT',
+        help='The maximum number of cache entries to keep. 0 means no limit.')
+    parser.add_argument(
+        '-b', '--cache-bytes',
+        dest='cache_bytes',
+        type=int,
+        default=0,
+        metavar='INT',
+        help='The maximum number of bytes of cached images to keep. '
+             '0 means no limit.')
+    parser.add_argument(
+        '-C', '--commit-every',
+        dest='commit_every',
+        type=int,
+        default=10,
+        metavar='INT',
+        help='Commit finished slides to the cache in batches of this size. '
+             '0 means only commit at the end of the build.')
+    parser.add_argument(
+        '-t', '--search-ttl',
+        dest='search_ttl',
+        type=int,
+        default=7 * 24 * 60 * 60,
+        metavar='SECONDS',
+        help='How long to reuse cached search results.')
+    parser.add_argument(
+        '-n', '--negative-ttl',
+        dest='negative_ttl',
+        type=int,
+        default=24 * 60 * 60,
+        metavar='SECONDS',
+        help='How long to remember that a search found nothing.')
+    parser.add_argument(
+        '-B', '--cache-backend',
+        dest='cache_backend',
+        default=DEFAULT_BACKEND,
+        metavar='BACKEND',
+        help='The cache storage to use: one of {} or the fully-qualified '
+             'name of a backend class.'.format(', '.join(sorted(BACKENDS))))
+    parser.add_argument(
+        '-M', '--max-download-bytes',
+        dest='max_download_bytes',
+        type=int,
+        default=32 * 1024 * 1024,
+        metavar='INT',
+        help='Skip candidate images larger than this. 0 means no limit.')
+    parser.add_argument(
+        '-D', '--hedge-delay',
+        dest='hedge_delay',
+        type=float,
+        default=0,
+        metavar='SECONDS',
+        help='Start downloading the next candidate image when the current '
+             'ones take longer than this. 0 tries candidates one at a time.')
+    parser.add_argument(
+        '-u', '--revalidate',
+        dest='revalidate',
+        choices=REVALIDATE_MODES,
+        default='off',
+        help='When to check cached images against their source once '
+             'they are older than --revalidate-after: "sync" before using '
+             'them, "background" after using them, to refresh them for '
+             'the next build.')
+    parser.add_argument(
+        '-U', '--revalidate-after',
+        dest='revalidate_after',
+        type=int,
+        default=7 * 24 * 60 * 60,
+        metavar='SECONDS',
+        help='How long to use a cached image before revalidating it. '
+             '0 revalidates it every time it is used.')
+    parser.add_argument(
+        '-P', '--host-concurrency',
+        dest='host_concurrency',
+        type=int,
+        default=4,
+        metavar='INT',
+        help='The most requests in flight to any one host.')
+    parser.add_argument(
+        '-R', '--host-rate',
+        dest='host_rate',
+        type=float,
+        default=0,
+        metavar='PER_SECOND',
+        help='The most requests started per second to any one host. '
+             '0 means no limit.')
+    parser.add_argument(
+        '-r', '--retries',
+        dest='retries',
+        type=int,
+        default=3,
+        metavar='INT',
+        help='How many times to retry a request which failed with a '
+             'transient error.')
+    parser.add_argument(
+        '-S', '--shared',
+        dest='shared',
+        action='store_true',
+        help='Coordinate with other lazy_slides processes using the same '
+             'data directory.')
+    parser.add_argument(
+        '-L', '--lock-timeout',
+        dest='lock_timeout',
+        type=float,
+        default=300,
+        metavar='SECONDS',
+        help='How long to wait for another process to resolve a tag in '
+             '--shared mode before resolving it anyway.')
+
+    config = parser.parse_args()
+    config.sizes = by_area(
+        set(config.sizes or [(config.image_width, config.image_height)]))
+    config.encoding = manipulation.Encoding(config.encode_format,
+                                            config.encode_quality,
+                                            config.progressive,
+                                            config.compress_level)
+    return config
+
+def parse_gc_args(argv):
+    '''Parse the command line arguments of the "gc" subcommand.
+
+    :param argv: The arguments following "gc".
+    '''
+    parser = argparse.ArgumentParser(
+        prog='lazy_slides gc',
+        description='Delete files in the data directory which the cache '
+                    'does not refer to, and cache entries whose files are '
+                    'missing.')
+    parser.add_argument(
+        '-V', '--verbose', dest='verbose', action='store_true',
+        help='Generate extra output.')
+    parser.add_argument(
+        '-d', '--directory',
+        dest='directory',
+        default='.lazy_slides',
+        metavar='DIRECTORY',
+        help='The directory used to hold lazy-slides data.')
+    parser.add_argument(
+        '-B', '--cache-backend',
+        dest='cache_backend',
+        default=DEFAULT_BACKEND,
+        metavar='BACKEND',
+        help='The cache storage to use: one of {} or the fully-qualified '
+             'name of a backend class.'.format(', '.join(sorted(BACKENDS))))
+    parser.add_argument(
+        '-a', '--min-age',
+        dest='min_age',
+        type=int,
+        default=60 * 60,
+        metavar='SECONDS',
+        help='Leave files younger than this alone.')
+    parser.add_argument(
+        '-n', '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        help='Report what would be removed without removing it.')
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def init_logging(verbose):
     '''Initialized the logging system.
@@ -120,19 +425,41 @@ class Builder:
     def __init__(self, config):
         self.config = config
         self.directory = self.config.directory
+        self.store = BlobStore(self.directory)
+        self.flight = SingleFlight()
+        self.cpu_executor = None
+        self.locks = None
+        if self.config.shared:
+            self.locks = KeyLocks(self.directory, self.config.lock_timeout)
+        transport.set_scheduler(
+            Scheduler(max_concurrency=self.config.host_concurrency,
+                      rate=self.config.host_rate or None,
+                      retries=self.config.retries))
 
     def _create_resolvers(self, cache):
+        fnames = dict((tag, {}) for tag in self.config.tags)
+        base_fnames = {}
+        for size in self.config.sizes:
+            entries = cache.get_many(
+                self.config.search_function,
+                self.config.tags,
+                *size,
+                encoding=manipulation.encoding_key(self.config.encoding))
+            for tag, (fname, base_fname) in entries.items():
+                if caches_renditions(self.config):
+                    fnames[tag][size] = fname
+                base_fnames[tag] = base_fnames.get(tag) or base_fname
+
         return [Resolver(tag=tag,
                          config=self.config,
-                         fname=cache.get(
-                             self.config.search_function,
-                             tag,
-                             self.config.image_width,
-                             self.config.image_height),
-                         base_fname=cache.get(
-                             self.config.search_function,
-                             tag))
-                for tag in set(self.config.tags)]
+                         fnames=fnames[tag],
+                         base_fname=base_fnames.get(tag),
+                         store=self.store,
+                         cache=cache,
+                         locks=self.locks,
+                         flight=self.flight,
+                         cpu_executor=self.cpu_executor)
+                for tag in fnames]
 
     def _calculate_num_workers(self):
         '''Determine how many workers we should use.
@@ -149,60 +476,264 @@ class Builder:
                 num_workers = 4
         return num_workers
 
-    def _build_tag_map(self, resolvers):
+    def _calculate_cpu_workers(self):
+        '''Determine how many workers should do image work.'''
+        if self.config.cpu_workers > 0:
+            return self.config.cpu_workers
+        return self._calculate_num_workers()
+
+    def _resolve_threads(self, resolvers):
+        '''Resolve each tag start to finish on one worker.
+
+        :return: An iterator of (tag, fnames) results, in the order
+          they finish.
+        '''
         num_workers = self._calculate_num_workers()
         log.info('Using {} workers'.format(num_workers))
+        transport.configure(pool_size=num_workers)
 
-        tag_map = {}
         with futures.ThreadPoolExecutor(num_workers) as e:
-            for result in [e.submit(r.resolve) for r in resolvers]:
+            for result in futures.as_completed(
+                    [e.submit(r.resolve) for r in resolvers]):
                 try:
                     rs = result.result()
-                    tag_map[rs[0]] = rs[1]
                 except Exception:
                     log.exception('Exception while fetching result.')
-        return tag_map
-
-    def _update_cache(self, resolvers, cache):
-        rslt = True
-        for r in resolvers:
-            if r.success:
-                cache.set(r.config.search_function,
-                          r.tag,
-                          r.fname,
-                          r.config.image_width,
-                          r.config.image_height)
-                cache.set(r.config.search_function,
-                          r.tag,
-                          r.base_fname)
-            else:
-                rslt = False
+                    continue
+                yield rs
+
+    def _resolve_pipeline(self, resolvers):
+        '''Resolve tags in an I/O stage and a CPU stage.
+
+        Searching and downloading spend most of their time waiting on
+        the network, so they run on a large pool of I/O threads. As
+        each download finishes, its conversion and resizing are handed
+        to a pool sized to the number of CPUs, so slow downloads never
+        hold up image processing and vice versa. With `--cpu-executor
+        processes` that pool's threads hand the image work itself on
+        to worker processes.
+
+        :return: An iterator of (tag, fnames) results, in the order
+          they finish.
+        '''
+        num_workers = self._calculate_cpu_workers()
+        io_workers = max(self.config.io_workers, 1)
+        log.info('Using {} I/O workers and {} CPU workers'.format(
+            io_workers, num_workers))
+        transport.configure(pool_size=io_workers)
+
+        with futures.ThreadPoolExecutor(io_workers) as io, \
+                futures.ThreadPoolExecutor(num_workers) as cpu:
+            fetches = dict((io.submit(r.fetch), r) for r in resolvers)
+            # Both stages are waited on together so that results come
+            # out while downloads are still going.
+            pending = set(fetches)
+            while pending:
+                done, pending = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in fetches:
+                        try:
+                            future.result()
+                        except Exception:
+                            log.exception('Exception while fetching result.')
+                            continue
+                        pending.add(cpu.submit(fetches[future].process))
+                        continue
+
+                    try:
+                        rs = future.result()
+                    except Exception:
+                        log.exception('Exception while processing result.')
+                        continue
+                    yield rs
+
+    def _resolve(self, resolvers):
+        '''Resolve tags with the configured engine.
+
+        :return: An iterator of (tag, fnames) results, in the order
+          they finish. Tags which fail are logged and left out.
+        '''
+        return getattr(self, ENGINES[self.config.engine])(resolvers)
+
+    def _build_tag_map(self, resolvers):
+        return dict(self._resolve(resolvers))
+
+    def _start_revalidation(self, resolvers):
+        '''Revalidate cached images in the background.
 
-        return rslt
+        :return: The executor doing the work. Shut it down to wait for
+          it to finish.
+        '''
+        executor = futures.ThreadPoolExecutor(max(self.config.io_workers, 1))
+
+        def revalidate(resolver):
+            try:
+                resolver.revalidate()
+            except Exception:
+                log.exception('Exception while revalidating {}.'.format(
+                    resolver.tag))
+
+        for resolver in resolvers:
+            executor.submit(revalidate, resolver)
+        return executor
 
     def _generate_slides(self, tag_map):
-        # Generate the slideshow.
-        log.info('Writing output to file {}'.format(self.config.output))
-        with open(self.config.output, 'w') as outfile:
-            generate.generate_slides(
-                self.config.tags,
-                tag_map,
-                outfile,
-                self.config)
+        '''Generate one slideshow per size.
+
+        :param tag_map: A dict mapping each tag to a dict mapping each
+          size to its image.
+        '''
+        for size in self.config.sizes:
+            output = output_filename(self.config.output,
+                                     size,
+                                     self.config.sizes)
+            log.info('Writing output to file {}'.format(output))
+            with open(output, 'wb') as outfile:
+                generate.generate_slides(
+                    self.config.tags,
+                    dict((tag, fnames[size])
+                         for tag, fnames in tag_map.items()),
+                    outfile,
+                    self.config,
+                    size=size)
+
+    def _stream_slides(self, resolvers):
+        '''Resolve tags while adding their slides to one slideshow per
+        size.
+
+        Results arrive in the order tags finish, so they wait in a
+        reorder buffer until every tag before them has been added,
+        keeping the slides in tag order. The buffer only holds
+        filenames, but each slideshow holds all of its pages until it's
+        saved, so this overlaps the work without bounding memory.
+
+        :return: The slideshows, ready to save, or `None` if a tag
+          couldn't be resolved.
+        '''
+        slideshows = []
+        for size in self.config.sizes:
+            output = output_filename(self.config.output,
+                                     size,
+                                     self.config.sizes)
+            log.info('Streaming output to file {}'.format(output))
+            slideshows.append(generate.Slideshow(output, size))
+
+        tags = self.config.tags
+        ready = {}
+        added = 0
+        for tag, fnames in self._resolve(resolvers):
+            ready[tag] = fnames
+            while added < len(tags) and tags[added] in ready:
+                for slides in slideshows:
+                    slides.add_slide(ready[tags[added]][slides.size])
+                added += 1
+
+        if added < len(tags):
+            return None
+        return slideshows
+
+    def trim(self, cache, size, max_bytes):
+        '''Trim the cache to a budget.
+
+        In shared mode this is skipped while other processes are
+        building, since they may be using the files it would delete.
+        '''
+        if self.locks is None:
+            cache.trim(size, max_bytes)
+            return
+
+        lock = self.locks.acquire('build', blocking=False)
+        if lock is None:
+            log.info('Other builds are running. Not trimming the cache.')
+            return
+        try:
+            cache.trim(size, max_bytes)
+        finally:
+            lock.release()
 
     def run(self, cache):
+        build_lock = None
+        if self.locks is not None:
+            build_lock = self.locks.acquire('build', shared=True)
+        if self.config.cpu_executor == 'processes':
+            cpu_workers = self._calculate_cpu_workers()
+            log.info('Using {} image processes'.format(cpu_workers))
+            self.cpu_executor = futures.ProcessPoolExecutor(cpu_workers)
+        try:
+            self._run(cache)
+        finally:
+            if self.cpu_executor is not None:
+                self.cpu_executor.shutdown()
+                self.cpu_executor = None
+            if build_lock is not None:
+                build_lock.release()
+
+    def _run(self, cache):
         resolvers = self._create_resolvers(cache)
 
-        tag_map = self._build_tag_map(resolvers)
+        if self.config.stream:
+            slideshows = self._stream_slides(resolvers)
+        else:
+            tag_map = self._build_tag_map(resolvers)
 
-        if not self._update_cache(resolvers, cache):
+        if not all(r.success for r in resolvers):
             # If there were resolver failures, don't generate slides
             log.error('Not all slides could be made. Exiting.')
             return
 
-        self._generate_slides(tag_map)
+        # Stale-while-revalidate: the slides are made from what's
+        # cached while the cache is refreshed for the next build.
+        revalidation = None
+        if self.config.revalidate == 'background':
+            revalidation = self._start_revalidation(resolvers)
+        try:
+            if self.config.stream:
+                for slides in slideshows:
+                    slides.save()
+            else:
+                self._generate_slides(tag_map)
+        finally:
+            if revalidation is not None:
+                revalidation.shutdown(wait=True)
+
+def gc_main(argv):
+    config = parse_gc_args(argv)
+    init_logging(config.verbose)
+
+    if not os.path.isdir(config.directory):
+        log.error('No data directory: {}'.format(config.directory))
+        return 1
+
+    # A running build may be using files it hasn't recorded yet.
+    lock = KeyLocks(config.directory).acquire('build', blocking=False)
+    if lock is None:
+        log.error('Builds are using {}. Not sweeping.'.format(config.directory))
+        return 1
+
+    try:
+        cache_file = os.path.join(config.directory, 'cache.db')
+        with open_cache(cache_file,
+                        None,
+                        backend=config.cache_backend) as cache:
+            report = sweep.sweep(config.directory,
+                                 cache,
+                                 min_age=config.min_age,
+                                 dry_run=config.dry_run)
+    finally:
+        lock.release()
+
+    print('{} orphaned files, {} dangling entries, {} bytes reclaimed{}'.format(
+        len(report.orphans),
+        len(report.dangling),
+        report.reclaimed,
+        ' (dry run)' if config.dry_run else ''))
+    return 0
 
 def main():
+    if sys.argv[1:2] == ['gc']:
+        return gc_main(sys.argv[2:])
+
     config = parse_args()
     init_logging(config.verbose)
     init_search_function(config.search_function)
@@ -214,9 +745,19 @@ def main():
             log.info('Creating data directory: {}'.format(config.directory))
             os.makedirs(config.directory)
 
+        # Other processes only see what's been committed, so shared
+        # builds commit every write.
+        commit_every = 1 if config.shared else config.commit_every or None
+
         cache_file = os.path.join(config.directory, 'cache.db')
-        with open_cache(cache_file, 100) as cache:
+        with open_cache(cache_file,
+                        None,
+                        commit_every=commit_every,
+                        backend=config.cache_backend) as cache:
             bld.run(cache)
+            bld.trim(cache,
+                     config.cache_entries or None,
+                     config.cache_bytes or None)
     except Exception:
         log.exception('Exception while building slides:')
 
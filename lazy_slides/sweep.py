@@ -0,0 +1,82 @@
+'''Reconciling the data directory with the cache.
+
+Files can end up in the data directory without a cache entry: the
+original downloads left behind by conversion, renditions whose entries
+were overwritten, and temp files from interrupted downloads. Entries
+can likewise outlive their files. `sweep()` finds and removes both.
+'''
+
+import collections
+import logging
+import os
+import time
+
+from .cache.backend import unlink_all
+
+log = logging.getLogger(__name__)
+
+# The results of a sweep: the files no cache entry referred to, the
+# filenames of entries whose files were missing, and the number of
+# bytes the orphaned files used.
+SweepReport = collections.namedtuple(
+    'SweepReport',
+    ['orphans', 'dangling', 'reclaimed'])
+
+# Subdirectories of the data directory which aren't cache files.
+IGNORED_DIRECTORIES = ('locks',)
+
+def _is_database(name):
+    return name.startswith('cache.db')
+
+def scan(directory):
+    '''Find every cache file in a data directory in one pass.
+
+    :return: A dict mapping the absolute path of each file to a
+      `(size, mtime)` tuple.
+    '''
+    directory = os.path.abspath(directory)
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if dirpath == directory:
+            dirnames[:] = [d for d in dirnames
+                           if d not in IGNORED_DIRECTORIES]
+            filenames = [f for f in filenames if not _is_database(f)]
+
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files[path] = (st.st_size, st.st_mtime)
+    return files
+
+def sweep(directory, cache, min_age=60 * 60, dry_run=False):
+    '''Delete orphaned files and drop dangling cache entries.
+
+    :param directory: The lazy_slides data directory.
+    :param cache: The cache for `directory`.
+    :param min_age: Files modified less than this many seconds ago are
+      left alone, since a running build may not have recorded them
+      yet.
+    :param dry_run: Report what would be removed without removing it.
+    :return: A `SweepReport`.
+    '''
+    files = scan(directory)
+    orphans, dangling = cache.reconcile(files)
+
+    cutoff = time.time() - min_age
+    orphans = sorted(f for f in orphans if files[f][1] <= cutoff)
+    # Entries outside the data directory aren't in the scan, so only
+    # drop the ones which are really gone.
+    dangling = sorted(f for f in dangling if not os.path.exists(f))
+    reclaimed = sum(files[f][0] for f in orphans)
+
+    log.info('Sweep found {} orphaned files ({} bytes) and {} dangling '
+             'entries'.format(len(orphans), reclaimed, len(dangling)))
+
+    if not dry_run:
+        unlink_all(orphans)
+        cache.forget(dangling)
+
+    return SweepReport(orphans, dangling, reclaimed)
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lazy_slides.blobstore import BlobStore, file_digest
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, data, ext='.png'):
+        filename = self.store.temp_path(ext)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+    def test_put(self):
+        filename = self._write(b'asdfasdf')
+        digest = file_digest(filename)
+
+        blob = self.store.put(filename)
+
+        self.assertEqual(blob, self.store.path(digest, '.png'))
+        self.assertEqual(os.path.basename(os.path.dirname(blob)), digest[:2])
+        self.assertTrue(self.store.contains(digest, '.png'))
+        self.assertFalse(os.path.exists(filename))
+
+    def test_put_duplicate(self):
+        first = self._write(b'asdfasdf')
+        second = self._write(b'asdfasdf')
+
+        self.assertEqual(self.store.put(first), self.store.put(second))
+        self.assertFalse(os.path.exists(second))
+
+    def test_put_distinct(self):
+        first = self.store.put(self._write(b'asdf'))
+        second = self.store.put(self._write(b'qwer'))
+
+        self.assertNotEqual(first, second)
@@ -1,12 +1,18 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 import unittest
 
-import sqlalchemy
-
-from lazy_slides.cache import open_cache
+from lazy_slides.cache import LRUCache, create_cache, open_cache
+from lazy_slides.cache.backend import expired
 
 from lazy_slides.tests.util import (remove, temp_file)
 
 class CacheTest(unittest.TestCase):
+    backend = 'sqlite'
 
     def setUp(self):
         self.db_file = ':memory:'
@@ -20,7 +26,7 @@ class CacheTest(unittest.TestCase):
         tag = 'tag'
         filename = 'test_file'
 
-        with open_cache(self.db_file, 1000) as cache:
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
             self.assertEqual(cache.get(engine, tag), None)
 
             with temp_file(filename):
@@ -33,7 +39,7 @@ class CacheTest(unittest.TestCase):
         tag = 'tag'
         filename = 'test_file'
 
-        with open_cache(self.db_file, 100) as cache:
+        with open_cache(self.db_file, 100, backend=self.backend) as cache:
 
             with temp_file(filename):
                 cache.set(engine, tag, filename)
@@ -48,7 +54,7 @@ class CacheTest(unittest.TestCase):
         filename = 'temp_file'
         filename2 = 'temp_file2'
 
-        with open_cache(self.db_file, 1000) as cache:
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
             with temp_file(filename):
                 cache.set(engine, tag, filename)
                 self.assertEqual(cache.get(engine, tag), filename)
@@ -58,7 +64,7 @@ class CacheTest(unittest.TestCase):
                 self.assertEqual(cache.get(engine, tag), filename2)
 
     def test_size(self):
-        with open_cache(self.db_file, 1000) as cache:
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
             self.assertEqual(cache.size(), 0)
 
             for i in range(100):
@@ -68,7 +74,7 @@ class CacheTest(unittest.TestCase):
     def test_trim(self):
         SIZE = 100
 
-        with open_cache(self.db_file, 1000) as cache:
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
             for i in range(SIZE):
                 cache.set('engine', str(i), str(i))
 
@@ -80,3 +86,376 @@ class CacheTest(unittest.TestCase):
 
             cache.trim(cache.size() + 1)
             self.assertEqual(cache.size(), NEW_SIZE)
+
+    def test_get_many(self):
+        engine = 'engine'
+
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base_a'), temp_file('sized_a'), temp_file('base_b'):
+                cache.set(engine, 'a', 'base_a')
+                cache.set(engine, 'a', 'sized_a', 10, 20)
+                cache.set(engine, 'b', 'base_b')
+                cache.set(engine, 'b', 'other_size', 30, 40)
+
+                self.assertEqual(
+                    cache.get_many(engine, ['a', 'b', 'c', 'a'], 10, 20),
+                    {'a': ('sized_a', 'base_a'),
+                     'b': (None, 'base_b'),
+                     'c': (None, None)})
+
+    def test_get_many_missing_file(self):
+        engine = 'engine'
+
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base_a'):
+                cache.set(engine, 'a', 'base_a')
+                cache.set(engine, 'a', 'sized_a', 10, 20)
+
+                self.assertEqual(
+                    cache.get_many(engine, ['a'], 10, 20),
+                    {'a': (None, 'base_a')})
+
+            self.assertEqual(cache.get(engine, 'a', 10, 20), None)
+
+    def test_trim_bytes(self):
+        # temp_file() writes 8 bytes per file.
+        filenames = ['trim_{}'.format(i) for i in range(5)]
+        now = datetime.datetime.now()
+
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            try:
+                for i, filename in enumerate(filenames):
+                    with open(filename, 'w') as f:
+                        f.write('asdfasdf')
+                    cache.set('engine', filename, filename,
+                              timestamp=now + datetime.timedelta(seconds=i))
+
+                removed = cache.trim(max_bytes=20)
+
+                self.assertEqual(removed, filenames[:3])
+                self.assertEqual(cache.size(), 2)
+                for filename in filenames[:3]:
+                    self.assertFalse(os.path.exists(filename))
+                for filename in filenames[3:]:
+                    self.assertTrue(os.path.exists(filename))
+            finally:
+                for filename in filenames:
+                    remove(filename)
+
+    def test_trim_keeps_shared_files(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('shared'):
+                cache.set('engine', 'old', 'shared',
+                          timestamp=datetime.datetime.now() -
+                          datetime.timedelta(days=1))
+                cache.set('engine', 'new', 'shared')
+
+                self.assertEqual(cache.trim(1), [])
+                self.assertEqual(cache.size(), 1)
+                self.assertTrue(os.path.exists('shared'))
+
+    def test_search_results(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            self.assertEqual(cache.get_search('f', 'tag', 5), None)
+
+            cache.set_search('f', 'tag', 5, ['a', 'b'])
+            self.assertEqual(cache.get_search('f', 'tag', 5), ['a', 'b'])
+            self.assertEqual(cache.get_search('f', 'tag', 3), None)
+            self.assertEqual(cache.get_search('g', 'tag', 5), None)
+
+            cache.set_search('f', 'tag', 5, ['c'])
+            self.assertEqual(cache.get_search('f', 'tag', 5), ['c'])
+
+    def test_negative_search_results(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            cache.set_search('f', 'fail', 5, None)
+            self.assertEqual(cache.get_search('f', 'fail', 5), [])
+
+    def test_search_result_ttl(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            cache.set_search('f', 'tag', 5, ['a'])
+            cache.set_search('f', 'fail', 5, None)
+
+            self.assertEqual(
+                cache.get_search('f', 'tag', 5, ttl=0, negative_ttl=60),
+                None)
+            self.assertEqual(
+                cache.get_search('f', 'fail', 5, ttl=60, negative_ttl=60),
+                [])
+            self.assertEqual(
+                cache.get_search('f', 'fail', 5, ttl=60, negative_ttl=0),
+                None)
+
+    def test_sources(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            self.assertEqual(cache.get_source('engine', 'tag'), None)
+
+            cache.set_source('engine', 'tag', 'http://a/1.jpg', '"abc"',
+                             image_format='JPEG')
+            url, etag, last_modified, timestamp, image_format = \
+                cache.get_source('engine', 'tag')
+            self.assertEqual((url, etag, last_modified, image_format),
+                             ('http://a/1.jpg', '"abc"', None, 'JPEG'))
+            self.assertFalse(expired(timestamp, 60))
+            self.assertEqual(cache.get_source('other', 'tag'), None)
+
+            cache.set_source('engine', 'tag', 'http://a/2.jpg',
+                             last_modified='Mon, 01 Jan 2018 00:00:00 GMT')
+            source = cache.get_source('engine', 'tag')
+            self.assertEqual(source[:3] + source[4:],
+                             ('http://a/2.jpg', None,
+                              'Mon, 01 Jan 2018 00:00:00 GMT', None))
+
+    def test_set_many(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base_a'), temp_file('sized_a'):
+                cache.set_many('engine', [('a', 'base_a', -1, -1),
+                                          ('a', 'sized_a', 10, 20)])
+
+                self.assertEqual(cache.size(), 2)
+                self.assertEqual(
+                    cache.get_many('engine', ['a'], 10, 20),
+                    {'a': ('sized_a', 'base_a')})
+
+    def test_encodings(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base'), temp_file('png'), temp_file('jpeg'):
+                cache.set_many('engine', [('tag', 'base', -1, -1),
+                                          ('tag', 'png', 10, 20)])
+                cache.set_many('engine', [('tag', 'jpeg', 10, 20)],
+                               encoding='jpeg-q85')
+
+                self.assertEqual(cache.get('engine', 'tag', 10, 20), 'png')
+                self.assertEqual(
+                    cache.get('engine', 'tag', 10, 20, encoding='jpeg-q85'),
+                    'jpeg')
+                self.assertEqual(
+                    cache.get_many('engine', ['tag'], 10, 20, 'webp-q85'),
+                    {'tag': (None, 'base')})
+                self.assertEqual(
+                    cache.get_many('engine', ['tag'], 10, 20, 'jpeg-q85'),
+                    {'tag': ('jpeg', 'base')})
+
+    def test_forget_tag(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base'), temp_file('png'), temp_file('jpeg'):
+                cache.set_many('engine', [('tag', 'base', -1, -1),
+                                          ('tag', 'png', 10, 20)])
+                cache.set_many('engine', [('tag', 'jpeg', 10, 20)],
+                               encoding='jpeg-q85')
+                # Other tags sharing the files keep their entries.
+                cache.set_many('engine', [('other', 'base', -1, -1),
+                                          ('other', 'png', 10, 20)])
+                cache.set('other engine', 'tag', 'base')
+
+                self.assertEqual(cache.forget_tag('engine', 'tag'), 3)
+
+                self.assertEqual(cache.size(), 3)
+                self.assertEqual(cache.get_many('engine', ['tag'], 10, 20),
+                                 {'tag': (None, None)})
+                self.assertEqual(cache.get_many('engine', ['other'], 10, 20),
+                                 {'other': ('png', 'base')})
+                self.assertEqual(cache.get('other engine', 'tag'), 'base')
+
+    def test_get_renditions(self):
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            with temp_file('base'), temp_file('large'), temp_file('small'):
+                cache.set_many('engine', [
+                    ('tag', 'base', -1, -1, 4000, 3000, 'PNG'),
+                    ('tag', 'large', 1024, 768, 1024, 768, 'PNG'),
+                    ('tag', 'small', 200, 200, 200, 200, 'PNG'),
+                    ('tag', 'missing', 800, 600, 800, 600, 'PNG'),
+                    ('tag', 'unknown', 2000, 2000),
+                ])
+
+                self.assertEqual(
+                    cache.get_renditions('engine', 'tag', 800, 600),
+                    [('large', 1024, 768, 'PNG'),
+                     ('base', 4000, 3000, 'PNG')])
+                self.assertEqual(
+                    cache.get_renditions('engine', 'tag', 100, 100)[0],
+                    ('small', 200, 200, 'PNG'))
+                self.assertEqual(
+                    cache.get_renditions('engine', 'tag', 5000, 100), [])
+                self.assertEqual(
+                    cache.get_renditions('engine', 'other', 1, 1), [])
+
+
+class OrmCacheTest(CacheTest):
+    backend = 'orm'
+
+
+class IncrementalCacheTest(unittest.TestCase):
+    backend = 'sqlite'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_batched_commits(self):
+        cache = create_cache(self.db_file, 2, self.backend)
+        try:
+            for i in range(3):
+                cache.set('engine', str(i), str(i))
+
+            # Only the first full batch is visible to other connections.
+            other = create_cache(self.db_file, backend=self.backend)
+            self.assertEqual(other.size(), 2)
+            other.close()
+        finally:
+            cache.close(commit=False)
+
+        other = create_cache(self.db_file, backend=self.backend)
+        self.assertEqual(other.size(), 2)
+        other.close()
+
+    def test_concurrent_sets(self):
+        with open_cache(self.db_file, 1000, commit_every=5,
+                        backend=self.backend) as cache:
+            def work(n):
+                for i in range(20):
+                    cache.set('engine', '{}-{}'.format(n, i), 'file')
+
+            threads = [threading.Thread(target=work, args=(n,))
+                       for n in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        cache = create_cache(self.db_file, backend=self.backend)
+        self.assertEqual(cache.size(), 80)
+        cache.close()
+
+
+    def test_rekey_old_entries(self):
+        connection = sqlite3.connect(self.db_file)
+        connection.executescript('''
+            CREATE TABLE entries (
+                engine VARCHAR NOT NULL, tag VARCHAR NOT NULL,
+                width INTEGER NOT NULL, height INTEGER NOT NULL,
+                filename VARCHAR, timestamp DATETIME, size INTEGER,
+                PRIMARY KEY (engine, tag, width, height));
+            INSERT INTO entries VALUES
+                ('engine', 'a', -1, -1, 'base_a',
+                 '2018-01-01 00:00:00.000000', 8),
+                ('engine', 'a', 10, 20, 'sized_a',
+                 '2018-01-01 00:00:00.000000', 8);
+        ''')
+        connection.close()
+
+        with temp_file('base_a'), temp_file('sized_a'):
+            with open_cache(self.db_file, 1000,
+                            backend=self.backend) as cache:
+                self.assertEqual(cache.get_many('engine', ['a'], 10, 20),
+                                 {'a': ('sized_a', 'base_a')})
+                self.assertEqual(
+                    cache.get_many('engine', ['a'], 10, 20, 'jpeg-q85'),
+                    {'a': (None, 'base_a')})
+
+    def test_upgrade_old_sources(self):
+        connection = sqlite3.connect(self.db_file)
+        connection.executescript('''
+            CREATE TABLE sources (
+                engine VARCHAR NOT NULL, tag VARCHAR NOT NULL,
+                url VARCHAR, etag VARCHAR, last_modified VARCHAR,
+                timestamp DATETIME, PRIMARY KEY (engine, tag));
+        ''')
+        connection.close()
+
+        with open_cache(self.db_file, 1000, backend=self.backend) as cache:
+            cache.set_source('engine', 'a', 'http://a/1.gif',
+                             image_format='GIF')
+            self.assertEqual(cache.get_source('engine', 'a')[4], 'GIF')
+
+
+class OrmIncrementalCacheTest(IncrementalCacheTest):
+    backend = 'orm'
+
+    def test_shared_database(self):
+        with temp_file('base_a'):
+            with open_cache(self.db_file, 1000, backend='orm') as cache:
+                cache.set('engine', 'a', 'base_a')
+                cache.set_search('f', 'a', 5, ['url'])
+
+            with open_cache(self.db_file, 1000, backend='sqlite') as cache:
+                self.assertEqual(cache.get('engine', 'a'), 'base_a')
+                self.assertEqual(cache.get_search('f', 'a', 5, 60), ['url'])
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db_file = ':memory:'
+
+    def test_repeat_lookups_skip_backing(self):
+        lru = LRUCache()
+
+        with temp_file('base_a'), temp_file('sized_a'):
+            with open_cache(self.db_file, 1000, lru=lru) as cache:
+                cache.set('engine', 'a', 'base_a')
+                cache.set('engine', 'a', 'sized_a', 10, 20)
+
+            # A fresh database knows nothing about 'a', so these can
+            # only be answered from memory.
+            with open_cache(self.db_file, 1000, lru=lru) as cache:
+                self.assertEqual(
+                    cache.get_many('engine', ['a'], 10, 20),
+                    {'a': ('sized_a', 'base_a')})
+                self.assertEqual(cache.get('engine', 'a'), 'base_a')
+
+        self.assertEqual(lru.hits, 3)
+        self.assertEqual(lru.misses, 0)
+
+    def test_eviction(self):
+        lru = LRUCache(max_entries=2)
+
+        with open_cache(self.db_file, 1000, lru=lru) as cache:
+            for tag in 'abc':
+                cache.set('engine', tag, tag)
+
+        with open_cache(self.db_file, 1000, lru=lru) as cache:
+            self.assertEqual(cache.get('engine', 'a'), None)
+            self.assertEqual(lru.misses, 1)
+
+    def test_ttl(self):
+        lru = LRUCache(ttl=-1)
+
+        with open_cache(self.db_file, 1000, lru=lru) as cache:
+            with temp_file('base_a'):
+                cache.set('engine', 'a', 'base_a')
+                self.assertEqual(cache.get('engine', 'a'), 'base_a')
+
+        self.assertEqual(lru.hits, 0)
+        self.assertEqual(lru.misses, 1)
+
+    def test_trim_invalidates(self):
+        lru = LRUCache()
+
+        with open_cache(self.db_file, 1000, lru=lru) as cache:
+            with temp_file('old'), temp_file('new'):
+                cache.set('engine', 'old', 'old',
+                          timestamp=datetime.datetime.now() -
+                          datetime.timedelta(days=1))
+                cache.set('engine', 'new', 'new')
+
+                cache.trim(1)
+                self.assertEqual(cache.get('engine', 'old'), None)
+                self.assertEqual(cache.get('engine', 'new'), 'new')
+
+    def test_forget_tag_invalidates(self):
+        lru = LRUCache()
+
+        with open_cache(self.db_file, 1000, lru=lru) as cache:
+            with temp_file('base'), temp_file('sized'):
+                cache.set_many('engine', [('tag', 'base', -1, -1),
+                                          ('tag', 'sized', 10, 20),
+                                          ('other', 'base', -1, -1)])
+
+                cache.forget_tag('engine', 'tag')
+                self.assertEqual(cache.get('engine', 'tag', 10, 20), None)
+                self.assertEqual(cache.get('engine', 'tag'), None)
+                self.assertEqual(cache.get('engine', 'other'), 'base')
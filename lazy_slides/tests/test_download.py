@@ -0,0 +1,187 @@
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lazy_slides.scheduler import Cancelled
+from lazy_slides.tests.util import (http_server, patched, python2_module,
+                                    send)
+
+download = python2_module('lazy_slides.download')
+
+DATA = b'x' * (3 * 64 * 1024 + 5)
+
+def _unsized(handler):
+    # No Content-Length, so the size is only known as it's read.
+    handler.send_response(200)
+    handler.send_header('Connection', 'close')
+    handler.end_headers()
+    handler.close_connection = True
+    handler.wfile.write(DATA)
+
+ROUTES = {
+    '/image': lambda handler: send(handler, DATA, headers=[('ETag', '"1"')]),
+    '/unsized': _unsized,
+    '/unchanged': lambda handler: send(handler, status=304),
+}
+
+@unittest.skipIf(download is None, 'needs Python 2')
+class SaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'image.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        with http_server(ROUTES) as url:
+            saved, info = download._save(url + '/image', self.filename, None)
+
+        self.assertTrue(saved)
+        self.assertEqual(info.get('ETag'), '"1"')
+        # The temporary .part file has been renamed into place.
+        self.assertEqual(os.listdir(self.directory), ['image.png'])
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+
+    def test_not_modified(self):
+        with http_server(ROUTES) as url:
+            saved, _ = download._save(url + '/unchanged', self.filename, None,
+                                      {'If-None-Match': '"1"'})
+
+        self.assertFalse(saved)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_size_cap(self):
+        with http_server(ROUTES) as url:
+            for path in ('/image', '/unsized'):
+                with self.assertRaises(IOError):
+                    download._save(url + path, self.filename, len(DATA) - 1)
+
+                # Nothing is left behind, not even a partial .part file.
+                self.assertEqual(os.listdir(self.directory), [])
+
+            saved, _ = download._save(url + '/unsized', self.filename,
+                                      len(DATA))
+            self.assertTrue(saved)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        with http_server(ROUTES) as url:
+            def save():
+                download._save(url + '/image', self.filename, None,
+                               cancel=cancel)
+
+            open_ = download._open
+            def cancel_after_first_chunk(*args):
+                chunks, info, close = open_(*args)
+                def cancelling():
+                    for chunk in chunks:
+                        yield chunk
+                        cancel.set()
+                return cancelling(), info, close
+
+            with patched(download, '_open', cancel_after_first_chunk):
+                self.assertRaises(Cancelled, save)
+            self.assertEqual(os.listdir(self.directory), [])
+
+            # Cancelled downloads don't start.
+            self.assertRaises(Cancelled, save)
+
+    def test_fetch(self):
+        with http_server(ROUTES) as url:
+            result = download.fetch(url + '/image', self.directory)
+            self.assertEqual(result.etag, '"1"')
+            self.assertEqual(os.path.dirname(result.filename), self.directory)
+            self.assertEqual(os.path.getsize(result.filename), len(DATA))
+
+            unchanged = download.fetch(url + '/unchanged', self.directory,
+                                       etag='"1"')
+            self.assertIsNone(unchanged.filename)
+            self.assertEqual(unchanged.etag, '"1"')
+
+class FakeFcntl:
+    '''Stands in for fcntl, cloning by copying the data.'''
+
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def ioctl(self, fd, request, source_fd):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        assert request == download.FICLONE
+        for chunk in iter(lambda: os.read(source_fd, 1024), b''):
+            os.write(fd, chunk)
+
+def _no_link(*args):
+    raise AssertionError('local sources must not be hard-linked')
+
+@unittest.skipIf(download is None, 'needs Python 2')
+class SaveLocalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'source.png')
+        with open(self.source, 'wb') as f:
+            f.write(DATA)
+        self.filename = os.path.join(self.directory, 'saved.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save(self, fcntl, max_bytes=None):
+        with patched(download, 'fcntl', fcntl), \
+                patched(os, 'link', _no_link):
+            download._save_local(self.source, self.filename, max_bytes)
+
+    def _check_copy(self):
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertFalse(os.path.samefile(self.source, self.filename))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['saved.png', 'source.png'])
+
+    def test_reflink(self):
+        fcntl = FakeFcntl()
+
+        def no_copy(*args):
+            raise AssertionError('cloned files are not copied')
+
+        with patched(download, '_copy', no_copy):
+            self._save(fcntl)
+
+        self.assertEqual(fcntl.calls, 1)
+        self._check_copy()
+
+    def test_copy_when_reflink_fails(self):
+        fcntl = FakeFcntl(IOError(errno.EOPNOTSUPP, 'not supported'))
+        self._save(fcntl)
+
+        self.assertEqual(fcntl.calls, 1)
+        self._check_copy()
+
+    def test_copy_without_fcntl(self):
+        self._save(None)
+        self._check_copy()
+
+    def test_size_cap(self):
+        with self.assertRaises(IOError):
+            self._save(None, max_bytes=len(DATA) - 1)
+        self.assertEqual(os.listdir(self.directory), ['source.png'])
+
+    def test_fetch(self):
+        result = download.fetch(self.source, self.directory)
+        self.assertIsNotNone(result.last_modified)
+        with open(result.filename, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+
+        unchanged = download.fetch('file://' + self.source,
+                                   self.directory,
+                                   last_modified=result.last_modified)
+        self.assertIsNone(unchanged.filename)
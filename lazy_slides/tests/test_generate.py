@@ -0,0 +1,48 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+from reportlab import rl_config
+
+from lazy_slides.generate import Slideshow, generate_slides
+
+class GenerateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_jpegs_embedded_verbatim(self):
+        image = os.path.join(self.directory, 'image.jpg')
+        PIL.Image.effect_noise((64, 48), 32).convert('RGB').save(image)
+        outfile = os.path.join(self.directory, 'slides.pdf')
+        use_a85 = rl_config.useA85
+
+        generate_slides(['tag'], {'tag': image}, outfile,
+                        argparse.Namespace(), size=(64, 48))
+
+        with open(image, 'rb') as f:
+            jpeg = f.read()
+        with open(outfile, 'rb') as f:
+            self.assertIn(jpeg, f.read())
+        self.assertEqual(rl_config.useA85, use_a85)
+
+    def test_slideshow(self):
+        image = os.path.join(self.directory, 'image.png')
+        PIL.Image.new('RGB', (64, 48), 'red').save(image)
+        outfile = os.path.join(self.directory, 'slides.pdf')
+
+        slides = Slideshow(outfile, (64, 48))
+        for _ in range(3):
+            slides.add_slide(image)
+        # Nothing is written until the slideshow is saved.
+        self.assertFalse(os.path.exists(outfile))
+
+        slides.save()
+        with open(outfile, 'rb') as f:
+            self.assertEqual(f.read().count(b'/Type /Page\n'), 3)
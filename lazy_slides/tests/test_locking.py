@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lazy_slides.locking import KeyLocks, fcntl
+
+@unittest.skipIf(fcntl is None, 'fcntl is not available')
+class KeyLocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.locks = KeyLocks(self.directory, timeout=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_exclusive(self):
+        lock = self.locks.acquire(('engine', 'tag'))
+        self.assertNotEqual(lock, None)
+        self.assertEqual(self.locks.acquire(('engine', 'tag')), None)
+        self.assertNotEqual(self.locks.acquire(('engine', 'other')), None)
+
+        lock.release()
+        self.assertNotEqual(self.locks.acquire(('engine', 'tag')), None)
+
+    def test_shared(self):
+        first = self.locks.acquire('build', shared=True)
+        second = self.locks.acquire('build', shared=True)
+        self.assertNotEqual(first, None)
+        self.assertNotEqual(second, None)
+        self.assertEqual(self.locks.acquire('build', blocking=False), None)
+
+        first.release()
+        second.release()
+        self.assertNotEqual(self.locks.acquire('build', blocking=False), None)
+
+    def test_in_flight_marker(self):
+        lock = self.locks.acquire(('engine', 'tag'))
+        self.assertIn(str(os.getpid()), lock.holder())
+        self.assertIn('tag', lock.holder())
+
+        lock.release()
+        self.assertEqual(lock.holder(), None)
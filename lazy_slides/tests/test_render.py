@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import PIL.Image
+
+from lazy_slides.manipulation import (Encoding, encoding_key, extension,
+                                      for_source, render)
+from lazy_slides.manipulation.render import _reduce
+
+class RenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = self._path('source.png')
+        PIL.Image.new('RGB', (1200, 900), 'red').save(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _sizes(self, filenames):
+        return [PIL.Image.open(f).size for f in filenames]
+
+    def test_renditions_keep_their_order(self):
+        sizes = [(40, 30), (400, 300), (100, 100)]
+        renditions = [(self._path('{}x{}.png'.format(*size)), size)
+                      for size in sizes]
+
+        for quality in ('best', 'normal', 'fast'):
+            written = render(self.source,
+                             base_filename=self._path('base.png'),
+                             renditions=renditions,
+                             quality=quality)
+
+            self.assertEqual(written,
+                             [self._path('base.png')] +
+                             [f for f, _ in renditions])
+            self.assertEqual(self._sizes(written),
+                             [(1200, 900)] + sizes)
+
+    def test_without_base(self):
+        renditions = [(self._path('small.png'), (60, 45)),
+                      (self._path('large.png'), (600, 450))]
+
+        written = render(self.source, renditions=renditions)
+
+        self.assertEqual(self._sizes(written), [(60, 45), (600, 450)])
+        self.assertEqual(PIL.Image.open(written[0]).getpixel((0, 0)),
+                         (255, 0, 0))
+
+    def test_reduce(self):
+        im = PIL.Image.new('RGB', (1201, 900), 'red')
+
+        reduced = _reduce(im, (100, 75), 3.0)
+        # The largest factor leaving it 3 times bigger than the target.
+        self.assertEqual(reduced.size, (301, 225))
+        self.assertEqual(reduced.getpixel((300, 224)), (255, 0, 0))
+
+        self.assertIs(_reduce(im, (500, 400), 3.0), im)
+        self.assertIs(_reduce(im, (100, 75), None), im)
+        self.assertEqual(_reduce(im.convert('P'), (100, 75), 3.0).size,
+                         im.size)
+
+    def test_reduce_without_image_reduce(self):
+        # Pillow before 7.0, which is all there is for Python 2, has
+        # no Image.reduce().
+        reduce_ = getattr(PIL.Image.Image, 'reduce', None)
+        if reduce_ is not None:
+            del PIL.Image.Image.reduce
+        try:
+            self.test_reduce()
+            self.test_renditions_keep_their_order()
+        finally:
+            if reduce_ is not None:
+                PIL.Image.Image.reduce = reduce_
+
+    def test_encoding(self):
+        transparent = self._path('transparent.png')
+        PIL.Image.new('RGBA', (300, 300), (0, 0, 0, 0)).save(transparent)
+        encoding = Encoding('jpeg', quality=70, progressive=True)
+
+        written = render(transparent,
+                         renditions=[(self._path('small.jpg'), (30, 30))],
+                         encoding=encoding)
+
+        im = PIL.Image.open(written[0])
+        self.assertEqual(im.format, 'JPEG')
+        self.assertTrue(im.info.get('progressive'))
+        # Transparency is flattened onto white.
+        self.assertEqual(im.convert('RGB').getpixel((15, 15)),
+                         (255, 255, 255))
+
+    def test_source_encoding(self):
+        # The format is read from the file, not taken from its name.
+        photo = self._path('photo')
+        PIL.Image.new('RGB', (300, 300), 'red').save(photo, 'JPEG')
+        renditions = [(self._path('small'), (30, 30))]
+
+        written = render(photo, renditions=renditions,
+                         encoding=Encoding('source', quality=70))
+        self.assertEqual(PIL.Image.open(written[0]).format, 'JPEG')
+
+        written = render(self.source, renditions=renditions,
+                         encoding=Encoding('source'))
+        self.assertEqual(PIL.Image.open(written[0]).format, 'PNG')
+
+    def test_for_source(self):
+        source = Encoding('source', quality=70)
+        self.assertEqual(for_source(source, 'JPEG'),
+                         Encoding('jpeg', quality=70))
+        self.assertEqual(for_source(source, 'GIF'),
+                         Encoding('png', quality=70))
+        self.assertEqual(for_source(Encoding('webp'), 'JPEG'),
+                         Encoding('webp'))
+
+        self.assertEqual(extension(source, 'JPEG'), '.jpg')
+        self.assertEqual(extension(source, 'GIF'), '.png')
+        self.assertEqual(extension(Encoding('webp')), '.webp')
+
+    def test_encoding_key(self):
+        self.assertEqual(encoding_key(Encoding()), 'png')
+        self.assertEqual(encoding_key(Encoding('png', compress_level=9)),
+                         'png-z9')
+        self.assertEqual(encoding_key(Encoding('jpeg', progressive=True)),
+                         'jpeg-q85-progressive')
+        self.assertEqual(encoding_key(Encoding('webp', quality=60)),
+                         'webp-q60')
+        self.assertEqual(encoding_key(Encoding('source')), 'source-q85-z6')
+        self.assertEqual(
+            encoding_key(Encoding('source', quality=70, compress_level=9,
+                                  progressive=True)),
+            'source-q70-z9-progressive')
@@ -0,0 +1,366 @@
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import PIL.Image
+
+from lazy_slides import manipulation, transport
+from lazy_slides.blobstore import BlobStore
+from lazy_slides.cache import open_cache
+from lazy_slides.manipulation import Encoding
+from lazy_slides.tests.util import (http_server, patched, python2_module,
+                                    send)
+
+resolver = python2_module('lazy_slides.resolver')
+futures = python2_module('futures')
+search = python2_module('lazy_slides.search')
+
+def _png(color):
+    data = io.BytesIO()
+    PIL.Image.new('RGB', (40, 30), color).save(data, 'PNG')
+    return data.getvalue()
+
+def _config(**kwargs):
+    config = argparse.Namespace(sizes=[(20, 15)],
+                                encoding=Encoding(),
+                                max_download_bytes=None,
+                                hedge_delay=0,
+                                search_function='engine',
+                                revalidate='off',
+                                revalidate_after=0,
+                                resample=None,
+                                quality='normal',
+                                search_ttl=None,
+                                negative_ttl=None)
+    for name, value in kwargs.items():
+        setattr(config, name, value)
+    return config
+
+@unittest.skipIf(resolver is None, 'needs Python 2')
+class HedgedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+        self.release = threading.Event()
+        self.hung = []
+        self.routes = {
+            '/hangs': self._hangs,
+            '/image': lambda handler: send(handler, _png('red')),
+        }
+
+    def tearDown(self):
+        self.release.set()
+        transport.configure()
+        shutil.rmtree(self.directory)
+
+    def _hangs(self, handler):
+        self.hung.append(handler.path)
+        self.release.wait(10)
+        send(handler, _png('blue'))
+
+    def _resolver(self, **kwargs):
+        return resolver.Resolver('tag', _config(**kwargs), {}, None,
+                                 self.store, None)
+
+    def test_next_candidate_wins(self):
+        # One pooled connection per host, as with a single worker: the
+        # hedge mustn't wait for the hanging request's connection.
+        transport.configure(pool_size=1)
+
+        with http_server(self.routes) as url:
+            start = time.time()
+            result = self._resolver(hedge_delay=0.2)._download_any(
+                [url + '/hangs', url + '/image'])
+            elapsed = time.time() - start
+
+        self.assertEqual(result.url, url + '/image')
+        self.assertLess(elapsed, 2)
+        self.assertEqual(PIL.Image.open(result.filename).getpixel((0, 0)),
+                         (255, 0, 0))
+
+    def test_losers_are_cancelled(self):
+        with patched(transport, 'TIMEOUT', 0.5), \
+                http_server(self.routes) as url:
+            result = self._resolver(hedge_delay=0.1)._download_any(
+                [url + '/hangs', url + '/image'])
+            # Give the loser time to time out and be retried.
+            time.sleep(2)
+
+        self.assertEqual(result.url, url + '/image')
+        self.assertEqual(self.hung, ['/hangs'])
+
+@unittest.skipIf(resolver is None, 'needs Python 2')
+class RevalidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+        self.etag = '"red"'
+        self.data = _png('red')
+        self.requests = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _image(self, handler):
+        self.requests += 1
+        if handler.headers.get('If-None-Match') == self.etag:
+            send(handler, status=304)
+        else:
+            send(handler, self.data, headers=[('ETag', self.etag)])
+
+    def _blob(self, data):
+        filename = self.store.temp_path('.png')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return self.store.put(filename)
+
+    def _revalidate(self, cache, url, **kwargs):
+        base = self._blob(_png('red'))
+        # Both tags found the same image.
+        cache.set_many('engine', [('a', base, -1, -1, 40, 30, 'PNG'),
+                                  ('b', base, -1, -1, 40, 30, 'PNG')])
+        cache.set_source('engine', 'a', url, '"red"')
+
+        r = resolver.Resolver('a', _config(**kwargs), {}, base,
+                              self.store, cache)
+        return base, r.revalidate()
+
+    def test_unchanged(self):
+        with open_cache(':memory:', None) as cache, \
+                http_server({'/image': self._image}) as url:
+            base, changed = self._revalidate(cache, url + '/image')
+
+            self.assertFalse(changed)
+            self.assertEqual(cache.get('engine', 'a'), base)
+            self.assertEqual(self.requests, 1)
+
+    def test_not_due(self):
+        with open_cache(':memory:', None) as cache, \
+                http_server({'/image': self._image}) as url:
+            _, changed = self._revalidate(cache, url + '/image',
+                                          revalidate_after=60)
+
+            self.assertFalse(changed)
+            self.assertEqual(self.requests, 0)
+
+    def test_changed(self):
+        self.etag = '"blue"'
+        self.data = _png('blue')
+
+        with open_cache(':memory:', None) as cache, \
+                http_server({'/image': self._image}) as url:
+            base, changed = self._revalidate(cache, url + '/image')
+
+            self.assertTrue(changed)
+            new_base = cache.get('engine', 'a')
+            self.assertNotEqual(new_base, base)
+            self.assertEqual(PIL.Image.open(new_base).getpixel((0, 0)),
+                             (0, 0, 255))
+            self.assertEqual(cache.get_source('engine', 'a')[1], '"blue"')
+            # The other tag sharing the old image keeps it.
+            self.assertEqual(cache.get('engine', 'b'), base)
+
+@unittest.skipIf(resolver is None, 'needs Python 2')
+class ProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+        self.source = os.path.join(self.directory, 'source.png')
+        PIL.Image.new('RGB', (400, 300), 'red').save(self.source)
+        self.render = manipulation.render
+        self.renders = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _render(self, infilename, **kwargs):
+        self.renders.append(infilename)
+        return self.render(infilename, **kwargs)
+
+    def test_single_decode(self):
+        sizes = [(40, 30), (200, 150)]
+
+        with open_cache(':memory:', None) as cache, \
+                patched(manipulation, 'render', self._render):
+            r = resolver.Resolver('tag', _config(sizes=sizes), {}, None,
+                                  self.store, cache)
+            r._download = r._download_url(self.source)
+            tag, fnames = r.process()
+
+            self.assertEqual(len(self.renders), 1)
+            self.assertEqual(
+                dict((size, PIL.Image.open(f).size)
+                     for size, f in fnames.items()),
+                dict((size, size) for size in sizes))
+            self.assertEqual(
+                PIL.Image.open(cache.get('engine', 'tag')).size, (400, 300))
+            for size in sizes:
+                self.assertEqual(cache.get('engine', 'tag', *size),
+                                 fnames[size])
+
+    def test_source_encoding(self):
+        # Served from a URL with no extension to go by.
+        data = io.BytesIO()
+        PIL.Image.new('RGB', (400, 300), 'red').save(data, 'JPEG')
+        routes = {'/photo': lambda handler: send(handler, data.getvalue())}
+        encoding = Encoding('source', quality=70)
+
+        with open_cache(':memory:', None) as cache, \
+                http_server(routes) as url:
+            r = resolver.Resolver('tag',
+                                  _config(encoding=encoding,
+                                          sizes=[(200, 150)]),
+                                  {}, None, self.store, cache)
+            r._download = r._download_url(url + '/photo')
+            _, fnames = r.process()
+
+            self.assertTrue(fnames[(200, 150)].endswith('.jpg'))
+            self.assertEqual(PIL.Image.open(fnames[(200, 150)]).format,
+                             'JPEG')
+            self.assertEqual(cache.get_source('engine', 'tag')[4], 'JPEG')
+
+            # A new size made from the cached PNG base is a JPEG too.
+            base = cache.get('engine', 'tag')
+            r = resolver.Resolver('tag',
+                                  _config(encoding=encoding,
+                                          sizes=[(40, 30)]),
+                                  {}, base, self.store, cache)
+            _, fnames = r.resolve()
+
+            self.assertEqual(PIL.Image.open(base).format, 'PNG')
+            self.assertEqual(PIL.Image.open(fnames[(40, 30)]).format, 'JPEG')
+
+    def test_process_pool(self):
+        executor = futures.ProcessPoolExecutor(1)
+        try:
+            with open_cache(':memory:', None) as cache:
+                r = resolver.Resolver('tag', _config(sizes=[(40, 30)]), {},
+                                      None, self.store, cache,
+                                      cpu_executor=executor)
+                self.assertNotEqual(r._image_work(os.getpid), os.getpid())
+
+                r._download = r._download_url(self.source)
+                tag, fnames = r.process()
+
+                self.assertEqual(PIL.Image.open(fnames[(40, 30)]).size,
+                                 (40, 30))
+                self.assertEqual(cache.get('engine', 'tag', 40, 30),
+                                 fnames[(40, 30)])
+        finally:
+            executor.shutdown()
+
+    def _cache_rendition(self, cache):
+        r = resolver.Resolver('tag', _config(sizes=[(200, 150)]), {}, None,
+                              self.store, cache)
+        r._download = r._download_url(self.source)
+        _, fnames = r.process()
+        return cache.get('engine', 'tag'), fnames[(200, 150)]
+
+    def test_reuses_renditions(self):
+        with open_cache(':memory:', None) as cache:
+            base, rendition = self._cache_rendition(cache)
+
+            with patched(manipulation, 'render', self._render):
+                r = resolver.Resolver('tag', _config(sizes=[(40, 30)]), {},
+                                      base, self.store, cache)
+                _, fnames = r.resolve()
+
+            self.assertEqual(self.renders, [rendition])
+            self.assertEqual(cache.get('engine', 'tag', 40, 30),
+                             fnames[(40, 30)])
+
+    def test_other_quality_is_not_cached(self):
+        for config in [_config(sizes=[(40, 30)], quality='best'),
+                       _config(sizes=[(40, 30)], resample='bicubic')]:
+            with open_cache(':memory:', None) as cache:
+                base, rendition = self._cache_rendition(cache)
+                self.renders = []
+
+                with patched(manipulation, 'render', self._render):
+                    r = resolver.Resolver('tag', config, {}, base,
+                                          self.store, cache)
+                    _, fnames = r.resolve()
+
+                # Made from the full base image, not the rendition
+                # resized at normal quality, and not recorded.
+                self.assertEqual(self.renders, [base])
+                self.assertEqual(PIL.Image.open(fnames[(40, 30)]).size,
+                                 (40, 30))
+                self.assertIsNone(cache.get('engine', 'tag', 40, 30))
+
+@unittest.skipIf(resolver is None, 'needs Python 2')
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = BlobStore(self.directory)
+        self.image = os.path.join(self.directory, 'image.png')
+        PIL.Image.new('RGB', (40, 30), 'red').save(self.image)
+        self.missing = os.path.join(self.directory, 'missing.png')
+        self.results = [self.image]
+        self.searches = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _search(self, tag, count):
+        self.searches.append(tag)
+        return self.results
+
+    def _fetch(self, cache):
+        r = resolver.Resolver('tag', _config(), {}, None, self.store, cache)
+        with patched(search, 'search_function', self._search):
+            r.fetch()
+        return r._download
+
+    def test_reuses_results(self):
+        with open_cache(':memory:', None) as cache:
+            self.assertEqual(self._fetch(cache).url, self.image)
+            self.assertEqual(self._fetch(cache).url, self.image)
+
+        self.assertEqual(self.searches, ['tag'])
+
+    def test_reuses_negative_results(self):
+        self.results = []
+        with open_cache(':memory:', None) as cache:
+            self.assertRaises(KeyError, self._fetch, cache)
+            self.assertRaises(KeyError, self._fetch, cache)
+
+        self.assertEqual(self.searches, ['tag'])
+
+    def test_searches_again_when_cached_results_fail(self):
+        with open_cache(':memory:', None) as cache:
+            cache.set_search('engine', 'tag', resolver.SEARCH_COUNT,
+                             [self.missing])
+
+            self.assertEqual(self._fetch(cache).url, self.image)
+            self.assertEqual(self.searches, ['tag'])
+            # The fresh results replace the stale ones.
+            self.assertEqual(
+                cache.get_search('engine', 'tag', resolver.SEARCH_COUNT),
+                [self.image])
+
+    def test_gives_up_when_results_are_unchanged(self):
+        self.results = [self.missing]
+        with open_cache(':memory:', None) as cache:
+            cache.set_search('engine', 'tag', resolver.SEARCH_COUNT,
+                             [self.missing])
+
+            self.assertRaises(IOError, self._fetch, cache)
+            self.assertEqual(self.searches, ['tag'])
+
+    def test_fresh_results_which_fail(self):
+        self.results = [self.missing]
+        with open_cache(':memory:', None) as cache:
+            self.assertRaises(IOError, self._fetch, cache)
+
+        # Results which were just found aren't searched for again.
+        self.assertEqual(self.searches, ['tag'])
@@ -0,0 +1,117 @@
+import threading
+import time
+import unittest
+
+import requests
+
+from lazy_slides.scheduler import (Cancelled, CircuitBreaker,
+                                   CircuitOpenError, Scheduler, TokenBucket)
+
+URL = 'http://example.com/image.jpg'
+
+class Flaky:
+    '''A callable which fails transiently a number of times.'''
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise requests.ConnectionError('connection reset')
+        return 'data'
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_retries_transient_failures(self):
+        scheduler = Scheduler(retries=2, backoff=0.001)
+        func = Flaky(2)
+        self.assertEqual(scheduler.call(URL, func), 'data')
+        self.assertEqual(func.calls, 3)
+
+    def test_gives_up_after_retries(self):
+        scheduler = Scheduler(retries=1, backoff=0.001)
+        func = Flaky(5)
+        self.assertRaises(requests.ConnectionError, scheduler.call, URL, func)
+        self.assertEqual(func.calls, 2)
+
+    def test_does_not_retry_other_errors(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise IOError('too big')
+
+        scheduler = Scheduler(retries=3, backoff=0.001)
+        self.assertRaises(IOError, scheduler.call, URL, func)
+        self.assertEqual(len(calls), 1)
+
+    def test_does_not_retry_cancelled_work(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise Cancelled('nobody wants it')
+
+        scheduler = Scheduler(retries=3, backoff=0.001, threshold=1)
+        self.assertRaises(Cancelled, scheduler.call, URL, func)
+        self.assertEqual(len(calls), 1)
+        # Being cancelled isn't the host's fault.
+        self.assertEqual(scheduler.call(URL, Flaky(0)), 'data')
+
+    def test_circuit_opens_per_host(self):
+        scheduler = Scheduler(retries=0, threshold=2, reset_timeout=60)
+        for _ in range(2):
+            self.assertRaises(requests.ConnectionError,
+                              scheduler.call, URL, Flaky(1))
+
+        self.assertRaises(CircuitOpenError, scheduler.call, URL, Flaky(0))
+        self.assertEqual(
+            scheduler.call('http://other.com/image.jpg', Flaky(0)), 'data')
+
+    def test_max_concurrency(self):
+        scheduler = Scheduler(max_concurrency=2)
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def func():
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+        threads = [threading.Thread(target=scheduler.call, args=(URL, func))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(active[1], 2)
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        breaker.failed()
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        # Only one trial call is let through.
+        self.assertFalse(breaker.allow())
+
+        breaker.succeeded()
+        self.assertTrue(breaker.allow())
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_rate(self):
+        bucket = TokenBucket(rate=100, burst=1)
+        start = time.time()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.04)
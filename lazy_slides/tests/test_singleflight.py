@@ -0,0 +1,152 @@
+import threading
+import unittest
+
+from lazy_slides.tests.util import python2_module
+
+singleflight = python2_module('lazy_slides.singleflight')
+futures = python2_module('futures')
+
+class Blocking:
+    '''A call which runs until it's released or cancelled.'''
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = None
+        self.calls = 0
+
+    def __call__(self, value, cancel=None):
+        self.calls += 1
+        self.started.set()
+        while not self.release.wait(0.01):
+            if cancel is not None and cancel.is_set():
+                return 'cancelled'
+        if self.error is not None:
+            raise self.error
+        return value
+
+@unittest.skipIf(singleflight is None, 'needs Python 2')
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = singleflight.SingleFlight()
+
+    def _do_in_threads(self, func, count=4):
+        '''Call `func` for one key from several threads at once.
+
+        :return: The list of results, or exceptions, of the calls.
+        '''
+        results = []
+
+        def do():
+            try:
+                results.append(self.flight.do('key', func, 'value'))
+            except Exception as exc:
+                results.append(exc)
+
+        threads = [threading.Thread(target=do) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        # Only let the call finish once everyone has joined it.
+        while self.flight._flights.get('key') is None or \
+                self.flight._flights['key'].waiters < count:
+            threads[0].join(0.01)
+        func.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalesces(self):
+        func = Blocking()
+
+        self.assertEqual(self._do_in_threads(func), ['value'] * 4)
+        self.assertEqual(func.calls, 1)
+
+        # Once it's finished, the key is free again.
+        self.assertEqual(self.flight.do('key', func, 'again'), 'again')
+        self.assertEqual(func.calls, 2)
+
+    def test_shares_errors(self):
+        func = Blocking()
+        error = IOError('no image')
+        func.error = error
+
+        self.assertEqual(self._do_in_threads(func), [error] * 4)
+        self.assertEqual(func.calls, 1)
+        self.assertEqual(self.flight._flights, {})
+
+    def test_keys_are_separate(self):
+        func = Blocking()
+        func.release.set()
+
+        self.assertEqual(self.flight.do('a', func, 'a'), 'a')
+        self.assertEqual(self.flight.do('b', func, 'b'), 'b')
+        self.assertEqual(func.calls, 2)
+
+    def test_submit_shares_future(self):
+        func = Blocking()
+        executor = futures.ThreadPoolExecutor(2)
+        try:
+            first = self.flight.submit('key', executor, func, 'value')
+            second = self.flight.submit('key', executor, func, 'other')
+            func.release.set()
+
+            self.assertIs(first, second)
+            self.assertEqual(second.result(5), 'value')
+            self.assertEqual(func.calls, 1)
+        finally:
+            executor.shutdown()
+
+@unittest.skipIf(singleflight is None, 'needs Python 2')
+class LeaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = singleflight.SingleFlight()
+        self.executor = futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def _submit(self, func):
+        return self.flight.submit('key', self.executor, func, 'value')
+
+    def test_cancelled_once_everyone_leaves(self):
+        func = Blocking()
+        first = self._submit(func)
+        second = self._submit(func)
+        self.assertIs(first, second)
+
+        self.assertFalse(self.flight.leave('key', first))
+        self.assertTrue(self.flight.leave('key', second))
+        self.assertEqual(first.result(5), 'cancelled')
+
+        # The key is free again straight away.
+        func = Blocking()
+        func.release.set()
+        self.assertEqual(self._submit(func).result(5), 'value')
+        self.assertEqual(func.calls, 1)
+
+    def test_do_is_never_left(self):
+        func = Blocking()
+        future = self._submit(func)
+        func.started.wait(5)
+        done = []
+        waiter = threading.Thread(
+            target=lambda: done.append(self.flight.do('key', func, 'other')))
+        waiter.start()
+        while self.flight._flights['key'].waiters < 2:
+            waiter.join(0.01)
+
+        self.assertFalse(self.flight.leave('key', future))
+        func.release.set()
+        waiter.join(5)
+        self.assertEqual(done, ['value'])
+        self.assertEqual(func.calls, 1)
+
+    def test_finished_calls_are_left_alone(self):
+        func = Blocking()
+        func.release.set()
+        future = self._submit(func)
+        future.result(5)
+
+        self.assertFalse(self.flight.leave('key', future))
@@ -0,0 +1,358 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import PIL.Image
+
+from lazy_slides import transport
+from lazy_slides.cache import open_cache
+from lazy_slides.manipulation import Encoding
+from lazy_slides.scheduler import Scheduler
+from lazy_slides.tests.util import patched, python2_module
+
+slides = python2_module('lazy_slides.slides')
+
+# Command line options given by their long names, the attribute each
+# sets and the value expected.
+LONG_OPTIONS = [
+    (['--cache-entries', '5'], 'cache_entries', 5),
+    (['--cache-bytes', '1000'], 'cache_bytes', 1000),
+    (['--commit-every', '3'], 'commit_every', 3),
+    (['--search-ttl', '60'], 'search_ttl', 60),
+    (['--negative-ttl', '30'], 'negative_ttl', 30),
+    (['--cache-backend', 'orm'], 'cache_backend', 'orm'),
+    (['--shared'], 'shared', True),
+    (['--lock-timeout', '1.5'], 'lock_timeout', 1.5),
+    (['--max-download-bytes', '100'], 'max_download_bytes', 100),
+    (['--hedge-delay', '0.5'], 'hedge_delay', 0.5),
+    (['--engine', 'pipeline'], 'engine', 'pipeline'),
+    (['--io-workers', '8'], 'io_workers', 8),
+    (['--verbose'], 'verbose', True),
+    (['--output', 'talk.pdf'], 'output', 'talk.pdf'),
+    (['--fail-on-missing'], 'fail_on_missing', True),
+    (['--search-function', 'f'], 'search_function', 'f'),
+    (['--image-width', '10'], 'image_width', 10),
+    (['--image-height', '20'], 'image_height', 20),
+    (['--workers', '2'], 'num_workers', 2),
+    (['--directory', 'data'], 'directory', 'data'),
+    (['--host-concurrency', '2'], 'host_concurrency', 2),
+    (['--host-rate', '1.5'], 'host_rate', 1.5),
+    (['--retries', '1'], 'retries', 1),
+    (['--revalidate', 'sync'], 'revalidate', 'sync'),
+    (['--revalidate-after', '0'], 'revalidate_after', 0),
+    (['--resample', 'lanczos'], 'resample', 'lanczos'),
+    (['--quality', 'best'], 'quality', 'best'),
+    (['--cpu-executor', 'processes'], 'cpu_executor', 'processes'),
+    (['--cpu-workers', '2'], 'cpu_workers', 2),
+    (['--sizes', '10x10'], 'sizes', [(10, 10)]),
+    (['--encoding', 'jpeg'], 'encode_format', 'jpeg'),
+    (['--encode-quality', '70'], 'encode_quality', 70),
+    (['--progressive'], 'progressive', True),
+    (['--compress-level', '9'], 'compress_level', 9),
+    (['--stream'], 'stream', True),
+]
+
+GC_LONG_OPTIONS = [
+    (['--verbose'], 'verbose', True),
+    (['--directory', 'data'], 'directory', 'data'),
+    (['--cache-backend', 'orm'], 'cache_backend', 'orm'),
+    (['--min-age', '5'], 'min_age', 5),
+    (['--dry-run'], 'dry_run', True),
+]
+
+class FakeResolver:
+    '''Records which threads its stages run on.'''
+
+    def __init__(self, tag, fetch=None, fnames=None):
+        self.tag = tag
+        self._fetch = fetch
+        self.fnames = fnames or {}
+        self.fetch_thread = None
+        self.process_thread = None
+        self.processed = 0
+        self.success = False
+
+    def fetch(self):
+        self.fetch_thread = threading.current_thread()
+        if self._fetch is not None:
+            self._fetch()
+
+    def process(self):
+        self.process_thread = threading.current_thread()
+        self.processed += 1
+        self.success = True
+        return (self.tag, dict(self.fnames))
+
+def _config(**kwargs):
+    config = argparse.Namespace(directory=tempfile.gettempdir(),
+                                shared=False,
+                                host_concurrency=4,
+                                host_rate=0,
+                                retries=0,
+                                engine='pipeline',
+                                num_workers=2,
+                                cpu_executor='threads',
+                                cpu_workers=1,
+                                io_workers=3)
+    for name, value in kwargs.items():
+        setattr(config, name, value)
+    return config
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = slides.Builder(_config())
+
+    def tearDown(self):
+        transport.set_scheduler(Scheduler())
+        transport.configure()
+
+    def _fail(self):
+        raise IOError('no image')
+
+    def test_stages(self):
+        resolvers = [FakeResolver(tag) for tag in 'abcd']
+        failed = FakeResolver('failed', fetch=self._fail)
+
+        results = list(self.builder._resolve(resolvers + [failed]))
+
+        self.assertEqual(sorted(tag for tag, _ in results), list('abcd'))
+        # A failed fetch isn't processed.
+        self.assertIsNone(failed.process_thread)
+        # Processing never runs on the I/O threads, and there's one
+        # CPU worker.
+        fetch_threads = set(r.fetch_thread for r in resolvers)
+        process_threads = set(r.process_thread for r in resolvers)
+        self.assertEqual(len(process_threads), 1)
+        self.assertFalse(fetch_threads & process_threads)
+
+    def test_processing_overlaps_fetching(self):
+        # The slow fetch only finishes once the fast tag has been
+        # processed, so the stages must run at the same time.
+        processed = threading.Event()
+        waited = []
+        slow = FakeResolver('slow',
+                            fetch=lambda: waited.append(processed.wait(5)))
+        fast = FakeResolver('fast')
+        process = fast.process
+        fast.process = lambda: (process(), processed.set())[0]
+
+        results = self.builder._resolve([slow, fast])
+
+        self.assertEqual([tag for tag, _ in results], ['fast', 'slow'])
+        self.assertEqual(waited, [True])
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class CpuExecutorTest(unittest.TestCase):
+
+    def tearDown(self):
+        transport.set_scheduler(Scheduler())
+
+    def _run(self, cpu_executor):
+        builder = slides.Builder(_config(cpu_executor=cpu_executor))
+        pids = []
+
+        def run(cache):
+            if builder.cpu_executor is not None:
+                pids.append(builder.cpu_executor.submit(os.getpid).result())
+
+        with patched(builder, '_run', run):
+            builder.run(None)
+
+        # The pool only lasts as long as the build.
+        self.assertIsNone(builder.cpu_executor)
+        return pids
+
+    def test_threads(self):
+        self.assertEqual(self._run('threads'), [])
+
+    def test_processes(self):
+        pids = self._run('processes')
+        self.assertEqual(len(pids), 1)
+        self.assertNotEqual(pids[0], os.getpid())
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class ParseArgsTest(unittest.TestCase):
+
+    def _parse(self, *args):
+        with patched(sys, 'argv', ['lazy_slides'] + list(args)):
+            return slides.parse_args()
+
+    def test_long_options(self):
+        for args, dest, value in LONG_OPTIONS:
+            config = self._parse('tag', *args)
+            self.assertEqual(getattr(config, dest), value)
+
+    def test_gc_long_options(self):
+        for args, dest, value in GC_LONG_OPTIONS:
+            config = slides.parse_gc_args(list(args))
+            self.assertEqual(getattr(config, dest), value)
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class CreateResolversTest(unittest.TestCase):
+
+    def tearDown(self):
+        transport.set_scheduler(Scheduler())
+
+    def _resolvers(self, **kwargs):
+        config = dict(tags=['tag'],
+                      sizes=[(40, 30)],
+                      search_function='engine',
+                      encoding=Encoding(),
+                      resample=None,
+                      quality='normal')
+        config.update(kwargs)
+        builder = slides.Builder(_config(**config))
+        with open_cache(':memory:', None) as cache:
+            cache.set_many('engine', [('tag', __file__, -1, -1),
+                                      ('tag', __file__, 40, 30)])
+            return builder._create_resolvers(cache)
+
+    def test_cached(self):
+        [r] = self._resolvers()
+        self.assertEqual(r.fnames, {(40, 30): __file__})
+        self.assertEqual(r.base_fname, __file__)
+
+    def test_other_quality_is_not_cached(self):
+        for kwargs in [dict(quality='best'), dict(resample='lanczos')]:
+            [r] = self._resolvers(**kwargs)
+            # Only the base image is reused.
+            self.assertEqual(r.fnames, {})
+            self.assertEqual(r.base_fname, __file__)
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class SizesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        transport.set_scheduler(Scheduler())
+
+    def test_parse_sizes(self):
+        self.assertEqual(slides.parse_sizes('1024x768, 640X480'),
+                         [(1024, 768), (640, 480)])
+
+    def test_parse_invalid_sizes(self):
+        for text in ['', '1024', '1024x', 'x768', 'axb', '1024x768x2',
+                     '1024x768,', '0x768', '1024x0', '-1024x768',
+                     '1024x768,1024x768']:
+            self.assertRaises(argparse.ArgumentTypeError,
+                              slides.parse_sizes, text)
+
+    def test_output_filename(self):
+        one = [(1024, 768)]
+        two = [(1024, 768), (640, 480)]
+        self.assertEqual(slides.output_filename('slides.pdf', (1024, 768),
+                                                one),
+                         'slides.pdf')
+        self.assertEqual(slides.output_filename('slides.pdf', (640, 480),
+                                                two),
+                         'slides-640x480.pdf')
+        self.assertEqual(slides.output_filename('out/talk', (1024, 768),
+                                                two),
+                         'out/talk-1024x768')
+
+    def test_two_sizes(self):
+        sizes = [(64, 48), (32, 24)]
+        output = os.path.join(self.directory, 'slides.pdf')
+        resolvers = []
+        for tag, color in [('a', 'red'), ('b', 'blue')]:
+            fnames = {}
+            for width, height in sizes:
+                fnames[(width, height)] = os.path.join(
+                    self.directory, '{}-{}.png'.format(tag, width))
+                PIL.Image.new('RGB', (width, height), color).save(
+                    fnames[(width, height)])
+            resolvers.append(FakeResolver(tag, fnames=fnames))
+
+        builder = slides.Builder(_config(tags=['a', 'b'],
+                                         sizes=sizes,
+                                         output=output,
+                                         stream=False,
+                                         revalidate='off'))
+        with patched(builder, '_create_resolvers', lambda cache: resolvers):
+            builder._run(None)
+
+        # Each tag is resolved once for both slideshows.
+        self.assertEqual([r.processed for r in resolvers], [1, 1])
+        self.assertFalse(os.path.exists(output))
+        for width, height in sizes:
+            filename = os.path.join(
+                self.directory, 'slides-{}x{}.pdf'.format(width, height))
+            with open(filename, 'rb') as f:
+                pdf = f.read()
+            self.assertEqual(pdf.count(b'/Type /Page\n'), 2)
+            self.assertEqual(
+                pdf.count('/MediaBox [ 0 0 {} {} ]'.format(
+                    width, height).encode('ascii')),
+                2)
+
+class FakeSlideshow:
+    '''Records the images added to it.'''
+
+    def __init__(self, outfile, size):
+        self.outfile = outfile
+        self.size = size
+        self.pages = []
+
+    def add_slide(self, filename):
+        self.pages.append(filename)
+
+@unittest.skipIf(slides is None, 'needs Python 2')
+class StreamTest(unittest.TestCase):
+
+    def tearDown(self):
+        transport.set_scheduler(Scheduler())
+
+    def _stream(self, tags, resolvers):
+        sizes = [(64, 48), (32, 24)]
+        builder = slides.Builder(_config(tags=tags,
+                                         sizes=sizes,
+                                         output='slides.pdf'))
+        for r in resolvers:
+            r.fnames = dict((size, '{}-{}'.format(r.tag, size[0]))
+                            for size in sizes)
+        with patched(slides.generate, 'Slideshow', FakeSlideshow):
+            return builder._stream_slides(resolvers)
+
+    def _delayed(self, tag, delay):
+        return FakeResolver(tag, fetch=lambda: time.sleep(delay))
+
+    def test_tag_order(self):
+        # The tags finish in reverse order.
+        resolvers = [self._delayed('a', 0.2),
+                     self._delayed('b', 0.1),
+                     self._delayed('c', 0)]
+
+        slideshows = self._stream(['a', 'b', 'c'], resolvers)
+
+        self.assertEqual([s.outfile for s in slideshows],
+                         ['slides-64x48.pdf', 'slides-32x24.pdf'])
+        self.assertEqual(slideshows[0].pages, ['a-64', 'b-64', 'c-64'])
+        self.assertEqual(slideshows[1].pages, ['a-32', 'b-32', 'c-32'])
+
+    def test_duplicate_tags(self):
+        resolvers = [self._delayed('a', 0.1), self._delayed('b', 0)]
+
+        slideshows = self._stream(['a', 'b', 'a'], resolvers)
+
+        self.assertEqual(slideshows[0].pages, ['a-64', 'b-64', 'a-64'])
+        self.assertEqual(slideshows[1].pages, ['a-32', 'b-32', 'a-32'])
+
+    def test_failed_tag(self):
+        def fail():
+            raise IOError('no image')
+
+        resolvers = [FakeResolver('a'),
+                     FakeResolver('b', fetch=fail),
+                     FakeResolver('c')]
+
+        self.assertIsNone(self._stream(['a', 'b', 'c'], resolvers))
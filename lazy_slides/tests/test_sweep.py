@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lazy_slides.blobstore import BlobStore
+from lazy_slides.cache import open_cache
+from lazy_slides.sweep import sweep
+
+class SweepTest(unittest.TestCase):
+    backend = 'sqlite'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.directory, 'cache.db')
+        self.store = BlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _blob(self, data):
+        filename = self.store.temp_path('.png')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return self.store.put(filename)
+
+    def test_sweep(self):
+        kept = self._blob(b'kept')
+        orphan = self._blob(b'orphan')
+        partial = self.store.temp_path('.jpg')
+        with open(partial, 'wb') as f:
+            f.write(b'partial')
+
+        with open_cache(self.db_file, None, backend=self.backend) as cache:
+            cache.set('engine', 'kept', kept)
+            cache.set('engine', 'gone', os.path.join(self.directory, 'gone'))
+
+            report = sweep(self.directory, cache, min_age=0)
+
+            self.assertEqual(report.orphans, sorted([orphan, partial]))
+            self.assertEqual(report.dangling,
+                             [os.path.join(self.directory, 'gone')])
+            self.assertEqual(report.reclaimed, len(b'orphan') + len(b'partial'))
+
+            self.assertTrue(os.path.exists(kept))
+            self.assertFalse(os.path.exists(orphan))
+            self.assertFalse(os.path.exists(partial))
+            self.assertTrue(os.path.exists(self.db_file))
+            self.assertEqual(cache.size(), 1)
+
+    def test_dry_run(self):
+        orphan = self._blob(b'orphan')
+
+        with open_cache(self.db_file, None, backend=self.backend) as cache:
+            report = sweep(self.directory, cache, min_age=0, dry_run=True)
+
+        self.assertEqual(report.orphans, [orphan])
+        self.assertTrue(os.path.exists(orphan))
+
+    def test_min_age(self):
+        self._blob(b'orphan')
+
+        with open_cache(self.db_file, None, backend=self.backend) as cache:
+            report = sweep(self.directory, cache, min_age=60)
+
+        self.assertEqual(report.orphans, [])
+
+
+class OrmSweepTest(SweepTest):
+    backend = 'orm'
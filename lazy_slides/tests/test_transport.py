@@ -0,0 +1,50 @@
+import unittest
+
+import requests
+
+from lazy_slides import transport
+from lazy_slides.tests.util import http_server, send
+
+def _client_port(handler):
+    send(handler, str(handler.client_address[1]).encode('ascii'))
+
+class TransportTest(unittest.TestCase):
+
+    def tearDown(self):
+        transport.configure()
+
+    def _adapter(self):
+        return transport.session().get_adapter('http://example.com/')
+
+    def test_configure(self):
+        old = transport.session()
+        transport.configure(pool_size=3)
+
+        self.assertIsNot(transport.session(), old)
+        adapter = self._adapter()
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter._pool_connections, transport.POOL_HOSTS)
+        self.assertFalse(adapter._pool_block)
+        self.assertIs(transport.session().get_adapter('https://example.com/'),
+                      adapter)
+
+    def test_default_pool_size(self):
+        self.assertEqual(self._adapter()._pool_maxsize,
+                         transport.DEFAULT_POOL_SIZE)
+
+    def test_keep_alive(self):
+        transport.configure(pool_size=1)
+        with http_server({'/port': _client_port}) as url:
+            ports = [transport.get(url + '/port').content for _ in range(3)]
+
+        # Every request went over the same connection.
+        self.assertEqual(len(set(ports)), 1)
+
+    def test_errors(self):
+        with http_server({}) as url:
+            with self.assertRaises(requests.HTTPError):
+                transport.send('GET', url + '/missing')
+
+    def test_non_http_is_not_scheduled(self):
+        self.assertEqual(transport.schedule('file:///image.png', len, 'abc'),
+                         3)
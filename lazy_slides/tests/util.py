@@ -1,5 +1,15 @@
 import contextlib
+import importlib
 import os
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
 
 def remove(path):
     try:
@@ -15,3 +25,74 @@ def temp_file(filename):
     yield
 
     remove(filename)
+
+def python2_module(name):
+    '''Import a lazy_slides module which needs Python 2's urllib2 and
+    urlparse or the futures backport.
+
+    Elsewhere this returns `None`, so the module's tests can be
+    skipped rather than failing to import.
+    '''
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        if sys.version_info[0] < 3:
+            raise
+        return None
+
+@contextlib.contextmanager
+def patched(obj, name, value):
+    '''Replace an attribute for the duration of the block.'''
+    old = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, old)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def send(handler, body=b'', status=200, headers=()):
+    '''Write a whole response from a request handler.'''
+    handler.send_response(status)
+    for header in headers:
+        handler.send_header(*header)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+@contextlib.contextmanager
+def http_server(routes):
+    '''Serve GET requests on localhost from a thread.
+
+    :param routes: A dict from request path to a function which takes
+      the request handler and writes the response, e.g. with `send()`.
+      Other paths get a 404. Connections are kept alive, so responses
+      without a Content-Length must set the handler's
+      `close_connection`.
+    :return: A context manager giving the server's base URL.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections alive, as real servers do.
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            route = routes.get(self.path)
+            if route is None:
+                self.send_error(404)
+            else:
+                route(self)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,122 @@
+'''The HTTP transport shared by the search functions and the
+downloader.
+
+All HTTP traffic goes through one `requests` session, which keeps
+per-host pools of keep-alive connections. Repeated requests to the
+same host then reuse a connection rather than paying for a new TCP
+(and TLS) handshake each time.
+
+Requests are also made through a shared `scheduler.Scheduler`, which
+limits how hard each host is hit and retries transient failures.
+'''
+
+import logging
+import threading
+
+import requests
+import requests.adapters
+
+from .scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+# The number of connections kept per host unless `configure()` says
+# otherwise.
+DEFAULT_POOL_SIZE = 10
+
+# The number of hosts for which pools are kept.
+POOL_HOSTS = 20
+
+# Seconds to wait when connecting or between bytes of a response.
+TIMEOUT = 30
+
+_session = None
+_scheduler = Scheduler()
+_lock = threading.Lock()
+
+def _create_session(pool_size):
+    session = requests.Session()
+    # Don't block waiting for a pooled connection: the scheduler
+    # already limits how many requests each host gets at once, and a
+    # hedged request has to get through while another request to the
+    # same host is stuck. Connections beyond pool_size are closed
+    # after use rather than kept.
+    adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_HOSTS,
+                                            pool_maxsize=pool_size,
+                                            pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def configure(pool_size=DEFAULT_POOL_SIZE):
+    '''(Re)create the shared session.
+
+    :param pool_size: The maximum number of connections kept open to
+      each host. This should match the number of workers making
+      requests. It doesn't limit the connections in use at once.
+    '''
+    global _session
+
+    log.info('HTTP connection pool size: {}'.format(pool_size))
+    with _lock:
+        old, _session = _session, _create_session(pool_size)
+    if old is not None:
+        old.close()
+
+def session():
+    '''Get the shared session, creating it if need be.'''
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = _create_session(DEFAULT_POOL_SIZE)
+        return _session
+
+def set_scheduler(scheduler):
+    '''Replace the shared `Scheduler`.'''
+    global _scheduler
+    _scheduler = scheduler
+
+def schedule(url, func, *args, **kwargs):
+    '''Call `func(*args, **kwargs)` as a request to `url`'s host.
+
+    See `Scheduler.call()`. Non-HTTP URLs are called straight away.
+    '''
+    if not is_http(url):
+        return func(*args, **kwargs)
+    return _scheduler.call(url, func, *args, **kwargs)
+
+def is_http(url):
+    return url.split(':', 1)[0].lower() in ('http', 'https')
+
+def send(method, url, **kwargs):
+    '''Make a request over the shared session without scheduling it.
+
+    This takes the same arguments as `requests.Session.request()`,
+    with a default timeout of `TIMEOUT`, and raises for HTTP error
+    statuses. It's meant to be called inside `schedule()`, e.g. to
+    stream a response while holding the host's concurrency slot.
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    response = session().request(method, url, **kwargs)
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+def request(method, url, **kwargs):
+    '''Make a scheduled request over the shared session.
+
+    This takes the same arguments as `send()`. Streamed responses are
+    read after the host's concurrency slot has been given back; use
+    `schedule()` and `send()` to hold it until they're read.
+    '''
+    return schedule(url, send, method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, data=None, **kwargs):
+    return request('POST', url, data=data, **kwargs)
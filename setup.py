@@ -34,8 +34,11 @@ setup(
         'pillow',
         'reportlab',
         'requests',
-        'sqlalchemy',
         ],
+    extras_require={
+        # The ORM cache backend, --cache-backend=orm.
+        'orm': ['sqlalchemy'],
+        },
 
     package_data = {
         'lazy_slides.dummy': ['*.gif', '*.jpg'],